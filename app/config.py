@@ -11,3 +11,127 @@ UPLOAD_DIR.mkdir(exist_ok=True)
 
 # Model specific configurations can go here
 DEMUCS_MODEL = "htdemucs" # Default demucs model
+
+# Demucs separation worker pool.
+# Each worker is a long-lived process that loads its models once and keeps them
+# in memory between jobs, so requests only pay for the separation itself.
+DEMUCS_WORKERS = int(os.getenv("DEMUCS_WORKERS", "1"))
+# Models loaded as soon as a worker starts (others are loaded on first use)
+DEMUCS_PRELOAD_MODELS = [m for m in os.getenv("DEMUCS_PRELOAD_MODELS", DEMUCS_MODEL).split(",") if m]
+# torch intra-op threads per worker (0 = let torch decide)
+DEMUCS_TORCH_THREADS = int(os.getenv("DEMUCS_TORCH_THREADS", "0"))
+# Tracks are separated in chunks of this length; progress is reported and
+# cancellation is checked once per chunk.
+DEMUCS_CHUNK_SECONDS = float(os.getenv("DEMUCS_CHUNK_SECONDS", "30"))
+# Tracks at least this long are cut into overlapping chunks that are separated
+# in parallel across the pool (needs DEMUCS_WORKERS > 1; 0 disables).
+DEMUCS_PARALLEL_MIN_SECONDS = float(os.getenv("DEMUCS_PARALLEL_MIN_SECONDS", "120"))
+
+# Stem separation job queue (/stems/jobs)
+STEM_JOB_CONCURRENCY = int(os.getenv("STEM_JOB_CONCURRENCY", str(DEMUCS_WORKERS)))
+STEM_JOB_MAX_QUEUE = int(os.getenv("STEM_JOB_MAX_QUEUE", "100"))
+# Finished jobs are forgotten after this many seconds
+STEM_JOB_TTL_SECONDS = int(os.getenv("STEM_JOB_TTL_SECONDS", "3600"))
+# Batch jobs (/stems/batch): tracks per batch, and how many of a batch's tracks
+# are separated at once (enough to keep every worker busy)
+STEM_BATCH_MAX_TRACKS = int(os.getenv("STEM_BATCH_MAX_TRACKS", "200"))
+STEM_BATCH_CONCURRENCY = int(os.getenv("STEM_BATCH_CONCURRENCY", str(DEMUCS_WORKERS)))
+
+# Content-addressed cache of separated stems (see app/services/stem_cache.py).
+# Least recently used entries are evicted once the total size exceeds the quota.
+STEM_CACHE_DIR = OUTPUT_DIR / "demucs"
+STEM_CACHE_MAX_BYTES = int(float(os.getenv("STEM_CACHE_MAX_GB", "20")) * 1024 ** 3)
+
+# Index of /upload/audio files (see app/services/upload_store.py); the files
+# themselves are stored in UPLOAD_DIR, sharded by id prefix.
+UPLOAD_INDEX_PATH = Path(os.getenv("UPLOAD_INDEX_PATH", str(UPLOAD_DIR / "uploads.sqlite3")))
+# Resumable uploads (/upload/sessions): default and largest accepted chunk
+# size, and how long an unfinished upload is kept.
+UPLOAD_CHUNK_BYTES = int(float(os.getenv("UPLOAD_CHUNK_MB", "8")) * 1024 ** 2)
+UPLOAD_MAX_CHUNK_BYTES = int(float(os.getenv("UPLOAD_MAX_CHUNK_MB", "64")) * 1024 ** 2)
+UPLOAD_SESSION_TTL_SECONDS = int(os.getenv("UPLOAD_SESSION_TTL_SECONDS", "86400"))
+# Largest file a resumable upload may announce (its file is preallocated)
+UPLOAD_MAX_BYTES = int(float(os.getenv("UPLOAD_MAX_GB", "4")) * 1024 ** 3)
+# Uploaded file parts are streamed here while the request arrives (see
+# app/services/ingest.py), then renamed into place: same filesystem as UPLOAD_DIR
+INGEST_DIR = UPLOAD_DIR / ".incoming"
+
+# Browser previews of uploads (/upload/preview/{file_id}, see app/services/preview.py):
+# low-bitrate renditions of the first PREVIEW_SECONDS or of the whole track,
+# rendered on first request and kept on disk.
+PREVIEW_DIR = OUTPUT_DIR / "previews"
+PREVIEW_SECONDS = float(os.getenv("PREVIEW_SECONDS", "30"))
+PREVIEW_BITRATE_KBPS = int(os.getenv("PREVIEW_BITRATE_KBPS", "96"))
+
+# Effects per /effects/chain request (all rendered in one job on the effects pool)
+EFFECT_CHAIN_MAX_EFFECTS = int(os.getenv("EFFECT_CHAIN_MAX_EFFECTS", "32"))
+
+# Decoded-PCM cache (see app/services/pcm_cache.py): every /upload/audio file
+# is decoded once to a float32 .npy that services memory-map instead of
+# decoding it again. Least recently used entries are evicted past the quota.
+PCM_CACHE_DIR = UPLOAD_DIR / ".pcm"
+PCM_CACHE_MAX_BYTES = int(float(os.getenv("PCM_CACHE_MAX_GB", "10")) * 1024 ** 3)
+
+# Disk quota for uploads and generated files (see app/services/storage.py).
+# Files are indexed with their size and last access; a background pass every
+# STORAGE_SWEEP_SECONDS deletes those not accessed within their TTL, then the
+# least recently used ones past STORAGE_MAX_GB. Files a job is using are kept.
+# Stems and decoded PCM have their own quotas above. TTLs of 0 never expire.
+STORAGE_INDEX_PATH = Path(os.getenv("STORAGE_INDEX_PATH", str(OUTPUT_DIR / "storage.sqlite3")))
+STORAGE_MAX_BYTES = int(float(os.getenv("STORAGE_MAX_GB", "50")) * 1024 ** 3)
+STORAGE_SWEEP_SECONDS = int(os.getenv("STORAGE_SWEEP_SECONDS", "300"))
+# Files uploaded with a single request (/stems, /analysis, /mastering); they
+# are deleted as soon as their request or job ends, this catches leftovers
+STORAGE_SCRATCH_TTL_SECONDS = int(os.getenv("STORAGE_SCRATCH_TTL_SECONDS", "3600"))
+# Files stored through /upload/audio
+STORAGE_UPLOAD_TTL_SECONDS = int(os.getenv("STORAGE_UPLOAD_TTL_SECONDS", str(30 * 86400)))
+# Mastered tracks and previews under /outputs
+STORAGE_OUTPUT_TTL_SECONDS = int(os.getenv("STORAGE_OUTPUT_TTL_SECONDS", str(7 * 86400)))
+MASTERING_OUTPUT_DIR = OUTPUT_DIR / "mastering"
+
+# Audio analysis (app/services/analysis.py). Tracks longer than this (DJ mixes)
+# are analyzed in constant memory with the degara beat tracker and an
+# approximate dynamic complexity; shorter ones hold one mono copy in memory.
+ANALYSIS_LONG_TRACK_SECONDS = float(os.getenv("ANALYSIS_LONG_TRACK_SECONDS", "900"))
+
+# Preview analysis (/analysis/analyze?preview=true): this many windows of this
+# many seconds, spread over the track, stand in for the whole of it.
+ANALYSIS_PREVIEW_WINDOWS = int(os.getenv("ANALYSIS_PREVIEW_WINDOWS", "3"))
+ANALYSIS_PREVIEW_WINDOW_SECONDS = float(os.getenv("ANALYSIS_PREVIEW_WINDOW_SECONDS", "10"))
+
+# Analysis results cache (see app/services/analysis_cache.py): an in-memory LRU
+# of this many results in front of an SQLite database.
+ANALYSIS_CACHE_PATH = Path(os.getenv("ANALYSIS_CACHE_PATH", str(OUTPUT_DIR / "analysis_cache.sqlite3")))
+ANALYSIS_CACHE_MEMORY_ENTRIES = int(os.getenv("ANALYSIS_CACHE_MEMORY_ENTRIES", "1024"))
+# Entries of other analyzer versions are dropped once that version stored nothing for this long
+ANALYSIS_CACHE_STALE_VERSION_SECONDS = float(os.getenv("ANALYSIS_CACHE_STALE_VERSION_DAYS", "7")) * 86400
+
+# Pools for the CPU-bound services (see app/services/executor.py): pool kind,
+# jobs run at once, and seconds a request waits for its job (0 = no limit).
+# Overridable per service, e.g. ANALYSIS_WORKERS=8 MASTERING_TIMEOUT_SECONDS=900.
+CPU_COUNT = os.cpu_count() or 1
+
+
+def _service_pool(name: str, kind: str, workers: int, timeout: float) -> dict:
+    return {
+        "kind": kind,
+        "workers": int(os.getenv(f"{name.upper()}_WORKERS", str(workers))),
+        "timeout": float(os.getenv(f"{name.upper()}_TIMEOUT_SECONDS", str(timeout))),
+    }
+
+
+SERVICE_POOLS = {
+    # Essentia and Matchering hold the GIL: separate processes
+    "analysis": _service_pool("analysis", "process", CPU_COUNT, 600),
+    # Previews get their own small pool so they don't queue behind full analyses
+    "analysis_preview": _service_pool("analysis_preview", "process", max(1, CPU_COUNT // 4), 30),
+    "mastering": _service_pool("mastering", "process", max(1, CPU_COUNT // 2), 900),
+    # Pedalboard releases the GIL and Rubberband is a subprocess: threads, no pickling
+    "effects": _service_pool("effects", "thread", CPU_COUNT, 300),
+    "commit": _service_pool("commit", "thread", CPU_COUNT, 300),
+    "timestretch": _service_pool("timestretch", "thread", CPU_COUNT, 600),
+    # Upload decoding into the PCM cache; libsndfile releases the GIL
+    "decode": _service_pool("decode", "thread", CPU_COUNT, 300),
+    # Preview encoding: libsndfile/LAME or an ffmpeg subprocess
+    "preview": _service_pool("preview", "thread", max(1, CPU_COUNT // 2), 300),
+}
@@ -1,13 +1,33 @@
 import os
 os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
 
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from app.routers import stems, analysis, mastering, effects, timestretch, commit, upload
 from app.config import OUTPUT_DIR
+from app.services import analysis as analysis_service, demucs, executor, jobs, storage
 
-app = FastAPI(title="Music Stem Separation & Analysis API")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Start the separation workers up front so the first request
+    # doesn't pay for spawning them and loading the models.
+    await demucs.start_pool()
+    # Previews are meant to be answered in well under a second
+    await executor.get_pool("analysis_preview").start(analysis_service.warm_up)
+    jobs.stem_jobs.start()
+    # Evicts expired and least recently used uploads/outputs in the background
+    storage.get_manager().start()
+    yield
+    await storage.get_manager().stop()
+    await jobs.stem_jobs.stop()
+    demucs.shutdown_pool()
+    executor.shutdown()
+
+
+app = FastAPI(title="Music Stem Separation & Analysis API", lifespan=lifespan)
 
 # Configure CORS
 app.add_middleware(
@@ -18,8 +38,18 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
+class OutputFiles(StaticFiles):
+    """Static files that record each download, so eviction keeps what is still being fetched."""
+
+    async def get_response(self, path: str, scope):
+        response = await super().get_response(path, scope)
+        if response.status_code in (200, 206, 304):
+            await storage.get_manager().atouch(os.path.join(self.directory, path))
+        return response
+
+
 # Mount outputs directory to serve generated files
-app.mount("/outputs", StaticFiles(directory=OUTPUT_DIR), name="outputs")
+app.mount("/outputs", OutputFiles(directory=OUTPUT_DIR), name="outputs")
 
 app.include_router(stems.router)
 app.include_router(analysis.router)
@@ -30,6 +60,16 @@ app.include_router(timestretch.router)
 app.include_router(commit.router)
 app.include_router(upload.router)
 
+@app.get("/status/pools")
+async def pool_status():
+    """Queue depth, running jobs and counters of each CPU-bound service's pool."""
+    return executor.stats()
+
+@app.get("/status/storage")
+def storage_status():
+    """Files and bytes under the disk quota per area (scratch, upload, output)."""
+    return storage.get_manager().stats()
+
 @app.get("/")
 async def root():
     return {"message": "Stem Extraction API is running. Use POST /stems/extract to separate audio."}
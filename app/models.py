@@ -1,11 +1,50 @@
 from pydantic import BaseModel
-from typing import Dict, Optional
+from typing import Dict, List, Optional
 
 class StemResponse(BaseModel):
     status: str
     model: str
     stems: Dict[str, str]
     processing_time: float
+    archive_url: Optional[str] = None  # all stems as one zip download
+    error: Optional[str] = None
+
+class StemJobResponse(BaseModel):
+    job_id: str
+    status: str  # queued, running, done, failed, cancelled
+    model: str
+    priority: int
+    progress: float
+    segments_done: int
+    segments_total: int
+    stems: Optional[Dict[str, str]] = None
+    archive_url: Optional[str] = None
+    processing_time: Optional[float] = None
+    error: Optional[str] = None
+
+class StemBatchTrack(BaseModel):
+    name: str
+    status: str  # queued, running, done, failed, cancelled
+    progress: float
+    duration: Optional[float] = None  # seconds of audio
+    stems: Optional[Dict[str, str]] = None
+    archive_url: Optional[str] = None
+    processing_time: Optional[float] = None
+    error: Optional[str] = None
+
+class StemBatchResponse(BaseModel):
+    job_id: str
+    status: str
+    model: str
+    priority: int
+    progress: float
+    tracks_total: int
+    tracks_done: int
+    tracks_failed: int
+    tracks: List[StemBatchTrack]
+    audio_seconds: float  # total duration of the finished tracks
+    processing_time: Optional[float] = None
+    realtime_factor: Optional[float] = None  # audio seconds separated per wall-clock second
     error: Optional[str] = None
 
 class AnalysisResponse(BaseModel):
@@ -13,11 +52,22 @@ class AnalysisResponse(BaseModel):
     bpm: int
     key: str
     scale: str
-    loudness: float
+    loudness: Optional[float] = None  # integrated, LUFS (EBU R128); None for silence
+    loudness_range: Optional[float] = None  # LU
+    true_peak: Optional[float] = None  # dBTP
     danceability: float
     dynamic_complexity: float
+    preview: bool = False  # approximate; the full analysis is being cached in the background
+    bpm_confidence: Optional[float] = None  # previews only: share of sampled windows that agree
+    key_confidence: Optional[float] = None
+
+class AnalysisBatchRequest(BaseModel):
+    file_ids: List[str]  # from /upload/audio
 
 class MasteringResponse(BaseModel):
     status: str
     mastered_url: str
     message: Optional[str] = None
+    loudness: Optional[float] = None  # of the master: integrated, LUFS
+    loudness_range: Optional[float] = None  # LU
+    true_peak: Optional[float] = None  # dBTP
@@ -1,42 +1,138 @@
-from fastapi import APIRouter, UploadFile, File, HTTPException
-from app.models import AnalysisResponse
-from app.services import file_io, analysis
-from app.config import UPLOAD_DIR
+import json
+import logging
+from fastapi import APIRouter, BackgroundTasks, UploadFile, File, Form, HTTPException, Query
+from fastapi.responses import Response, StreamingResponse
+from app.models import AnalysisResponse, AnalysisBatchRequest
+from app.services import file_io, analysis, analysis_batch, executor, ingest, storage
 import shutil
 import os
 from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(
     prefix="/analysis",
     tags=["analysis"],
     responses={404: {"description": "Not found"}},
+    route_class=ingest.IngestRoute,
 )
 
+async def _refine(file_path: str):
+    """Full analysis after a preview, so the next request gets it from the cache."""
+    try:
+        await analysis.analyze_audio_cached(file_path)
+    except Exception as e:
+        logger.warning(f"Background analysis of {file_path} failed: {e}")
+    finally:
+        await storage.get_manager().arelease(file_path)
+
+
 @router.post("/analyze", response_model=AnalysisResponse)
-async def analyze_audio_endpoint(file: UploadFile = File(...)):
+async def analyze_audio_endpoint(
+    background_tasks: BackgroundTasks,
+    file: Optional[UploadFile] = File(None),
+    file_id: Optional[str] = Form(None, description=file_io.FILE_ID_DESCRIPTION),
+    preview: bool = Query(
+        False,
+        description="Fast approximate result from a few windows of the track at 22.05 kHz, with confidence values. "
+                    "The full analysis then runs in the background and is cached for the next request.",
+    ),
+):
     """
-    Upload an audio file and extract features (BPM, Key, Loudness, etc.) using Essentia.
+    Upload an audio file (or pass the file_id of one stored with /upload/audio) and
+    extract features (BPM, Key, Loudness, etc.) using Essentia.
     """
-    # Ensure upload directory exists
-    UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
-    
-    # Save uploaded file
-    file_path = UPLOAD_DIR / file.filename
-    await file_io.save_upload_file(file, file_path)
+    # The stored upload, or the sent file saved to disk (deleted once analyzed)
+    file_path, filename = await file_io.input_file(file, file_id)
+    manager = storage.get_manager()
+    await manager.apin(file_path)
+    refining = False
     
     try:
-        # Run analysis (synchronous for now as Essentia releases GIL often, but could be threaded)
-        # For heavy load, this should be offloaded to a worker/thread pool.
-        features = analysis.analyze_audio(str(file_path))
-        
+        # Runs on the analysis process pools so the event loop stays free.
+        # Cached by content, so re-analyzing a known track skips the pool entirely
+        if preview:
+            features, is_preview = await analysis.analyze_audio_preview(str(file_path))
+            if is_preview:
+                # Releases the file when it's done
+                background_tasks.add_task(_refine, str(file_path))
+                refining = True
+        else:
+            features = await analysis.analyze_audio_cached(str(file_path))
+            is_preview = False
+
         return AnalysisResponse(
-            filename=file.filename,
+            filename=filename,
             bpm=features.get("bpm"),
             key=features.get("key"),
             scale=features.get("scale"),
             loudness=features.get("loudness"),
+            loudness_range=features.get("loudness_range"),
+            true_peak=features.get("true_peak"),
             danceability=features.get("danceability"),
-            dynamic_complexity=features.get("dynamic_complexity")
+            dynamic_complexity=features.get("dynamic_complexity"),
+            preview=is_preview,
+            bpm_confidence=features.get("bpm_confidence"),
+            key_confidence=features.get("key_confidence"),
         )
+    except executor.JobTimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Analysis failed: {str(e)}")
+    finally:
+        if not refining:
+            await manager.arelease(file_path)
+
+
+@router.post("/timeline")
+async def analyze_timeline_endpoint(
+    file: Optional[UploadFile] = File(None),
+    file_id: Optional[str] = Form(None, description=file_io.FILE_ID_DESCRIPTION),
+):
+    """
+    Upload an audio file and get its time-resolved analysis as an .npz file of
+    float32 arrays (seconds unless noted): beats, downbeats, bar_loudness (dBFS
+    per bar, bars start at the downbeats), bar_key_strength and onsets.
+    Decoded once together with the regular features, which are cached.
+    """
+    file_path, filename = await file_io.input_file(file, file_id)
+
+    try:
+        async with storage.get_manager().ausing(file_path):
+            _, timeline = await analysis.analyze_timeline_cached(str(file_path))
+    except executor.JobTimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Analysis failed: {str(e)}")
+
+    return Response(
+        content=analysis.encode_timeline(timeline),
+        media_type="application/octet-stream",
+        headers={"Content-Disposition": f"attachment; filename={Path(filename).stem}_timeline.npz"},
+    )
+
+
+@router.post("/batch")
+async def analyze_batch_endpoint(request: AnalysisBatchRequest):
+    """
+    Analyze many uploaded files (by file_id) on a process pool.
+    Streams one NDJSON line per track as it finishes: {"file_id", ...features}
+    or {"file_id", "error"}. Results are cached, so re-sending a batch after an
+    interruption only analyzes the tracks that didn't finish.
+    """
+    tracks = []
+    for file_id in request.file_ids:
+        path = await file_io.find_upload(file_id)
+        if path is None:
+            raise HTTPException(status_code=404, detail=f"File not found: {file_id}")
+        tracks.append((file_id, str(path)))
+
+    async def lines():
+        # Not evicted while the batch runs
+        async with storage.get_manager().ausing(*[path for _, path in tracks]):
+            async for result in analysis_batch.analyze_batch(tracks):
+                result["file_id"] = result.pop("id")
+                yield json.dumps(result) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
@@ -2,23 +2,28 @@ from fastapi import APIRouter, UploadFile, File, Form, HTTPException
 from fastapi.responses import StreamingResponse
 from app.schemas import FXCommitJob
 from app.services.commit_processor import process_commit_job
+from app.services import executor, file_io, ingest, storage
+from typing import Optional
 import json
 
 router = APIRouter(
     prefix="/commit",
-    tags=["FX Commit System"]
+    tags=["FX Commit System"],
+    route_class=ingest.IngestRoute,
 )
 
 @router.post("/process")
 async def commit_fx(
-    file: UploadFile = File(...),
-    job_json: str = Form(..., description="JSON string matching FXCommitJob schema")
+    file: Optional[UploadFile] = File(None),
+    job_json: str = Form(..., description="JSON string matching FXCommitJob schema"),
+    file_id: Optional[str] = Form(None, description=file_io.FILE_ID_DESCRIPTION),
 ):
     """
     Applies an effect with precise Time-Based Automation (Curve).
     This supports the 'FX Commit System' spec.
     
-    - **file**: Input audio file (WAV/MP3)
+    - **file**: Input audio file (WAV/MP3), or
+    - **file_id**: A file stored with /upload/audio (not sent again)
     - **job_json**: JSON object defining FX, Static Params, and Automation Curve.
     """
     try:
@@ -26,11 +31,12 @@ async def commit_fx(
         job_data = json.loads(job_json)
         job = FXCommitJob(**job_data)
         
-        # Read file
-        audio_content = await file.read()
+        # A path either way: the stored upload, or the sent file as streamed to disk
+        source, _ = await file_io.input_file(file, file_id)
         
         # Process
-        result_buffer = process_commit_job(audio_content, job)
+        async with storage.get_manager().ausing(source):
+            result_buffer = await executor.run("commit", process_commit_job, str(source), job)
         
         return StreamingResponse(
             result_buffer, 
@@ -42,6 +48,8 @@ async def commit_fx(
         raise HTTPException(status_code=400, detail="Invalid JSON format in job_json")
     except ValueError as ve:
         raise HTTPException(status_code=400, detail=str(ve))
+    except executor.JobTimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -1,9 +1,12 @@
 from fastapi import APIRouter, UploadFile, File, Depends, Form, Query, HTTPException
 from fastapi.responses import StreamingResponse
-from typing import Optional
+from typing import List, Optional
+from pydantic import TypeAdapter, ValidationError
 from app.services.audio_processor import process_audio_chain
+from app.services import executor, file_io, ingest, storage
+from app.config import EFFECT_CHAIN_MAX_EFFECTS
 from app.schemas import (
-    BaseEffect,
+    BaseEffect, EffectItem,
     CompressorEffect, CompressorParams,
     LimiterEffect, LimiterParams,
     GainEffect, GainParams,
@@ -32,276 +35,361 @@ from app.schemas import (
 
 router = APIRouter(
     prefix="/effects",
-    tags=["Individual Effects"]
+    tags=["Individual Effects"],
+    route_class=ingest.IngestRoute,
 )
 
+# Loudness of the rendered audio, as response headers
+LEVEL_HEADERS = {
+    "integrated": "X-Loudness-LUFS",
+    "loudness_range": "X-Loudness-Range-LU",
+    "true_peak": "X-True-Peak-dBTP",
+}
+
+def level_headers(levels: dict) -> dict:
+    return {header: f"{levels[key]:.2f}" for key, header in LEVEL_HEADERS.items() if levels[key] is not None}
+
+# Validates an /effects/chain body: a JSON list of effects, told apart by "type"
+EFFECT_CHAIN = TypeAdapter(List[EffectItem])
+
 # Helper to process single effect
-def process_single_effect(file: UploadFile, effect: BaseEffect, start: Optional[float] = None, end: Optional[float] = None):
-    # Wrap in list
+async def process_single_effect(
+    file: Optional[UploadFile],
+    file_id: Optional[str],
+    effect: BaseEffect,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+):
     effect.start_time = start
     effect.end_time = end
+    return await process_effect_chain(file, file_id, [effect])
+
+async def process_effect_chain(
+    file: Optional[UploadFile],
+    file_id: Optional[str],
+    effects: List[BaseEffect],
+):
+    # A path either way: the stored upload, or the sent file as streamed to disk
+    source, filename = await file_io.input_file(file, file_id)
     
     try:
-        audio_content = file.file.read()
-        result = process_audio_chain(audio_content, [effect])
+        async with storage.get_manager().ausing(source):
+            result, levels = await executor.run("effects", process_audio_chain, str(source), effects)
         return StreamingResponse(
             result, 
             media_type="audio/wav",
-            headers={"Content-Disposition": f"attachment; filename=processed_{file.filename}.wav"}
+            headers={
+                "Content-Disposition": f"attachment; filename=processed_{filename}.wav",
+                **level_headers(levels),
+            }
         )
+    except executor.JobTimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Processing error: {str(e)}")
 
+# --- Chains ---
+
+@router.post("/chain")
+async def apply_chain(
+    file: Optional[UploadFile] = File(None),
+    file_id: Optional[str] = Form(None, description=file_io.FILE_ID_DESCRIPTION),
+    effects_json: str = Form(..., description='JSON list of effects applied in order, e.g. [{"type": "Gain", "params": {"gain_db": 3}}]'),
+):
+    """
+    Applies a whole chain of effects in one decode/render/encode cycle.
+    Each effect takes the same params as its single-effect endpoint, and
+    optionally its own `start_time` / `end_time` (seconds).
+    """
+    try:
+        effects = EFFECT_CHAIN.validate_json(effects_json)
+    except ValidationError as e:
+        # Bad JSON as well as bad effects, e.g. "0.Gain.params.gain_db: Input should be a valid number"
+        errors = "; ".join(
+            ": ".join(filter(None, [".".join(str(part) for part in err["loc"]), err["msg"]]))
+            for err in e.errors()
+        )
+        raise HTTPException(status_code=400, detail=f"Invalid effects_json: {errors}")
+    if not effects:
+        raise HTTPException(status_code=400, detail="effects_json must list at least one effect")
+    if len(effects) > EFFECT_CHAIN_MAX_EFFECTS:
+        raise HTTPException(status_code=400, detail=f"At most {EFFECT_CHAIN_MAX_EFFECTS} effects per chain.")
+    return await process_effect_chain(file, file_id, effects)
+
 # --- Dynamic Processing ---
 
 @router.post("/compressor")
-def apply_compressor(
-    file: UploadFile = File(...),
+async def apply_compressor(
+    file: Optional[UploadFile] = File(None),
+    file_id: Optional[str] = Form(None, description=file_io.FILE_ID_DESCRIPTION),
     params: CompressorParams = Depends(),
     start_time: Optional[float] = Query(None),
     end_time: Optional[float] = Query(None)
 ):
     effect = CompressorEffect(type="Compressor", params=params)
-    return process_single_effect(file, effect, start_time, end_time)
+    return await process_single_effect(file, file_id, effect, start_time, end_time)
 
 @router.post("/limiter")
-def apply_limiter(
-    file: UploadFile = File(...),
+async def apply_limiter(
+    file: Optional[UploadFile] = File(None),
+    file_id: Optional[str] = Form(None, description=file_io.FILE_ID_DESCRIPTION),
     params: LimiterParams = Depends(),
     start_time: Optional[float] = Query(None),
     end_time: Optional[float] = Query(None)
 ):
     effect = LimiterEffect(type="Limiter", params=params)
-    return process_single_effect(file, effect, start_time, end_time)
+    return await process_single_effect(file, file_id, effect, start_time, end_time)
 
 @router.post("/gain")
-def apply_gain(
-    file: UploadFile = File(...),
+async def apply_gain(
+    file: Optional[UploadFile] = File(None),
+    file_id: Optional[str] = Form(None, description=file_io.FILE_ID_DESCRIPTION),
     params: GainParams = Depends(),
     start_time: Optional[float] = Query(None),
     end_time: Optional[float] = Query(None)
 ):
     effect = GainEffect(type="Gain", params=params)
-    return process_single_effect(file, effect, start_time, end_time)
+    return await process_single_effect(file, file_id, effect, start_time, end_time)
 
 @router.post("/noisegate")
-def apply_noisegate(
-    file: UploadFile = File(...),
+async def apply_noisegate(
+    file: Optional[UploadFile] = File(None),
+    file_id: Optional[str] = Form(None, description=file_io.FILE_ID_DESCRIPTION),
     params: NoiseGateParams = Depends(),
     start_time: Optional[float] = Query(None),
     end_time: Optional[float] = Query(None)
 ):
     effect = NoiseGateEffect(type="NoiseGate", params=params)
-    return process_single_effect(file, effect, start_time, end_time)
+    return await process_single_effect(file, file_id, effect, start_time, end_time)
 
 # --- Time and Space ---
 
 @router.post("/reverb")
-def apply_reverb(
-    file: UploadFile = File(...),
+async def apply_reverb(
+    file: Optional[UploadFile] = File(None),
+    file_id: Optional[str] = Form(None, description=file_io.FILE_ID_DESCRIPTION),
     params: ReverbParams = Depends(),
     start_time: Optional[float] = Query(None),
     end_time: Optional[float] = Query(None)
 ):
     effect = ReverbEffect(type="Reverb", params=params)
-    return process_single_effect(file, effect, start_time, end_time)
+    return await process_single_effect(file, file_id, effect, start_time, end_time)
 
 @router.post("/delay")
-def apply_delay(
-    file: UploadFile = File(...),
+async def apply_delay(
+    file: Optional[UploadFile] = File(None),
+    file_id: Optional[str] = Form(None, description=file_io.FILE_ID_DESCRIPTION),
     params: DelayParams = Depends(),
     start_time: Optional[float] = Query(None),
     end_time: Optional[float] = Query(None)
 ):
     effect = DelayEffect(type="Delay", params=params)
-    return process_single_effect(file, effect, start_time, end_time)
+    return await process_single_effect(file, file_id, effect, start_time, end_time)
 
 @router.post("/convolution")
-def apply_convolution(
-    file: UploadFile = File(...),
+async def apply_convolution(
+    file: Optional[UploadFile] = File(None),
+    file_id: Optional[str] = Form(None, description=file_io.FILE_ID_DESCRIPTION),
     params: ConvolutionParams = Depends(),
     start_time: Optional[float] = Query(None),
     end_time: Optional[float] = Query(None)
 ):
     effect = ConvolutionEffect(type="Convolution", params=params)
-    return process_single_effect(file, effect, start_time, end_time)
+    return await process_single_effect(file, file_id, effect, start_time, end_time)
 
 # --- Filters ---
 
 @router.post("/lowpass")
-def apply_lowpass(
-    file: UploadFile = File(...),
+async def apply_lowpass(
+    file: Optional[UploadFile] = File(None),
+    file_id: Optional[str] = Form(None, description=file_io.FILE_ID_DESCRIPTION),
     params: LowpassFilterParams = Depends(),
     start_time: Optional[float] = Query(None),
     end_time: Optional[float] = Query(None)
 ):
     effect = LowpassFilterEffect(type="LowpassFilter", params=params)
-    return process_single_effect(file, effect, start_time, end_time)
+    return await process_single_effect(file, file_id, effect, start_time, end_time)
 
 @router.post("/highpass")
-def apply_highpass(
-    file: UploadFile = File(...),
+async def apply_highpass(
+    file: Optional[UploadFile] = File(None),
+    file_id: Optional[str] = Form(None, description=file_io.FILE_ID_DESCRIPTION),
     params: HighpassFilterParams = Depends(),
     start_time: Optional[float] = Query(None),
     end_time: Optional[float] = Query(None)
 ):
     effect = HighpassFilterEffect(type="HighpassFilter", params=params)
-    return process_single_effect(file, effect, start_time, end_time)
+    return await process_single_effect(file, file_id, effect, start_time, end_time)
 
 @router.post("/bandpass")
-def apply_bandpass(
-    file: UploadFile = File(...),
+async def apply_bandpass(
+    file: Optional[UploadFile] = File(None),
+    file_id: Optional[str] = Form(None, description=file_io.FILE_ID_DESCRIPTION),
     params: BandpassFilterParams = Depends(),
     start_time: Optional[float] = Query(None),
     end_time: Optional[float] = Query(None)
 ):
     effect = BandpassFilterEffect(type="BandpassFilter", params=params)
-    return process_single_effect(file, effect, start_time, end_time)
+    return await process_single_effect(file, file_id, effect, start_time, end_time)
 
 @router.post("/peak")
-def apply_peak(
-    file: UploadFile = File(...),
+async def apply_peak(
+    file: Optional[UploadFile] = File(None),
+    file_id: Optional[str] = Form(None, description=file_io.FILE_ID_DESCRIPTION),
     params: PeakFilterParams = Depends(),
     start_time: Optional[float] = Query(None),
     end_time: Optional[float] = Query(None)
 ):
     effect = PeakFilterEffect(type="PeakFilter", params=params)
-    return process_single_effect(file, effect, start_time, end_time)
+    return await process_single_effect(file, file_id, effect, start_time, end_time)
 
 @router.post("/notch")
-def apply_notch(
-    file: UploadFile = File(...),
+async def apply_notch(
+    file: Optional[UploadFile] = File(None),
+    file_id: Optional[str] = Form(None, description=file_io.FILE_ID_DESCRIPTION),
     params: NotchFilterParams = Depends(),
     start_time: Optional[float] = Query(None),
     end_time: Optional[float] = Query(None)
 ):
     effect = NotchFilterEffect(type="NotchFilter", params=params)
-    return process_single_effect(file, effect, start_time, end_time)
+    return await process_single_effect(file, file_id, effect, start_time, end_time)
 
 @router.post("/lowshelf")
-def apply_lowshelf(
-    file: UploadFile = File(...),
+async def apply_lowshelf(
+    file: Optional[UploadFile] = File(None),
+    file_id: Optional[str] = Form(None, description=file_io.FILE_ID_DESCRIPTION),
     params: LowShelfFilterParams = Depends(),
     start_time: Optional[float] = Query(None),
     end_time: Optional[float] = Query(None)
 ):
     effect = LowShelfFilterEffect(type="LowShelfFilter", params=params)
-    return process_single_effect(file, effect, start_time, end_time)
+    return await process_single_effect(file, file_id, effect, start_time, end_time)
 
 @router.post("/highshelf")
-def apply_highshelf(
-    file: UploadFile = File(...),
+async def apply_highshelf(
+    file: Optional[UploadFile] = File(None),
+    file_id: Optional[str] = Form(None, description=file_io.FILE_ID_DESCRIPTION),
     params: HighShelfFilterParams = Depends(),
     start_time: Optional[float] = Query(None),
     end_time: Optional[float] = Query(None)
 ):
     effect = HighShelfFilterEffect(type="HighShelfFilter", params=params)
-    return process_single_effect(file, effect, start_time, end_time)
+    return await process_single_effect(file, file_id, effect, start_time, end_time)
 
 @router.post("/ladder")
-def apply_ladder(
-    file: UploadFile = File(...),
+async def apply_ladder(
+    file: Optional[UploadFile] = File(None),
+    file_id: Optional[str] = Form(None, description=file_io.FILE_ID_DESCRIPTION),
     params: LadderFilterParams = Depends(),
     start_time: Optional[float] = Query(None),
     end_time: Optional[float] = Query(None)
 ):
     effect = LadderFilterEffect(type="LadderFilter", params=params)
-    return process_single_effect(file, effect, start_time, end_time)
+    return await process_single_effect(file, file_id, effect, start_time, end_time)
 
 # --- Modulation ---
 
 @router.post("/chorus")
-def apply_chorus(
-    file: UploadFile = File(...),
+async def apply_chorus(
+    file: Optional[UploadFile] = File(None),
+    file_id: Optional[str] = Form(None, description=file_io.FILE_ID_DESCRIPTION),
     params: ChorusParams = Depends(),
     start_time: Optional[float] = Query(None),
     end_time: Optional[float] = Query(None)
 ):
     effect = ChorusEffect(type="Chorus", params=params)
-    return process_single_effect(file, effect, start_time, end_time)
+    return await process_single_effect(file, file_id, effect, start_time, end_time)
 
 @router.post("/phaser")
-def apply_phaser(
-    file: UploadFile = File(...),
+async def apply_phaser(
+    file: Optional[UploadFile] = File(None),
+    file_id: Optional[str] = Form(None, description=file_io.FILE_ID_DESCRIPTION),
     params: PhaserParams = Depends(),
     start_time: Optional[float] = Query(None),
     end_time: Optional[float] = Query(None)
 ):
     effect = PhaserEffect(type="Phaser", params=params)
-    return process_single_effect(file, effect, start_time, end_time)
+    return await process_single_effect(file, file_id, effect, start_time, end_time)
 
 # --- Distortion ---
 
 @router.post("/distortion")
-def apply_distortion(
-    file: UploadFile = File(...),
+async def apply_distortion(
+    file: Optional[UploadFile] = File(None),
+    file_id: Optional[str] = Form(None, description=file_io.FILE_ID_DESCRIPTION),
     params: DistortionParams = Depends(),
     start_time: Optional[float] = Query(None),
     end_time: Optional[float] = Query(None)
 ):
     effect = DistortionEffect(type="Distortion", params=params)
-    return process_single_effect(file, effect, start_time, end_time)
+    return await process_single_effect(file, file_id, effect, start_time, end_time)
 
 @router.post("/clipping")
-def apply_clipping(
-    file: UploadFile = File(...),
+async def apply_clipping(
+    file: Optional[UploadFile] = File(None),
+    file_id: Optional[str] = Form(None, description=file_io.FILE_ID_DESCRIPTION),
     params: ClippingParams = Depends(),
     start_time: Optional[float] = Query(None),
     end_time: Optional[float] = Query(None)
 ):
     effect = ClippingEffect(type="Clipping", params=params)
-    return process_single_effect(file, effect, start_time, end_time)
+    return await process_single_effect(file, file_id, effect, start_time, end_time)
 
 @router.post("/bitcrush")
-def apply_bitcrush(
-    file: UploadFile = File(...),
+async def apply_bitcrush(
+    file: Optional[UploadFile] = File(None),
+    file_id: Optional[str] = Form(None, description=file_io.FILE_ID_DESCRIPTION),
     params: BitcrushParams = Depends(),
     start_time: Optional[float] = Query(None),
     end_time: Optional[float] = Query(None)
 ):
     effect = BitcrushEffect(type="Bitcrush", params=params)
-    return process_single_effect(file, effect, start_time, end_time)
+    return await process_single_effect(file, file_id, effect, start_time, end_time)
 
 # --- Pitch and Utility ---
 
 @router.post("/pitchshift")
-def apply_pitchshift(
-    file: UploadFile = File(...),
+async def apply_pitchshift(
+    file: Optional[UploadFile] = File(None),
+    file_id: Optional[str] = Form(None, description=file_io.FILE_ID_DESCRIPTION),
     params: PitchShiftParams = Depends(),
     start_time: Optional[float] = Query(None),
     end_time: Optional[float] = Query(None)
 ):
     effect = PitchShiftEffect(type="PitchShift", params=params)
-    return process_single_effect(file, effect, start_time, end_time)
+    return await process_single_effect(file, file_id, effect, start_time, end_time)
 
 @router.post("/pan")
-def apply_pan(
-    file: UploadFile = File(...),
+async def apply_pan(
+    file: Optional[UploadFile] = File(None),
+    file_id: Optional[str] = Form(None, description=file_io.FILE_ID_DESCRIPTION),
     params: PanParams = Depends(),
     start_time: Optional[float] = Query(None),
     end_time: Optional[float] = Query(None)
 ):
     effect = PanEffect(type="Pan", params=params)
-    return process_single_effect(file, effect, start_time, end_time)
+    return await process_single_effect(file, file_id, effect, start_time, end_time)
 
 @router.post("/invert")
-def apply_invert(
-    file: UploadFile = File(...),
+async def apply_invert(
+    file: Optional[UploadFile] = File(None),
+    file_id: Optional[str] = Form(None, description=file_io.FILE_ID_DESCRIPTION),
     start_time: Optional[float] = Query(None),
     end_time: Optional[float] = Query(None)
 ):
     # No params
     effect = InvertEffect(type="Invert", params=InvertParams())
-    return process_single_effect(file, effect, start_time, end_time)
+    return await process_single_effect(file, file_id, effect, start_time, end_time)
 
 @router.post("/resample")
-def apply_resample(
-    file: UploadFile = File(...),
+async def apply_resample(
+    file: Optional[UploadFile] = File(None),
+    file_id: Optional[str] = Form(None, description=file_io.FILE_ID_DESCRIPTION),
     params: ResampleParams = Depends(),
     start_time: Optional[float] = Query(None),
     end_time: Optional[float] = Query(None)
 ):
     effect = ResampleEffect(type="Resample", params=params)
-    return process_single_effect(file, effect, start_time, end_time)
+    return await process_single_effect(file, file_id, effect, start_time, end_time)
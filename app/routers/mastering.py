@@ -1,7 +1,7 @@
 from fastapi import APIRouter, UploadFile, File, Form, HTTPException
 from app.models import MasteringResponse
-from app.services import file_io, mastering
-from app.config import UPLOAD_DIR, OUTPUT_DIR
+from app.services import file_io, ingest, mastering, executor, loudness, storage
+from app.config import OUTPUT_DIR
 from typing import Optional, Union
 from pathlib import Path
 
@@ -9,49 +9,56 @@ router = APIRouter(
     prefix="/mastering",
     tags=["mastering"],
     responses={404: {"description": "Not found"}},
+    route_class=ingest.IngestRoute,
 )
 
 @router.post("/process", response_model=MasteringResponse)
 async def process_mastering(
-    target: UploadFile = File(...),
+    target: Union[UploadFile, str, None] = File(None),
     reference: Union[UploadFile, str, None] = File(None),
-    preset: Optional[str] = Form(None)
+    preset: Optional[str] = Form(None),
+    target_id: Optional[str] = Form(None, description="file_id of the target from /upload/audio, instead of sending it"),
+    reference_id: Optional[str] = Form(None, description="file_id of the reference from /upload/audio"),
 ):
     """
     Masters audio using Matchering 2.0.
     
-    - **target**: The track to be mastered.
-    - **reference**: (Optional) A reference track to match.
+    - **target** / **target_id**: The track to be mastered, sent or stored with /upload/audio.
+    - **reference** / **reference_id**: (Optional) A reference track to match.
     - **preset**: (Optional) If no reference is uploaded, use a preset (e.g., "neutral").
     """
-    # Ensure upload directory exists
-    UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
-    
-    # Save target file
-    target_path = UPLOAD_DIR / f"target_{target.filename}"
-    await file_io.save_upload_file(target, target_path)
+    # Stored uploads are used in place; sent files are saved and deleted afterwards
+    target_path, _ = await file_io.input_file(target, target_id, "target_")
+    inputs = [target_path]
     
     reference_path_str = None
     
     # Handle reference file
-    # Check if reference is actually an UploadFile (and not an empty string or None)
-    if isinstance(reference, UploadFile):
-        # Save reference file
-        ref_path = UPLOAD_DIR / f"ref_{reference.filename}"
-        await file_io.save_upload_file(reference, ref_path)
+    # Check if reference is actually a file (and not an empty string from the form) or a file_id.
+    # Not isinstance(reference, UploadFile): FastAPI passes Starlette's UploadFile, not its subclass
+    if (reference is not None and not isinstance(reference, str) and reference.filename) or reference_id:
+        try:
+            ref_path, _ = await file_io.input_file(reference, reference_id, "ref_")
+        except HTTPException:
+            await storage.get_manager().arelease(target_path)
+            raise
+        inputs.append(ref_path)
         reference_path_str = str(ref_path)
-    elif isinstance(reference, str):
-        # If it's a string (e.g. empty string from form), ignore it
-        pass
     
     try:
         # Run mastering
-        output_path = mastering.process_audio(
-            str(target_path),
-            reference_path=reference_path_str,
-            preset=preset
-        )
+        async with storage.get_manager().ausing(*inputs):
+            output_path = await executor.run(
+                "mastering",
+                mastering.process_audio,
+                str(target_path),
+                reference_path=reference_path_str,
+                preset=preset
+            )
+        await storage.get_manager().atrack(output_path, storage.OUTPUT)
         
+        levels = await executor.run("mastering", loudness.measure_file, output_path)
+
         # Construct URL
         rel_path = Path(output_path).relative_to(OUTPUT_DIR)
         url = f"/outputs/{rel_path}"
@@ -59,8 +66,13 @@ async def process_mastering(
         return MasteringResponse(
             status="success",
             mastered_url=url,
-            message="Mastering completed successfully"
+            message="Mastering completed successfully",
+            loudness=levels["integrated"],
+            loudness_range=levels["loudness_range"],
+            true_peak=levels["true_peak"],
         )
         
+    except executor.JobTimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Mastering failed: {str(e)}")
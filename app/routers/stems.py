@@ -1,32 +1,82 @@
 import time
 import shutil
+from typing import List, Optional
 from fastapi import APIRouter, UploadFile, File, Form, HTTPException
-from app.models import StemResponse
-from app.config import UPLOAD_DIR
-from app.services import file_io, demucs
+from fastapi.responses import StreamingResponse
+from app.models import StemResponse, StemJobResponse, StemBatchResponse
+from app.config import STEM_BATCH_MAX_TRACKS
+from app.services import audio_encoding, file_io, demucs, ingest, storage
+from app.services.jobs import stem_jobs, BatchJob, QueueFullError
+
+router = APIRouter(prefix="/stems", tags=["stems"], route_class=ingest.IngestRoute)
+
+# *_int8: same weights with int8-quantized transformer/LSTM layers, faster on CPU (see README)
+VALID_MODELS = ["ht_demucs", "ht_demucs_ft", "ht_demucs_int8", "ht_demucs_ft_int8"]
+MODEL_DESCRIPTION = "Model to use: " + ", ".join(VALID_MODELS)
+
+STEMS_DESCRIPTION = "Comma-separated stems to compute, e.g. 'vocals,drums' (default: all of vocals, drums, bass, other)"
+TWO_STEMS_DESCRIPTION = "Return only <stem> and no_<stem> (the rest of the mix), e.g. 'vocals'"
+OUTPUT_FORMAT_DESCRIPTION = "Stem file format: wav (16-bit), flac, mp3 or opus (mp3/opus depend on the installed encoders)"
+
+
+def parse_stem_selection(stems: Optional[str], two_stems: Optional[str]) -> dict:
+    """Validates the stem selection form fields into run_model() keyword arguments."""
+    if stems and two_stems:
+        raise HTTPException(status_code=400, detail="Use either 'stems' or 'two_stems', not both.")
+    if two_stems:
+        if two_stems not in demucs.SOURCES:
+            raise HTTPException(status_code=400, detail=f"Invalid stem '{two_stems}'. Choose from {demucs.SOURCES}.")
+        return {"two_stems": two_stems}
+
+    selected: Optional[List[str]] = None
+    if stems:
+        selected = []
+        for name in stems.split(","):
+            name = name.strip()
+            if not name:
+                continue
+            if name not in demucs.SOURCES:
+                raise HTTPException(status_code=400, detail=f"Invalid stem '{name}'. Choose from {demucs.SOURCES}.")
+            if name not in selected:
+                selected.append(name)
+    return {"stems": selected or None}
+
+
+def validate_output_format(output_format: str) -> str:
+    output_format = output_format.lower()
+    available = audio_encoding.available_formats()
+    if output_format not in available:
+        raise HTTPException(status_code=400, detail=f"Invalid output format '{output_format}'. Choose from {available}.")
+    return output_format
 
-router = APIRouter(prefix="/stems", tags=["stems"])
 
 @router.post("/extract", response_model=StemResponse)
 async def extract_stems(
-    audio_file: UploadFile = File(...),
-    separation_model: str = Form("ht_demucs", description="Model to use: ht_demucs, ht_demucs_ft"),
+    audio_file: Optional[UploadFile] = File(None),
+    file_id: Optional[str] = Form(None, description=file_io.FILE_ID_DESCRIPTION),
+    separation_model: str = Form("ht_demucs", description=MODEL_DESCRIPTION),
+    stems: Optional[str] = Form(None, description=STEMS_DESCRIPTION),
+    two_stems: Optional[str] = Form(None, description=TWO_STEMS_DESCRIPTION),
+    output_format: str = Form("wav", description=OUTPUT_FORMAT_DESCRIPTION),
 ):
     start_time = time.time()
     
     # Validate model name
-    valid_models = ["ht_demucs", "ht_demucs_ft"]
-    if separation_model not in valid_models:
-        raise HTTPException(status_code=400, detail=f"Invalid model name. Only {valid_models} is supported.")
+    if separation_model not in VALID_MODELS:
+        raise HTTPException(status_code=400, detail=f"Invalid model name. Only {VALID_MODELS} is supported.")
+    selection = parse_stem_selection(stems, two_stems)
+    output_format = validate_output_format(output_format)
 
-    # Save uploaded file
-    file_path = UPLOAD_DIR / audio_file.filename
-    await file_io.save_upload_file(audio_file, file_path)
+    # The stored upload, or the sent file saved to disk (deleted when it's done)
+    file_path, _ = await file_io.input_file(audio_file, file_id)
     
     try:
         # Dispatch to appropriate service
-        if separation_model in ["ht_demucs", "ht_demucs_ft"]:
-            stems = await demucs.run_model(str(file_path), separation_model)
+        if separation_model in VALID_MODELS:
+            async with storage.get_manager().ausing(file_path):
+                stem_urls = await demucs.run_model(
+                    str(file_path), separation_model, output_format=output_format, **selection
+                )
         else:
             raise HTTPException(status_code=400, detail="Model not implemented")
             
@@ -35,14 +85,187 @@ async def extract_stems(
         return StemResponse(
             status="ok",
             model=separation_model,
-            stems=stems,
-            processing_time=processing_time
+            stems=stem_urls,
+            processing_time=processing_time,
+            archive_url=demucs.archive_url(stem_urls),
         )
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        # Optional: Clean up uploaded file
-        # if file_path.exists():
-        #     file_path.unlink()
-        pass
+
+
+# --- Asynchronous jobs ---
+
+@router.post("/jobs", response_model=StemJobResponse, status_code=202)
+async def submit_stem_job(
+    audio_file: Optional[UploadFile] = File(None),
+    file_id: Optional[str] = Form(None, description=file_io.FILE_ID_DESCRIPTION),
+    separation_model: str = Form("ht_demucs", description=MODEL_DESCRIPTION),
+    priority: int = Form(0, description="Higher priority jobs run first; equal priorities run in submission order"),
+    stems: Optional[str] = Form(None, description=STEMS_DESCRIPTION),
+    two_stems: Optional[str] = Form(None, description=TWO_STEMS_DESCRIPTION),
+    output_format: str = Form("wav", description=OUTPUT_FORMAT_DESCRIPTION),
+):
+    """
+    Queue a separation job and return immediately with its job_id.
+    Poll GET /stems/jobs/{job_id} or subscribe to GET /stems/jobs/{job_id}/events for progress.
+    """
+    if separation_model not in VALID_MODELS:
+        raise HTTPException(status_code=400, detail=f"Invalid model name. Only {VALID_MODELS} is supported.")
+    selection = parse_stem_selection(stems, two_stems)
+    output_format = validate_output_format(output_format)
+
+    # Pinned by the job; a sent file is deleted when the job ends
+    file_path, _ = await file_io.input_file(audio_file, file_id)
+
+    try:
+        job = await stem_jobs.submit(
+            str(file_path), separation_model, priority, output_format=output_format, **selection
+        )
+    except QueueFullError as e:
+        await storage.get_manager().arelease(file_path)
+        raise HTTPException(status_code=503, detail=str(e))
+
+    return job.to_response()
+
+
+def _get_job(job_id: str, batch: bool = False):
+    job = stem_jobs.get(job_id)
+    if job is None or isinstance(job, BatchJob) != batch:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+def _sse_response(job) -> StreamingResponse:
+    async def events():
+        async for state in stem_jobs.subscribe(job):
+            yield f"event: {state.status}\ndata: {state.model_dump_json()}\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get("/jobs/{job_id}", response_model=StemJobResponse)
+async def get_stem_job(job_id: str):
+    return _get_job(job_id).to_response()
+
+
+@router.get("/jobs/{job_id}/events")
+async def stream_stem_job(job_id: str):
+    """
+    Server-Sent Events stream of job state.
+    One event is sent immediately and one after every processed segment;
+    the stream ends when the job is done, failed or cancelled.
+    """
+    return _sse_response(_get_job(job_id))
+
+
+@router.delete("/jobs/{job_id}", response_model=StemJobResponse)
+async def cancel_stem_job(job_id: str):
+    """
+    Cancel a job. Queued jobs are dropped; running jobs stop at the next segment.
+    """
+    job = _get_job(job_id)
+    await stem_jobs.cancel(job)
+    return job.to_response()
+
+
+# --- Batches ---
+
+@router.post("/batch", response_model=StemBatchResponse, status_code=202)
+async def submit_stem_batch(
+    audio_files: List[UploadFile] = File(None, description="Tracks to separate"),
+    file_ids: Optional[str] = Form(None, description="Comma-separated file_ids from /upload/audio"),
+    separation_model: str = Form("ht_demucs", description=MODEL_DESCRIPTION),
+    priority: int = Form(0, description="Higher priority jobs run first; equal priorities run in submission order"),
+    stems: Optional[str] = Form(None, description=STEMS_DESCRIPTION),
+    two_stems: Optional[str] = Form(None, description=TWO_STEMS_DESCRIPTION),
+    output_format: str = Form("wav", description=OUTPUT_FORMAT_DESCRIPTION),
+):
+    """
+    Queue many tracks (uploaded files and/or earlier uploads by file_id) as one job.
+    Tracks share the loaded models and are separated several at a time;
+    subscribe to GET /stems/batch/{job_id}/events to get each track's stems as it finishes.
+    """
+    if separation_model not in VALID_MODELS:
+        raise HTTPException(status_code=400, detail=f"Invalid model name. Only {VALID_MODELS} is supported.")
+    selection = parse_stem_selection(stems, two_stems)
+    output_format = validate_output_format(output_format)
+
+    tracks = []
+    for file_id in (file_ids or "").split(","):
+        file_id = file_id.strip()
+        if not file_id:
+            continue
+        path = await file_io.find_upload(file_id)
+        if path is None:
+            raise HTTPException(status_code=404, detail=f"File not found: {file_id}")
+        tracks.append((file_id, str(path)))
+
+    audio_files = audio_files or []
+    if not tracks and not audio_files:
+        raise HTTPException(status_code=400, detail="Send audio_files and/or file_ids.")
+    if len(tracks) + len(audio_files) > STEM_BATCH_MAX_TRACKS:
+        raise HTTPException(status_code=400, detail=f"At most {STEM_BATCH_MAX_TRACKS} tracks per batch.")
+
+    saved = []
+    for audio_file in audio_files:
+        file_path, name = await file_io.input_file(audio_file, None)
+        saved.append(file_path)
+        tracks.append((name or file_path.name, str(file_path)))
+
+    try:
+        job = await stem_jobs.submit_batch(
+            tracks, separation_model, priority, output_format=output_format, **selection
+        )
+    except QueueFullError as e:
+        await storage.get_manager().arelease(*saved)
+        raise HTTPException(status_code=503, detail=str(e))
+
+    return job.to_response()
+
+
+@router.get("/batch/{job_id}", response_model=StemBatchResponse)
+async def get_stem_batch(job_id: str):
+    return _get_job(job_id, batch=True).to_response()
+
+
+@router.get("/batch/{job_id}/events")
+async def stream_stem_batch(job_id: str):
+    """
+    Server-Sent Events stream of batch state, sent whenever a track starts,
+    makes progress or finishes (with its stem URLs). Ends when the batch does.
+    """
+    return _sse_response(_get_job(job_id, batch=True))
+
+
+@router.delete("/batch/{job_id}", response_model=StemBatchResponse)
+async def cancel_stem_batch(job_id: str):
+    """
+    Cancel a batch. Finished tracks keep their stems; the rest are stopped.
+    """
+    job = _get_job(job_id, batch=True)
+    await stem_jobs.cancel(job)
+    return job.to_response()
+
+
+# --- Downloads ---
+
+@router.get("/archive/{model}/{key}")
+async def download_stem_archive(model: str, key: str):
+    """
+    All stems of a separation as a single zip, streamed as it is built.
+    The URL is returned as `archive_url` by /extract and finished jobs.
+    """
+    files = demucs.archive_files(model, key)
+    if files is None:
+        raise HTTPException(status_code=404, detail="Stems not found (they may have been evicted from the cache)")
+
+    return StreamingResponse(
+        file_io.iter_zip([(path.name, path) for path in files]),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="stems_{model}_{key[:8]}.zip"'},
+    )
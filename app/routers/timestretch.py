@@ -1,13 +1,12 @@
 
 from fastapi import APIRouter, UploadFile, File, Form, HTTPException, BackgroundTasks
 from fastapi.responses import StreamingResponse
-from fastapi.concurrency import run_in_threadpool
 import os
-import shutil
-import tempfile
 from app.services.time_stretch import stretch_r2, stretch_r3
+from app.services import executor, file_io, ingest, storage
+from typing import Optional
 
-router = APIRouter(tags=["Time Stretch"])
+router = APIRouter(tags=["Time Stretch"], route_class=ingest.IngestRoute)
 
 
 def cleanup_file(path: str):
@@ -21,9 +20,10 @@ def cleanup_file(path: str):
 @router.post("/timestretch/process", summary="BPM Switch — R2 Fast")
 async def timestretch_fast(
     background_tasks: BackgroundTasks,
-    file: UploadFile = File(...),
+    file: Optional[UploadFile] = File(None),
     tempo_ratio: float = Form(..., description="Tempo ratio (1.2 = 20% faster)"),
     pitch_ratio: float = Form(1.0, description="Reserved, unused"),
+    file_id: Optional[str] = Form(None, description=file_io.FILE_ID_DESCRIPTION),
 ):
     """
     Fast time-stretch using R2 engine (multi-threaded).
@@ -32,33 +32,32 @@ async def timestretch_fast(
     if tempo_ratio <= 0:
         raise HTTPException(status_code=400, detail="tempo_ratio must be positive")
 
-    suffix = os.path.splitext(file.filename)[1] or ".wav"
-    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-        shutil.copyfileobj(file.file, tmp)
-        input_path = tmp.name
+    input_path, filename = await file_io.input_file(file, file_id)
 
     try:
-        output_path = await run_in_threadpool(stretch_r2, input_path, tempo_ratio)
+        async with storage.get_manager().ausing(input_path):
+            output_path = await executor.run("timestretch", stretch_r2, str(input_path), tempo_ratio)
 
-        background_tasks.add_task(cleanup_file, input_path)
         background_tasks.add_task(cleanup_file, output_path)
 
         return StreamingResponse(
             open(output_path, "rb"),
             media_type="audio/wav",
-            headers={"Content-Disposition": f"attachment; filename=stretched_{file.filename}"}
+            headers={"Content-Disposition": f"attachment; filename=stretched_{filename}"}
         )
+    except executor.JobTimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
-        cleanup_file(input_path)
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @router.post("/timestretch/process-hq", summary="BPM Switch — R3 Fine (HQ)")
 async def timestretch_hq(
     background_tasks: BackgroundTasks,
-    file: UploadFile = File(...),
+    file: Optional[UploadFile] = File(None),
     tempo_ratio: float = Form(..., description="Tempo ratio (1.2 = 20% faster)"),
     pitch_ratio: float = Form(1.0, description="Reserved, unused"),
+    file_id: Optional[str] = Form(None, description=file_io.FILE_ID_DESCRIPTION),
 ):
     """
     High-quality time-stretch using R3 (finer) engine.
@@ -67,22 +66,20 @@ async def timestretch_hq(
     if tempo_ratio <= 0:
         raise HTTPException(status_code=400, detail="tempo_ratio must be positive")
 
-    suffix = os.path.splitext(file.filename)[1] or ".wav"
-    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-        shutil.copyfileobj(file.file, tmp)
-        input_path = tmp.name
+    input_path, filename = await file_io.input_file(file, file_id)
 
     try:
-        output_path = await run_in_threadpool(stretch_r3, input_path, tempo_ratio)
+        async with storage.get_manager().ausing(input_path):
+            output_path = await executor.run("timestretch", stretch_r3, str(input_path), tempo_ratio)
 
-        background_tasks.add_task(cleanup_file, input_path)
         background_tasks.add_task(cleanup_file, output_path)
 
         return StreamingResponse(
             open(output_path, "rb"),
             media_type="audio/wav",
-            headers={"Content-Disposition": f"attachment; filename=stretched_{file.filename}"}
+            headers={"Content-Disposition": f"attachment; filename=stretched_{filename}"}
         )
+    except executor.JobTimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
-        cleanup_file(input_path)
         raise HTTPException(status_code=500, detail=str(e))
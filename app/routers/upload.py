@@ -2,24 +2,81 @@
 Upload Router - Handles large file uploads
 Files are saved to disk and referenced by ID for subsequent processing.
 This prevents browser crashes from loading large files into memory.
+Uploads are looked up through their index (see app/services/upload_store.py).
 """
+import asyncio
+import logging
 import os
 import uuid
-import shutil
-from fastapi import APIRouter, UploadFile, File, HTTPException
-from fastapi.responses import FileResponse, StreamingResponse
+import hashlib
+from pathlib import Path
+from typing import Any, Dict, Optional
+from fastapi import APIRouter, UploadFile, File, Form, Header, HTTPException, Query, Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from email.utils import parsedate_to_datetime
+import mimetypes
 import soundfile as sf
 import numpy as np
 import io
+from app.services import audio_encoding, executor, file_io, ingest, pcm_cache, preview, storage, upload_store, waveform
+from app.services.stem_cache import hash_file
+from app.config import UPLOAD_CHUNK_BYTES, UPLOAD_MAX_BYTES, UPLOAD_MAX_CHUNK_BYTES, UPLOAD_SESSION_TTL_SECONDS
 
-router = APIRouter(prefix="/upload", tags=["upload"])
+logger = logging.getLogger(__name__)
 
-# Base directory for uploaded files
-UPLOAD_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "uploads")
-os.makedirs(UPLOAD_DIR, exist_ok=True)
+router = APIRouter(prefix="/upload", tags=["upload"], route_class=ingest.IngestRoute)
 
-# Preview duration in seconds
-PREVIEW_DURATION = 30
+# Browsers may cache uploads and previews this long; a file_id's content never changes
+CACHE_CONTROL = "private, max-age=86400"
+
+
+async def _get_upload(file_id: str) -> upload_store.Upload:
+    upload = upload_store.get_store().get(file_id)
+    if upload is None or not upload.path.exists():
+        raise HTTPException(status_code=404, detail="File not found")
+    await storage.get_manager().atouch(upload.path)
+    return upload
+
+
+def _media_type(path: str) -> str:
+    media_type = audio_encoding.media_type(path)
+    if media_type == "application/octet-stream":
+        media_type = mimetypes.guess_type(path)[0] or media_type
+    return media_type
+
+
+def _not_modified(request: Request, response: FileResponse) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or response.headers["etag"] in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            return parsedate_to_datetime(response.headers["last-modified"]) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def _file_response(request: Request, path: str, filename: str) -> Response:
+    """
+    Serves a file with byte ranges (Range / If-Range), ETag and Last-Modified,
+    answering If-None-Match / If-Modified-Since with 304 when it hasn't changed.
+    """
+    response = FileResponse(
+        path,
+        media_type=_media_type(path),
+        filename=filename,
+        stat_result=os.stat(path),
+        headers={"Cache-Control": CACHE_CONTROL},
+        content_disposition_type="inline",
+    )
+    if _not_modified(request, response):
+        headers = {key: response.headers[key] for key in ("etag", "last-modified", "cache-control")}
+        return Response(status_code=304, headers=headers)
+    return response
 
 
 @router.post("/audio")
@@ -35,52 +92,177 @@ async def upload_audio(file: UploadFile = File(...)):
     original_name = file.filename or "audio.wav"
     ext = os.path.splitext(original_name)[1] or ".wav"
     
-    # Save to disk
-    file_path = os.path.join(UPLOAD_DIR, f"{file_id}{ext}")
+    # The body was streamed to disk and hashed while it arrived (see ingest); move it into place
+    store = upload_store.get_store()
+    file_path = str(store.path_for(file_id, ext))
     
     try:
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        await file_io.save_upload_file(file, Path(file_path))
+        if isinstance(file, ingest.IngestFile):
+            content_hash, info = file.sha256, file.info
+        else:
+            content_hash, info = await executor.run("decode", hash_file, file_path), None
         
-        # Get basic file info without loading entire file
-        info = sf.info(file_path)
-        
-        return {
-            "file_id": file_id,
-            "original_name": original_name,
-            "duration_seconds": info.duration,
-            "sample_rate": info.samplerate,
-            "channels": info.channels,
-            "file_size_mb": round(os.path.getsize(file_path) / (1024 * 1024), 2)
-        }
+        return await _register(file_id, file_path, original_name, content_hash, info)
+    except executor.JobTimeoutError as e:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
         # Cleanup on error
         if os.path.exists(file_path):
             os.remove(file_path)
+        if isinstance(file, ingest.IngestFile) and file.info is None:
+            # The header probe already saw no audio libsndfile reads, and the fallback decoder failed too
+            raise HTTPException(status_code=400, detail=f"Unsupported audio file: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
 
 
-@router.get("/stream/{file_id}")
-async def stream_audio(file_id: str):
+def _ingest(file_id: str, file_path: str) -> pcm_cache.Pcm:
+    # Decode once into the PCM cache; processing endpoints read it from there.
+    # The waveform pyramid is built from the freshly decoded (still cached) samples.
+    pcm = pcm_cache.get_cache().put(file_id, file_path)
+    waveform.build(pcm.audio, pcm.sample_rate, waveform.peaks_path(file_id))
+    return pcm
+
+
+# file_id -> background decode of an upload indexed from its header (see _register)
+_warming: Dict[str, asyncio.Task] = {}
+
+
+def _warmed(file_id: str, task: asyncio.Task) -> None:
+    if _warming.get(file_id) is task:
+        del _warming[file_id]
+
+
+async def _warm(file_id: str, file_path: str) -> None:
+    try:
+        await executor.run("decode", _ingest, file_id, file_path)
+    except Exception:
+        # Not fatal: the first request that needs the PCM decodes it (and reports the error)
+        logger.exception(f"Decoding upload {file_id} failed")
+
+
+async def _register(
+    file_id: str, file_path: str, original_name: str, content_hash: str,
+    info: Optional[Dict[str, Any]] = None,
+) -> dict:
     """
-    Stream the full uploaded audio file.
-    Browser can load this progressively without crashing.
-    """
-    # Find the file (could be any extension)
-    file_path = None
-    for f in os.listdir(UPLOAD_DIR):
-        if f.startswith(file_id):
-            file_path = os.path.join(UPLOAD_DIR, f)
-            break
+    Indexes a stored upload and returns its metadata. With a header probe that
+    gives the duration (see ingest.IngestFile.info) the metadata comes from it
+    and the file is decoded in the background; otherwise it is decoded first.
+    """
+    if info is not None and info["duration"] is not None:
+        duration, sample_rate, channels = info["duration"], info["sample_rate"], info["channels"]
+        task = asyncio.create_task(_warm(file_id, file_path))
+        _warming[file_id] = task
+        task.add_done_callback(lambda done: _warmed(file_id, done))
+    else:
+        pcm = await executor.run("decode", _ingest, file_id, file_path)
+        duration, sample_rate, channels = len(pcm.audio) / pcm.sample_rate, pcm.sample_rate, pcm.audio.shape[1]
     
-    if not file_path or not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail="File not found")
+    upload = upload_store.get_store().add(
+        file_id, file_path, original_name,
+        duration=duration,
+        sample_rate=sample_rate,
+        channels=channels,
+        content_hash=content_hash,
+    )
+    await storage.get_manager().atrack(file_path, storage.UPLOAD)
     
-    # Return file directly - browser handles streaming
-    return FileResponse(
-        file_path,
-        media_type="audio/wav",
-        filename=f"audio_{file_id}.wav"
+    return {
+        "file_id": file_id,
+        "original_name": original_name,
+        "duration_seconds": upload.duration,
+        "sample_rate": upload.sample_rate,
+        "channels": upload.channels,
+        "file_size_mb": round(upload.size / (1024 * 1024), 2)
+    }
+
+
+@router.get("/stream/{file_id}")
+async def stream_audio(file_id: str, request: Request):
+    """
+    Stream the full uploaded audio file.
+    Browser can load this progressively without crashing, and seek with range requests.
+    """
+    upload = await _get_upload(file_id)
+    return _file_response(request, str(upload.path), upload.original_name)
+
+
+@router.get("/preview/{file_id}")
+async def preview_audio(
+    file_id: str,
+    request: Request,
+    full: bool = Query(False, description="Whole track instead of its first PREVIEW_SECONDS"),
+):
+    """
+    Low-bitrate compressed preview of an upload (PREVIEW_BITRATE_KBPS, MP3).
+    Rendered the first time it is requested, then served from disk with range requests.
+    """
+    upload = await _get_upload(file_id)
+    try:
+        path = await preview.get_preview(file_id, str(upload.path), full)
+    except executor.JobTimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Preview failed: {str(e)}")
+    await storage.get_manager().atouch(path, storage.OUTPUT)
+    name = os.path.splitext(upload.original_name)[0] + "_preview" + path.suffix
+    return _file_response(request, str(path), name)
+
+
+async def _waveform_header(file_id: str) -> dict:
+    upload = await _get_upload(file_id)
+    path = waveform.peaks_path(file_id)
+    warming = _warming.get(file_id)
+    if warming is not None and not path.exists():
+        # Just uploaded: its decode builds the waveform. shield: this request
+        # going away must not cancel it (_warm logs its errors, never raises)
+        await asyncio.shield(warming)
+    try:
+        if not path.exists():
+            # Uploaded before waveforms were computed at upload time, or its decode failed
+            pcm = await executor.run("decode", pcm_cache.load, str(upload.path))
+            return await executor.run("decode", waveform.build, pcm.audio, pcm.sample_rate, path)
+        return waveform.read_header(path)
+    except executor.JobTimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Waveform failed: {str(e)}")
+
+
+@router.get("/waveform/{file_id}")
+async def waveform_levels(file_id: str):
+    """
+    Zoom levels of the upload's waveform peak pyramid.
+    Each level lists its peak duration and number of tiles; fetch the visible tiles with
+    /upload/waveform/{file_id}/{level}/{tile}.
+    """
+    return waveform.describe(await _waveform_header(file_id))
+
+
+@router.get("/waveform/{file_id}/{level}/{tile}")
+async def waveform_tile(file_id: str, level: int, tile: int):
+    """
+    One tile of waveform peaks: up to tile_peaks peaks of `level`, each (min, max, rms)
+    per channel as little-endian int16 (32767 = full scale), i.e. a (peaks, channels, 3) array.
+    """
+    header = await _waveform_header(file_id)
+    if not 0 <= level < len(header["levels"]):
+        raise HTTPException(status_code=404, detail="Level not found")
+    data = waveform.read_tile(waveform.peaks_path(file_id), header, level, tile)
+    if data is None:
+        raise HTTPException(status_code=404, detail="Tile not found")
+    return Response(
+        content=data,
+        media_type="application/octet-stream",
+        headers={
+            "Cache-Control": CACHE_CONTROL,
+            "X-Samples-Per-Peak": str(header["levels"][level]["samples_per_peak"]),
+            "X-Channels": str(header["channels"]),
+            "X-First-Peak": str(tile * header["tile_peaks"]),
+        },
     )
 
 
@@ -90,11 +272,7 @@ async def get_file_path(file_id: str):
     Get the server-side file path for backend processing.
     Other routers (commit, stems, etc.) can use this to process the full file.
     """
-    for f in os.listdir(UPLOAD_DIR):
-        if f.startswith(file_id):
-            return {"file_path": os.path.join(UPLOAD_DIR, f)}
-    
-    raise HTTPException(status_code=404, detail="File not found")
+    return {"file_path": str((await _get_upload(file_id)).path)}
 
 
 @router.delete("/{file_id}")
@@ -102,9 +280,172 @@ async def delete_file(file_id: str):
     """
     Delete an uploaded file when no longer needed.
     """
-    for f in os.listdir(UPLOAD_DIR):
-        if f.startswith(file_id):
-            os.remove(os.path.join(UPLOAD_DIR, f))
-            return {"deleted": True, "file_id": file_id}
+    if not await run_in_threadpool(storage.remove_upload, file_id):
+        raise HTTPException(status_code=404, detail="File not found")
+    return {"deleted": True, "file_id": file_id}
+
+
+# --- Resumable uploads ---
+# POST /sessions reserves the file, each chunk is PUT (in any order, several
+# at once) straight into its place in it, and POST /sessions/{id}/complete
+# turns it into a regular upload. GET /sessions/{id} tells an interrupted
+# client which chunks it still has to send.
+
+def _get_session(file_id: str) -> upload_store.UploadSession:
+    session = upload_store.get_store().get_session(file_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    return session
+
+
+def _session_status(session: upload_store.UploadSession) -> dict:
+    received = upload_store.get_store().received_chunks(session.file_id)
+    return {
+        "file_id": session.file_id,
+        "size": session.size,
+        "chunk_size": session.chunk_size,
+        "chunks": session.chunks,
+        "received": received,
+        "missing": sorted(set(range(session.chunks)) - set(received)),
+    }
+
+
+@router.post("/sessions")
+async def create_upload_session(
+    filename: str = Form(..., description="Original file name; its extension is kept"),
+    size: int = Form(..., description="Total file size in bytes"),
+    chunk_size: int = Form(UPLOAD_CHUNK_BYTES, description="Chunk size in bytes (all chunks but the last)"),
+):
+    """
+    Start a resumable upload.
+    Returns the file_id to PUT chunks to and how many chunks are expected.
+    """
+    if size <= 0:
+        raise HTTPException(status_code=400, detail="size must be positive")
+    if size > UPLOAD_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"size must be at most {UPLOAD_MAX_BYTES} bytes")
+    if not 0 < chunk_size <= UPLOAD_MAX_CHUNK_BYTES:
+        raise HTTPException(status_code=400, detail=f"chunk_size must be between 1 and {UPLOAD_MAX_CHUNK_BYTES}")
+    
+    store = upload_store.get_store()
+    store.purge_sessions(UPLOAD_SESSION_TTL_SECONDS)
+    session = store.create_session(filename, size, chunk_size)
+    return _session_status(session)
+
+
+@router.get("/sessions/{file_id}")
+async def get_upload_session(file_id: str):
+    """Chunks received so far and those still missing."""
+    return _session_status(_get_session(file_id))
+
+
+def _write_at(fd: int, data: bytes, offset: int, digest) -> int:
+    """Writes data at offset and adds it to digest; returns its length."""
+    view = memoryview(data)
+    written = 0
+    while written < len(view):
+        written += os.pwrite(fd, view[written:], offset + written)
+    digest.update(view)
+    return written
+
+
+@router.put("/sessions/{file_id}/chunks/{index}")
+async def upload_chunk(
+    file_id: str,
+    index: int,
+    request: Request,
+    x_chunk_sha256: str = Header(..., description="Hex SHA-256 of the chunk"),
+):
+    """
+    Upload chunk `index` (0-based) as the raw request body.
+    Re-sending a chunk overwrites it. Until the chunk has been written and its
+    checksum verified it counts as missing: a chunk that is rejected or cut
+    off has to be sent again.
+    """
+    session = _get_session(file_id)
+    if not 0 <= index < session.chunks:
+        raise HTTPException(status_code=400, detail=f"Chunk index must be between 0 and {session.chunks - 1}")
+    offset, length = session.chunk_span(index)
+    
+    store = upload_store.get_store()
+    if not store.start_chunk(file_id, index):
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    
+    # Written in place: the file is never rewritten or reassembled
+    digest = hashlib.sha256()
+    received = 0
+    try:
+        fd = os.open(session.path, os.O_WRONLY)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    try:
+        async for data in request.stream():
+            if received + len(data) > length:
+                raise HTTPException(status_code=413, detail=f"Chunk {index} is {length} bytes")
+            # Off the event loop: chunks are large and arrive in parallel
+            received += await run_in_threadpool(_write_at, fd, data, offset + received, digest)
+    finally:
+        os.close(fd)
+    
+    if received != length:
+        raise HTTPException(status_code=400, detail=f"Chunk {index} is {length} bytes, got {received}")
+    if digest.hexdigest() != x_chunk_sha256.lower():
+        raise HTTPException(status_code=400, detail=f"Checksum mismatch for chunk {index}")
     
-    raise HTTPException(status_code=404, detail="File not found")
+    store.add_chunk(file_id, index, digest.hexdigest())
+    return {"file_id": file_id, "index": index, "received": len(store.received_chunks(file_id)), "chunks": session.chunks}
+
+
+@router.post("/sessions/{file_id}/complete")
+async def complete_upload_session(
+    file_id: str,
+    sha256: Optional[str] = Form(None, description="(Optional) Hex SHA-256 of the whole file, verified"),
+):
+    """
+    Finish a resumable upload once every chunk is in.
+    Returns the same metadata as /upload/audio.
+    """
+    session = _get_session(file_id)
+    status = _session_status(session)
+    if status["missing"]:
+        raise HTTPException(status_code=409, detail={"message": "Missing chunks", "missing": status["missing"]})
+    
+    # Verified before the session ends: on a mismatch the session and its file
+    # are kept, so the client can re-send chunks and complete again
+    store = upload_store.get_store()
+    digests = store.chunk_digests(file_id)
+    try:
+        content_hash = await executor.run("decode", hash_file, str(session.path))
+    except executor.JobTimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    if sha256 is not None and content_hash != sha256.lower():
+        raise HTTPException(status_code=400, detail="Checksum mismatch for the whole file")
+    
+    try:
+        file_path = store.finish_session(session, digests)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if file_path is None:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    
+    try:
+        return await _register(file_id, str(file_path), session.original_name, content_hash)
+    except executor.JobTimeoutError as e:
+        file_path.unlink(missing_ok=True)
+        raise HTTPException(status_code=504, detail=str(e))
+    except ValueError as e:
+        file_path.unlink(missing_ok=True)
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        file_path.unlink(missing_ok=True)
+        raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
+
+
+@router.delete("/sessions/{file_id}")
+async def abort_upload_session(file_id: str):
+    """Abandon a resumable upload and free its space."""
+    if upload_store.get_store().delete_session(file_id) is None:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    return {"deleted": True, "file_id": file_id}
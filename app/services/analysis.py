@@ -1,57 +1,528 @@
+import asyncio
+import io
+import math
+import multiprocessing
+import os
+import essentia
 import essentia.standard as es
+import essentia.streaming as ess
 import numpy as np
-from typing import Dict, Any
+import soundfile as sf
+from pathlib import Path
+from typing import Dict, Any, List, Optional, Tuple
+from app.config import (
+    ANALYSIS_LONG_TRACK_SECONDS, ANALYSIS_CACHE_PATH, ANALYSIS_CACHE_MEMORY_ENTRIES,
+    ANALYSIS_CACHE_STALE_VERSION_SECONDS,
+    ANALYSIS_PREVIEW_WINDOWS, ANALYSIS_PREVIEW_WINDOW_SECONDS,
+)
+from app.services import executor, loudness, pcm_cache, upload_store
+from app.services.analysis_cache import AnalysisCache, Key
+from app.services.stem_cache import hash_file
 
-def analyze_audio(audio_path: str) -> Dict[str, Any]:
+# Part of every cached result's key: bump it whenever a change here alters
+# the returned features, so results of the old code are not served anymore.
+ANALYZER_VERSION = f"essentia-{essentia.__version__}/streaming-3"
+
+SAMPLE_RATE = 44100
+# Shared 10ms frames: their energies give the per-bar levels, their standard
+# deviations are all Danceability looks at.
+ENVELOPE_FRAME = int(0.01 * SAMPLE_RATE)
+# DynamicComplexity for long tracks, computed as it streams (see _connect_dynamics):
+# its 0.2s frames, "B-curve" weighting filter and 35ms loudness smoothing
+DYNAMICS_FRAME = int(math.floor(0.2 * SAMPLE_RATE))
+DYNAMICS_WEIGHTING = ([0.98595, -0.98595], [1.0, -0.9719])
+DYNAMICS_SMOOTHING = math.exp(-1.0 / (0.035 * SAMPLE_RATE))
+SILENCE_POWER = 1e-10
+SILENCE_DB = -100.0
+# Time-resolved output (analyze_timeline): onset detection and chroma frames
+ONSET_FRAME = 1024
+ONSET_HOP = 512
+CHROMA_FRAME = 4096  # same framing as KeyExtractor
+BEATS_PER_BAR = 4
+# Preview analysis (analyze_preview) runs on a decimated signal
+PREVIEW_SAMPLE_RATE = 22050
+PREVIEW_BPM_TOLERANCE = 0.02
+
+_cache: Optional[AnalysisCache] = None
+
+
+def get_cache() -> AnalysisCache:
+    global _cache
+    if _cache is None:
+        _cache = AnalysisCache(
+            ANALYSIS_CACHE_PATH, ANALYZER_VERSION, ANALYSIS_CACHE_MEMORY_ENTRIES, ANALYSIS_CACHE_STALE_VERSION_SECONDS
+        )
+    return _cache
+
+
+def _duration(audio_path: str) -> float:
+    """Duration from the container metadata, without decoding. inf if unknown."""
+    try:
+        *_, duration, _, _, _ = es.MetadataReader(filename=audio_path)()
+    except RuntimeError:
+        return float("inf")
+    return float(duration) or float("inf")
+
+
+def _danceability(frame_std: np.ndarray) -> float:
+    """
+    Essentia's Danceability from the per-10ms-frame standard deviations.
+    Danceability only uses those, so it is fed two samples per frame with the
+    same deviation at a 200 Hz "sample rate" (still 10ms frames) instead of
+    the full-rate signal.
+    """
+    surrogate = np.stack([-frame_std, frame_std], axis=1).ravel().astype(np.float32)
+    danceability, _ = es.Danceability(sampleRate=2 / 0.01)(surrogate)
+    return float(danceability)
+
+
+def _connect_dynamics(signal, pool: essentia.Pool) -> None:
+    """
+    Streams Essentia's DynamicComplexity loudness curve into pool["dynamics_power"],
+    for long tracks where DynamicComplexity itself would hold the whole signal.
+    DynamicComplexity weights the signal with a first-order "B-curve" filter and
+    takes, at the end of each 0.2s frame, a running mean square that decays with
+    a 35ms time constant. That is a one-pole low-pass of the squared signal
+    sampled every DYNAMICS_FRAME samples, which IIR and FrameCutter stream.
+    """
+    weighting = ess.IIR(numerator=DYNAMICS_WEIGHTING[0], denominator=DYNAMICS_WEIGHTING[1])
+    square = ess.UnaryOperatorStream(type="square")
+    smoothing = ess.IIR(numerator=[1 - DYNAMICS_SMOOTHING], denominator=[1.0, -DYNAMICS_SMOOTHING])
+    # One-sample frames: not starting from zero, the first is centred before the
+    # signal and the k-th (k >= 1) is the last sample of the k-th 0.2s frame.
+    # Silent frames are kept as they are: FrameCutter would add noise right at
+    # the silence threshold, which decides where the leading silence ends.
+    frame_ends = ess.FrameCutter(
+        frameSize=1, hopSize=DYNAMICS_FRAME, startFromZero=False,
+        lastFrameToEndOfFile=False, validFrameThresholdRatio=0, silentFrames="keep",
+    )
+    signal >> weighting.signal
+    weighting.signal >> square.array
+    square.array >> smoothing.signal
+    smoothing.signal >> frame_ends.signal
+    frame_ends.frame >> (pool, "dynamics_power")
+
+
+def _dynamic_complexity(frame_power: np.ndarray) -> float:
+    """
+    DynamicComplexity from the loudness curve of _connect_dynamics (one value
+    per 0.2s frame, after a leading padding frame): the average absolute
+    deviation of the frame levels (dB) from a global level that weights louder
+    frames more, ignoring silence at the start and end. Same result as the
+    short-track path, up to float rounding.
+    """
+    power = frame_power.ravel()[1:]
+    levels = np.where(power < SILENCE_POWER, SILENCE_DB, 10 * np.log10(np.maximum(power, SILENCE_POWER)))
+    audible = np.flatnonzero(levels > SILENCE_DB)
+    if len(audible) == 0:
+        return 0.0
+    levels = levels[audible[0]:audible[-1] + 1]
+    weights = 0.9 ** -levels
+    overall = np.sum(levels * weights) / np.sum(weights)
+    return float(np.mean(np.abs(levels - overall)))
+
+
+def _downbeat_phase(beats: np.ndarray, onset_strength: np.ndarray) -> int:
+    """
+    Essentia has no downbeat tracker: assuming BEATS_PER_BAR beats per bar,
+    the downbeats are taken to be the beat phase with the strongest onsets.
+    """
+    if len(beats) < BEATS_PER_BAR or len(onset_strength) == 0:
+        return 0
+    frames = np.minimum(np.round(beats * SAMPLE_RATE / ONSET_HOP).astype(int), len(onset_strength) - 1)
+    strength = onset_strength[frames]
+    return int(np.argmax([strength[phase::BEATS_PER_BAR].mean() for phase in range(BEATS_PER_BAR)]))
+
+
+def _timeline(pool: Dict[str, Any], frame_energy: np.ndarray, duration: float) -> Dict[str, np.ndarray]:
+    """Beat grid, downbeats, per-bar loudness and key strength, and onsets, as float32 arrays."""
+    beats = np.asarray(pool["beats"], dtype=np.float64) if "beats" in pool else np.zeros(0)
+    if "onset_strength" in pool:
+        onset_strength = np.asarray(pool["onset_strength"], dtype=np.float64)
+        onsets = es.Onsets(frameRate=SAMPLE_RATE / ONSET_HOP)(essentia.array(onset_strength[np.newaxis, :]), [1])
+    else:
+        onset_strength = onsets = np.zeros(0)
+
+    downbeats = beats[_downbeat_phase(beats, onset_strength)::BEATS_PER_BAR]
+    # Bars run from a downbeat to the next one, the last one to the end
+    bars = list(zip(downbeats, np.append(downbeats[1:], duration)))
+
+    # Loudness of each bar in dBFS, from the 10ms frame energies
+    bar_loudness = []
+    for start, end in bars:
+        first = int(start * SAMPLE_RATE) // ENVELOPE_FRAME
+        last = max(int(end * SAMPLE_RATE) // ENVELOPE_FRAME, first + 1)
+        power = frame_energy[first:last].sum() / ((last - first) * ENVELOPE_FRAME)
+        bar_loudness.append(max(10 * np.log10(max(power, 1e-30)), SILENCE_DB))
+
+    # Key strength of each bar from its mean chroma (the key itself is KeyExtractor's)
+    chroma = np.asarray(pool["hpcp"], dtype=np.float32) if "hpcp" in pool else np.zeros((0, 12), np.float32)
+    chroma_times = np.arange(len(chroma)) * CHROMA_FRAME / SAMPLE_RATE
+    key = es.Key(profileType="bgate")
+    bar_key_strength = []
+    for start, end in bars:
+        bar = chroma[(chroma_times >= start) & (chroma_times < end)]
+        if not bar.any():
+            bar_key_strength.append(0.0)
+            continue
+        _, _, strength, _ = key(essentia.array(bar.mean(axis=0)))
+        bar_key_strength.append(strength)
+
+    return {
+        "beats": beats.astype(np.float32),
+        "downbeats": downbeats.astype(np.float32),
+        "bar_loudness": np.asarray(bar_loudness, dtype=np.float32),
+        "bar_key_strength": np.asarray(bar_key_strength, dtype=np.float32),
+        "onsets": np.asarray(onsets, dtype=np.float32),
+    }
+
+
+def encode_timeline(timeline: Dict[str, np.ndarray]) -> bytes:
+    """The timeline arrays as an (uncompressed) .npz file."""
+    buffer = io.BytesIO()
+    np.savez(buffer, **timeline)
+    return buffer.getvalue()
+
+
+def _run_network(audio_path: str, long_track: bool, timeline: bool) -> Tuple[Dict[str, Any], Any]:
+    """
+    Decodes the file once and streams it through a single Essentia network.
+    Returns the network's outputs by name, and the network itself (its loader).
+    What is shared is the decode: KeyExtractor and RhythmExtractor2013 are
+    composites that cut their own frames and compute their own spectra, so the
+    envelope, onset and chroma branches don't reuse theirs.
+    """
+    pool = essentia.Pool()
+
+    # Mono loader for general feature extraction
+    loader = ess.MonoLoader(filename=audio_path, sampleRate=SAMPLE_RATE)
+
+    # 1. Rhythm (BPM)
+    # RhythmExtractor2013 is a robust beat tracker. multifeature holds the
+    # whole track in memory; degara only keeps its onset curve.
+    rhythm = ess.RhythmExtractor2013(method="degara" if long_track else "multifeature")
+    loader.audio >> rhythm.signal
+    rhythm.bpm >> (pool, "bpm")
+    rhythm.ticks >> (pool, "beats")
+    rhythm.confidence >> None
+    rhythm.estimates >> None
+    rhythm.bpmIntervals >> None
+
+    # 2. Tonal (Key, Scale)
+    # KeyExtractor frames the stream itself (spectral peaks -> HPCP)
+    key = ess.KeyExtractor()
+    loader.audio >> key.audio
+    key.key >> (pool, "key")
+    key.scale >> (pool, "scale")
+    key.strength >> (pool, "key_strength")
+
+    # 3. Envelope: energy and standard deviation of 10ms frames
+    frames = ess.FrameCutter(
+        frameSize=ENVELOPE_FRAME, hopSize=ENVELOPE_FRAME, startFromZero=True,
+        lastFrameToEndOfFile=True, validFrameThresholdRatio=0,
+    )
+    energy = ess.Energy()
+    variance = ess.Variance()
+    loader.audio >> frames.signal
+    frames.frame >> energy.array
+    frames.frame >> variance.array
+    energy.energy >> (pool, "energy")
+    variance.variance >> (pool, "variance")
+
+    # 4. Dynamic Complexity
+    if long_track:
+        _connect_dynamics(loader.audio, pool)
+    else:
+        dynamic_complexity = ess.DynamicComplexity()
+        loader.audio >> dynamic_complexity.signal
+        dynamic_complexity.dynamicComplexity >> (pool, "dynamic_complexity")
+        dynamic_complexity.loudness >> None
+
+    # 5. Time-resolved output: onset detection function and chroma frames
+    if timeline:
+        # Overlapping frames have to run to the end of the stream, Essentia
+        # corrupts the network's buffers if they stop short of it
+        onset_frames = ess.FrameCutter(
+            frameSize=ONSET_FRAME, hopSize=ONSET_HOP, startFromZero=True,
+            lastFrameToEndOfFile=True, validFrameThresholdRatio=0,
+        )
+        onset_window = ess.Windowing(type="hann")
+        fft = ess.FFT()
+        polar = ess.CartesianToPolar()
+        onset_detection = ess.OnsetDetection(method="complex", sampleRate=SAMPLE_RATE)
+        loader.audio >> onset_frames.signal
+        onset_frames.frame >> onset_window.frame
+        onset_window.frame >> fft.frame
+        fft.fft >> polar.complex
+        polar.magnitude >> onset_detection.spectrum
+        polar.phase >> onset_detection.phase
+        onset_detection.onsetDetection >> (pool, "onset_strength")
+
+        chroma_frames = ess.FrameCutter(frameSize=CHROMA_FRAME, hopSize=CHROMA_FRAME, startFromZero=True)
+        chroma_window = ess.Windowing(type="hann")
+        spectrum = ess.Spectrum()
+        peaks = ess.SpectralPeaks(
+            orderBy="magnitude", magnitudeThreshold=0.0001, maxPeaks=60,
+            minFrequency=25, maxFrequency=3500, sampleRate=SAMPLE_RATE,
+        )
+        hpcp = ess.HPCP(size=12, minFrequency=25, maxFrequency=3500, weightType="cosine", sampleRate=SAMPLE_RATE)
+        loader.audio >> chroma_frames.signal
+        chroma_frames.frame >> chroma_window.frame
+        chroma_window.frame >> spectrum.frame
+        spectrum.spectrum >> peaks.spectrum
+        peaks.frequencies >> hpcp.frequencies
+        peaks.magnitudes >> hpcp.magnitudes
+        hpcp.hpcp >> (pool, "hpcp")
+
+    # Exact length in samples
+    length = ess.Duration()
+    loader.audio >> length.signal
+    length.duration >> (pool, "duration")
+
+    essentia.run(loader)
+    return {name: pool[name] for name in pool.descriptorNames()}, loader
+
+
+def _network_child(conn, audio_path: str, long_track: bool, timeline: bool) -> None:
+    try:
+        values, network = _run_network(audio_path, long_track, timeline)
+        conn.send((values, None))
+    except BaseException as e:
+        conn.send((None, f"{type(e).__name__}: {e}"))
+    finally:
+        conn.close()
+        # Exit without tearing the network down (see _run_network_isolated)
+        os._exit(0)
+
+
+def _run_network_isolated(audio_path: str, long_track: bool, timeline: bool) -> Dict[str, Any]:
+    """
+    _run_network() in a child process that exits without destroying the network.
+
+    Destroying a network built around the degara RhythmExtractor2013 can
+    corrupt the heap ("double free or corruption"), depending on the order its
+    consumers were connected in. That would kill the analysis pool worker, and
+    every job on the pool with it. The child sends its results back and then
+    exits without freeing anything. If it dies anyway, only this job fails.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    receiver, sender = ctx.Pipe(duplex=False)
+    child = ctx.Process(target=_network_child, args=(sender, audio_path, long_track, timeline), daemon=True)
+    child.start()
+    sender.close()
+    try:
+        values, error = receiver.recv()
+    except EOFError:
+        child.join()
+        raise RuntimeError(f"Analysis process died (exit code {child.exitcode})")
+    finally:
+        receiver.close()
+    child.join()
+    if error is not None:
+        raise RuntimeError(error)
+    return values
+
+
+def _analyze(audio_path: str, timeline: bool) -> Tuple[Dict[str, Any], Optional[Dict[str, np.ndarray]]]:
     """
     Analyzes audio using Essentia to extract BPM, Key, Loudness, and other features.
-    
+
+    The file is decoded once and streamed through a single Essentia network;
+    the algorithms consume it as it is decoded. Loudness (EBU R128) needs the
+    original channels and rate, so it reads the file a second time, in chunks
+    (see app/services/loudness.py). Tracks longer than
+    ANALYSIS_LONG_TRACK_SECONDS (e.g. DJ mixes) are analyzed in constant
+    memory, using the degara beat tracker and a streamed DynamicComplexity
+    (see _connect_dynamics), in a child process (see _run_network_isolated);
+    otherwise the results are the same as running each algorithm on the fully
+    loaded signal.
+
     Args:
         audio_path: Path to the input audio file.
-        
+        timeline: Also compute the time-resolved arrays (see _timeline), in the same pass.
+
     Returns:
-        Dictionary containing extracted features.
+        Dictionary containing extracted features, and the timeline arrays or None.
     """
-    # Load audio
-    # Mono loader for general feature extraction
-    loader = es.MonoLoader(filename=audio_path, sampleRate=44100)
-    audio = loader()
-    
+    long_track = _duration(audio_path) > ANALYSIS_LONG_TRACK_SECONDS
+    if long_track:
+        pool = _run_network_isolated(audio_path, long_track, timeline)
+    else:
+        pool, _ = _run_network(audio_path, long_track, timeline)
+
     features = {}
-    
-    # 1. Rhythm (BPM)
-    # RhythmExtractor2013 is a robust beat tracker
-    rhythm_extractor = es.RhythmExtractor2013(method="multifeature")
-    bpm, beats, beats_confidence, _, beats_intervals = rhythm_extractor(audio)
-    features["bpm"] = int(round(bpm))
-    features["beats_count"] = len(beats)
-    
-    # 2. Tonal (Key, Scale)
-    # KeyExtractor extracts key and scale
-    key_extractor = es.KeyExtractor()
-    key, scale, key_strength = key_extractor(audio)
-    features["key"] = key
-    features["scale"] = scale
-    features["key_strength"] = float(key_strength)
-    
-    # 3. Dynamics (Loudness)
-    # LoudnessEbur128 calculates integrated loudness (LUFS)
-    # It requires stereo signal usually, but MonoLoader returns mono.
-    # We can use standard Loudness algorithm or re-load as stereo if needed.
-    # For simplicity/speed on stems, mono is often fine, but let's check standard Loudness.
-    loudness_algo = es.Loudness()
-    loudness = loudness_algo(audio)
-    features["loudness"] = float(loudness)
-    
-    # 4. Spectral Features (Danceability, etc.)
-    # Danceability is often useful
-    danceability_algo = es.Danceability()
-    danceability, _ = danceability_algo(audio)
-    features["danceability"] = float(danceability)
-    
-    # Dynamic Complexity
-    dynamic_complexity_algo = es.DynamicComplexity()
-    dynamic_complexity, _ = dynamic_complexity_algo(audio)
-    features["dynamic_complexity"] = float(dynamic_complexity)
-    
+    features["bpm"] = int(round(float(pool["bpm"])))
+    features["beats_count"] = len(pool["beats"]) if "beats" in pool else 0
+
+    features["key"] = pool["key"]
+    features["scale"] = pool["scale"]
+    features["key_strength"] = float(pool["key_strength"])
+
+    meter = loudness.measure_file(audio_path)
+    features["loudness"] = meter["integrated"]  # LUFS
+    features["loudness_range"] = meter["loudness_range"]  # LU
+    features["true_peak"] = meter["true_peak"]  # dBTP
+
+    # Danceability only uses complete frames
+    complete = int(round(float(pool["duration"]) * SAMPLE_RATE)) // ENVELOPE_FRAME
+    frame_std = np.sqrt(np.asarray(pool["variance"], dtype=np.float64)[:complete])
+    features["danceability"] = _danceability(frame_std)
+
+    if long_track:
+        features["dynamic_complexity"] = _dynamic_complexity(np.asarray(pool["dynamics_power"], dtype=np.float64))
+    else:
+        features["dynamic_complexity"] = float(pool["dynamic_complexity"])
+
+    if not timeline:
+        return features, None
+    frame_energy = np.asarray(pool["energy"], dtype=np.float64)
+    return features, _timeline(pool, frame_energy, float(pool["duration"]))
+
+
+def analyze_audio(audio_path: str) -> Dict[str, Any]:
+    """Extracts BPM, Key, Loudness, and other features (see _analyze)."""
+    features, _ = _analyze(audio_path, timeline=False)
+    return features
+
+
+def analyze_timeline(audio_path: str) -> Tuple[Dict[str, Any], Dict[str, np.ndarray]]:
+    """The features plus their time-resolved arrays, from a single decode."""
+    return _analyze(audio_path, timeline=True)
+
+
+# The cache is consulted by the caller (the server), not in the pool workers:
+# a hit then costs no pool slot and no IPC, and the in-memory tier is shared.
+
+def _cache_key(audio_path: str) -> Key:
+    """Cache key of a file: a stored upload's recorded SHA-256, otherwise the file's hashed now."""
+    store = upload_store.get_store()
+    file_id = store.owns(Path(audio_path))
+    upload = store.get(file_id) if file_id else None
+    content_hash = upload.content_hash if upload is not None and upload.content_hash else hash_file(audio_path)
+    return get_cache().key(content_hash, SAMPLE_RATE)
+
+
+async def cached_features(audio_path: str) -> Tuple[Key, Optional[Dict[str, Any]]]:
+    """The file's cache key, and its full analysis if it's in the cache (without analyzing it)."""
+    key = await asyncio.to_thread(_cache_key, audio_path)
+    return key, await asyncio.to_thread(get_cache().get, key)
+
+
+async def analyze_audio_cached(audio_path: str) -> Dict[str, Any]:
+    """
+    analyze_audio() on the analysis pool, answered from the analysis cache when
+    this content was already analyzed by the current analyzer version.
+    """
+    key, features = await cached_features(audio_path)
+    if features is None:
+        features = await executor.run("analysis", analyze_audio, audio_path)
+        await asyncio.to_thread(get_cache().put, key, features)
     return features
+
+
+async def analyze_timeline_cached(audio_path: str) -> Tuple[Dict[str, Any], Dict[str, np.ndarray]]:
+    """analyze_timeline() on the analysis pool. Arrays aren't cached, but the features are."""
+    key = await asyncio.to_thread(_cache_key, audio_path)
+    features, timeline = await executor.run("analysis", analyze_timeline, audio_path)
+    await asyncio.to_thread(get_cache().put, key, features)
+    return features, timeline
+
+
+def _preview_windows(audio_path: str) -> Tuple[List[np.ndarray], float]:
+    """
+    Windows of the track evenly spread over it (the whole track if it's
+    shorter than the windows), as (frames, channels) arrays at the file's own
+    rate, and that rate. Uploads are sliced from the PCM cache; otherwise only
+    the windows are decoded when soundfile can seek in the format.
+    """
+    pcm = pcm_cache.cached(audio_path)
+    if pcm is not None:
+        spans = _window_spans(len(pcm.audio), int(ANALYSIS_PREVIEW_WINDOW_SECONDS * pcm.sample_rate))
+        return [pcm.audio[start:start + length] for start, length in spans], pcm.sample_rate
+
+    try:
+        with sf.SoundFile(audio_path) as f:
+            sample_rate, total = f.samplerate, f.frames
+            windows = []
+            for start, length in _window_spans(total, int(ANALYSIS_PREVIEW_WINDOW_SECONDS * sample_rate)):
+                f.seek(start)
+                windows.append(f.read(length, dtype="float32", always_2d=True))
+    except (sf.LibsndfileError, RuntimeError):
+        # Not seekable here (e.g. AAC): decode it all
+        audio, sample_rate, *_ = es.AudioLoader(filename=audio_path)()
+        spans = _window_spans(len(audio), int(ANALYSIS_PREVIEW_WINDOW_SECONDS * sample_rate))
+        return [audio[start:start + length] for start, length in spans], sample_rate
+
+    return windows, sample_rate
+
+
+def _window_spans(total: int, length: int) -> List[Tuple[int, int]]:
+    if total <= ANALYSIS_PREVIEW_WINDOWS * length:
+        return [(0, total)]
+    return [
+        ((total - length) * (i + 1) // (ANALYSIS_PREVIEW_WINDOWS + 1), length)
+        for i in range(ANALYSIS_PREVIEW_WINDOWS)
+    ]
+
+
+def analyze_preview(audio_path: str) -> Dict[str, Any]:
+    """
+    Fast approximation of analyze_audio() from a few windows of the track at
+    PREVIEW_SAMPLE_RATE, for a hint while the full analysis runs.
+
+    Returns the same features plus "bpm_confidence" and "key_confidence": the
+    share of the windows whose own estimate agrees with the returned one.
+    Loudness and true peak are those of the windows.
+    """
+    channel_windows, sample_rate = _preview_windows(audio_path)
+    if sum(len(window) for window in channel_windows) == 0:
+        raise ValueError("No audio decoded")
+
+    meter = loudness.LoudnessMeter(sample_rate, channel_windows[0].shape[1])
+    for window in channel_windows:
+        meter.process(window)
+    levels = meter.result()
+
+    resample = es.Resample(inputSampleRate=sample_rate, outputSampleRate=PREVIEW_SAMPLE_RATE, quality=4)
+    windows = [resample(essentia.array(window.mean(axis=1))) for window in channel_windows]
+    signal = np.concatenate(windows)
+
+    bpm_estimator = es.PercivalBpmEstimator(sampleRate=PREVIEW_SAMPLE_RATE)
+    window_bpms = np.array([bpm_estimator(window) for window in windows])
+    bpm = float(np.median(window_bpms))
+
+    key_extractor = es.KeyExtractor(sampleRate=PREVIEW_SAMPLE_RATE)
+    key, scale, key_strength = key_extractor(signal)
+    window_keys = [key_extractor(window)[:2] for window in windows]
+
+    danceability, _ = es.Danceability(sampleRate=PREVIEW_SAMPLE_RATE)(signal)
+    dynamic_complexity, _ = es.DynamicComplexity(sampleRate=PREVIEW_SAMPLE_RATE)(signal)
+
+    return {
+        "bpm": int(round(bpm)),
+        "bpm_confidence": float(np.mean(np.abs(window_bpms - bpm) <= PREVIEW_BPM_TOLERANCE * bpm)),
+        "key": key,
+        "scale": scale,
+        "key_strength": float(key_strength),
+        "key_confidence": float(np.mean([k == (key, scale) for k in window_keys])),
+        "loudness": levels["integrated"],
+        "loudness_range": levels["loudness_range"],
+        "true_peak": levels["true_peak"],
+        "danceability": float(danceability),
+        "dynamic_complexity": float(dynamic_complexity),
+    }
+
+
+def warm_up() -> None:
+    """Run in a new worker process, so Essentia's import (with this module) happens there, not in a request."""
+
+
+async def analyze_audio_preview(audio_path: str) -> Tuple[Dict[str, Any], bool]:
+    """
+    The cached full analysis if there is one, otherwise analyze_preview() on the
+    analysis_preview pool. The flag tells which one it is (True: preview).
+    """
+    _, features = await cached_features(audio_path)
+    if features is not None:
+        return features, False
+    return await executor.run("analysis_preview", analyze_preview, audio_path), True
@@ -0,0 +1,144 @@
+"""
+Library-scale audio analysis on a process pool.
+
+Tracks are fanned out over the "analysis" service pool (app/services/executor.py)
+and results are yielded as each one finishes. Every result lands in the analysis cache
+(app/services/analysis_cache.py), so re-running a batch that was interrupted
+only analyzes the tracks that hadn't finished.
+
+Also usable from the command line, writing NDJSON:
+    python -m app.services.analysis_batch ~/Music/catalog -o results.ndjson
+Running the same command again resumes: tracks already in the output file
+are skipped and new results are appended.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import sys
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, Iterable, List, Set, Tuple
+
+from app.services import analysis, executor
+
+logger = logging.getLogger(__name__)
+
+AUDIO_EXTENSIONS = {".wav", ".flac", ".mp3", ".ogg", ".opus", ".m4a", ".aac", ".aif", ".aiff"}
+# A track that takes its worker down (e.g. a decoder crash on a corrupt file)
+# breaks the whole pool; in-flight tracks are retried this many times.
+MAX_ATTEMPTS = 2
+
+
+async def analyze_batch(tracks: Iterable[Tuple[str, str]]) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Analyzes (track id, audio path) pairs on the analysis pool.
+
+    Yields {"id": ..., **features} or {"id": ..., "error": ...} per track, in
+    completion order. Only a few tracks per worker are submitted at a time,
+    so a crashing track can only take down the ones running next to it, and
+    single /analysis/analyze requests still get a turn in between.
+    """
+    pool = executor.get_pool("analysis")
+    queue = list(tracks)
+    queue.reverse()  # pop() from the end, keep the caller's order
+    attempts: Dict[str, int] = {}
+    running: Dict[asyncio.Task, Tuple[str, str]] = {}
+
+    try:
+        while queue or running:
+            while queue and len(running) < 2 * pool.workers:
+                track_id, path = queue.pop()
+                attempts[track_id] = attempts.get(track_id, 0) + 1
+                # Cache hits are answered here, only misses take a pool slot
+                task = asyncio.create_task(analysis.analyze_audio_cached(path))
+                running[task] = (track_id, path)
+
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                track_id, path = running.pop(task)
+                try:
+                    yield {"id": track_id, **task.result()}
+                except BrokenProcessPool:
+                    # The pool restarts itself; retry the tracks that went down with it
+                    if attempts[track_id] < MAX_ATTEMPTS:
+                        queue.append((track_id, path))
+                    else:
+                        yield {"id": track_id, "error": "Analysis worker crashed"}
+                except Exception as e:
+                    yield {"id": track_id, "error": str(e)}
+    finally:
+        for task in running:
+            task.cancel()
+
+
+# --- Command line ---
+
+def _find_audio(inputs: List[str]) -> List[str]:
+    files = []
+    for item in inputs:
+        path = Path(item)
+        if path.is_dir():
+            files.extend(
+                str(p) for p in sorted(path.rglob("*")) if p.suffix.lower() in AUDIO_EXTENSIONS and p.is_file()
+            )
+        else:
+            files.append(str(path))
+    return files
+
+
+def _finished(output: Path) -> Set[str]:
+    """Tracks with a successful result in an earlier run's output."""
+    done = set()
+    if not output.exists():
+        return done
+    with open(output) as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue  # last line of a run that was killed mid-write
+            if "error" not in result:
+                done.add(result["id"])
+    return done
+
+
+async def _run(files: List[str], output: Path) -> int:
+    failed = 0
+    with open(output, "a") as out:
+        async for result in analyze_batch((f, f) for f in files):
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+            if "error" in result:
+                failed += 1
+                logger.error(f"{result['id']}: {result['error']}")
+    return failed
+
+
+def main(argv: List[str] = None) -> None:
+    pool = executor.get_pool("analysis")
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("inputs", nargs="+", help="Audio files and/or directories (searched recursively)")
+    parser.add_argument("-o", "--output", required=True, help="NDJSON file results are appended to")
+    parser.add_argument("--workers", type=int, default=pool.workers)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    pool.workers = max(1, args.workers)
+    # A library run has no one waiting on individual tracks
+    pool.timeout = 0
+    output = Path(args.output)
+    files = _find_audio(args.inputs)
+    done = _finished(output)
+    todo = [f for f in files if f not in done]
+    logger.info(f"{len(files)} tracks, {len(files) - len(todo)} already done, analyzing {len(todo)}")
+
+    try:
+        failed = asyncio.run(_run(todo, output))
+    finally:
+        executor.shutdown()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
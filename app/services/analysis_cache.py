@@ -0,0 +1,105 @@
+"""
+Two-tier cache for audio analysis results.
+
+A small in-memory LRU sits in front of an SQLite table on disk, so repeated
+analyses of the same track are answered without decoding it, across
+restarts and across server processes. Entries are keyed by the audio content
+hash, the analysis sample rate and the analyzer version: bumping
+ANALYZER_VERSION (app/services/analysis.py) makes every old entry a miss.
+A version's entries are deleted once none has been stored for
+`stale_version_seconds`, so during a rolling deploy the processes still
+running the old version keep theirs.
+"""
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+Key = Tuple[str, int, str]  # (content hash, sample rate, analyzer version)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS analysis (
+    content_hash TEXT NOT NULL,
+    sample_rate INTEGER NOT NULL,
+    version TEXT NOT NULL,
+    features TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (content_hash, sample_rate, version)
+)
+"""
+
+
+class AnalysisCache:
+    """In-memory LRU of analysis results backed by an SQLite database."""
+
+    def __init__(self, db_path: Path, version: str, max_memory_entries: int, stale_version_seconds: float):
+        self.db_path = db_path
+        self.version = version
+        self.max_memory_entries = max_memory_entries
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[Key, Dict[str, Any]]" = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        # One connection shared by the request threads, serialized by _lock
+        self._db = sqlite3.connect(str(db_path), check_same_thread=False, timeout=30)
+        # WAL: readers in other processes don't block on writers
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(_SCHEMA)
+        with self._db:
+            self._db.execute(
+                "DELETE FROM analysis WHERE version != ? AND version IN "
+                "(SELECT version FROM analysis GROUP BY version HAVING MAX(created_at) < ?)",
+                (version, time.time() - stale_version_seconds),
+            )
+
+    def key(self, content_hash: str, sample_rate: int) -> Key:
+        return (content_hash, sample_rate, self.version)
+
+    def get(self, key: Key) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            features = self._memory.get(key)
+            if features is not None:
+                self._memory.move_to_end(key)
+                self._hits += 1
+                return dict(features)
+
+            row = self._db.execute(
+                "SELECT features FROM analysis WHERE content_hash = ? AND sample_rate = ? AND version = ?", key
+            ).fetchone()
+            if row is None:
+                self._misses += 1
+                return None
+            features = json.loads(row[0])
+            self._remember(key, features)
+            self._hits += 1
+            return dict(features)
+
+    def put(self, key: Key, features: Dict[str, Any]) -> None:
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO analysis VALUES (?, ?, ?, ?, ?)",
+                    (*key, json.dumps(features), time.time()),
+                )
+            self._remember(key, dict(features))
+
+    def _remember(self, key: Key, features: Dict[str, Any]) -> None:
+        self._memory[key] = features
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            (stored,) = self._db.execute("SELECT COUNT(*) FROM analysis").fetchone()
+            return {
+                "memory_entries": len(self._memory),
+                "stored_entries": stored,
+                "hits": self._hits,
+                "misses": self._misses,
+            }
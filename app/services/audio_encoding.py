@@ -0,0 +1,129 @@
+"""
+Output encoders for rendered audio (stems, previews, ...).
+
+Every format is written through a small writer object with write(frames) /
+close(), fed (frames, channels) float32 blocks, so long renders can be encoded
+incrementally. WAV/FLAC (and MP3 when libsndfile was built with it) go through
+soundfile; anything else is piped through ffmpeg if it is installed with the
+needed encoder.
+"""
+import functools
+import shutil
+import subprocess
+from typing import Dict, List, Optional
+
+import numpy as np
+import soundfile as sf
+
+FFMPEG_BIN = shutil.which("ffmpeg")
+
+# name -> extension, media type, soundfile (format, subtype) and/or ffmpeg codec args
+FORMATS: Dict[str, dict] = {
+    "wav": {"ext": ".wav", "media_type": "audio/wav", "soundfile": ("WAV", "PCM_16")},
+    "flac": {"ext": ".flac", "media_type": "audio/flac", "soundfile": ("FLAC", "PCM_16")},
+    "mp3": {
+        "ext": ".mp3", "media_type": "audio/mpeg",
+        "soundfile": ("MP3", "MPEG_LAYER_III"),
+        "ffmpeg": ["-c:a", "libmp3lame", "-b:a", "320k"],
+    },
+    # libsndfile's Opus only accepts 48kHz input, so Opus always goes through ffmpeg
+    "opus": {"ext": ".opus", "media_type": "audio/ogg", "ffmpeg": ["-c:a", "libopus", "-b:a", "160k"]},
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _ffmpeg_encoders() -> str:
+    if FFMPEG_BIN is None:
+        return ""
+    try:
+        return subprocess.run(
+            [FFMPEG_BIN, "-hide_banner", "-encoders"], capture_output=True, text=True, timeout=10
+        ).stdout
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+
+def _use_soundfile(spec: dict) -> bool:
+    return "soundfile" in spec and spec["soundfile"][0] in sf.available_formats()
+
+
+def _use_ffmpeg(spec: dict) -> bool:
+    # codec args are ["-c:a", <encoder>, ...]
+    return "ffmpeg" in spec and f" {spec['ffmpeg'][1]} " in _ffmpeg_encoders()
+
+
+def available_formats() -> List[str]:
+    """Formats an encoder exists for on this machine."""
+    return [name for name, spec in FORMATS.items() if _use_soundfile(spec) or _use_ffmpeg(spec)]
+
+
+def filename(name: str, fmt: str) -> str:
+    return name + FORMATS[fmt]["ext"]
+
+
+def media_type(path: str) -> str:
+    for spec in FORMATS.values():
+        if path.endswith(spec["ext"]):
+            return spec["media_type"]
+    return "application/octet-stream"
+
+
+class _FFmpegWriter:
+    """Pipes raw float32 frames into an ffmpeg encoder process."""
+
+    def __init__(self, path: str, codec_args: List[str], samplerate: int, channels: int):
+        self._proc = subprocess.Popen(
+            [
+                FFMPEG_BIN, "-hide_banner", "-loglevel", "error", "-y",
+                "-f", "f32le", "-ar", str(samplerate), "-ac", str(channels), "-i", "pipe:0",
+                *codec_args, path,
+            ],
+            stdin=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+
+    def write(self, data: np.ndarray) -> None:
+        self._proc.stdin.write(np.ascontiguousarray(data, dtype="<f4").tobytes())
+
+    def close(self) -> None:
+        self._proc.stdin.close()
+        error = self._proc.stderr.read()
+        if self._proc.wait() != 0:
+            raise RuntimeError(f"ffmpeg encoding failed: {error.decode(errors='replace')}")
+
+
+def _mp3_compression_level(bitrate: int) -> float:
+    # libsndfile maps compression levels 0..1 linearly onto 320..32 kbps (constant bitrate)
+    return min(max((320 - bitrate) / (320 - 32), 0.0), 0.99)
+
+
+def open_writer(path: str, fmt: str, samplerate: int, channels: int, bitrate: Optional[int] = None):
+    """
+    Opens an incremental encoder for `fmt` writing to `path`.
+    The returned object has write(frames) taking (frames, channels) float arrays and close().
+    bitrate (kbps) overrides the default of the lossy formats.
+    """
+    spec = FORMATS.get(fmt)
+    if spec is None:
+        raise ValueError(f"Unknown output format: {fmt}")
+    if _use_soundfile(spec):
+        sf_format, subtype = spec["soundfile"]
+        options = {}
+        if bitrate is not None and sf_format == "MP3":
+            options = {"bitrate_mode": "CONSTANT", "compression_level": _mp3_compression_level(bitrate)}
+        return sf.SoundFile(path, "w", samplerate, channels, format=sf_format, subtype=subtype, **options)
+    if _use_ffmpeg(spec):
+        codec_args = spec["ffmpeg"]
+        if bitrate is not None:
+            codec_args = codec_args[:2] + ["-b:a", f"{bitrate}k"]
+        return _FFmpegWriter(path, codec_args, samplerate, channels)
+    raise ValueError(f"No encoder available for format: {fmt}")
+
+
+def write_audio(path: str, data: np.ndarray, samplerate: int, fmt: str, bitrate: Optional[int] = None) -> None:
+    """Encodes a whole (frames, channels) array in one go."""
+    writer = open_writer(path, fmt, samplerate, data.shape[1], bitrate)
+    try:
+        writer.write(data)
+    finally:
+        writer.close()
@@ -15,6 +15,7 @@ from pedalboard import (
 )
 
 from app.schemas import FXCommitJob, Point
+from app.services import pcm_cache
 
 logger = logging.getLogger(__name__)
 
@@ -252,9 +253,13 @@ CUSTOM_PROCESSORS = {
 
 # ── Main entry point ─────────────────────────────────────────────────
 
-def process_commit_job(audio_bytes: bytes, job: FXCommitJob) -> io.BytesIO:
+def process_commit_job(source: str, job: FXCommitJob) -> io.BytesIO:
+    """source: path of the input (a stored upload is read from its decoded PCM)."""
     # 1. Load audio
-    data, sample_rate = sf.read(io.BytesIO(audio_bytes))
+    pcm = pcm_cache.load(source)
+    # Same shape as sf.read: 1-D for mono
+    data = pcm.audio[:, 0] if pcm.audio.shape[1] == 1 else pcm.audio
+    data, sample_rate = pcm_cache.writable(data), pcm.sample_rate
     if data.dtype != np.float32:
         data = data.astype(np.float32)
 
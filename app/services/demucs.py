@@ -1,71 +1,354 @@
 import asyncio
-import shlex
-import subprocess
-import sys
-from typing import Dict
-from pathlib import Path
-from app.config import OUTPUT_DIR
-
-async def run_model(audio_path: str, model_name: str = "htdemucs") -> Dict[str, str]:
+import functools
+import logging
+import multiprocessing
+import queue
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, List, Optional
+from pathlib import Path, PurePosixPath
+import soundfile as sf
+from app.config import (
+    OUTPUT_DIR, DEMUCS_WORKERS, DEMUCS_PRELOAD_MODELS, DEMUCS_TORCH_THREADS,
+    STEM_CACHE_DIR, STEM_CACHE_MAX_BYTES, DEMUCS_CHUNK_SECONDS, DEMUCS_PARALLEL_MIN_SECONDS,
+)
+from app.services import demucs_worker
+from app.services.stem_cache import StemCache, hash_file, make_key
+
+logger = logging.getLogger(__name__)
+
+# Long-lived separation pool. Workers load their models once (see demucs_worker)
+# and pick jobs off the executor's queue, so there is no interpreter start,
+# torch import or weight load per request.
+_pool: Optional[ProcessPoolExecutor] = None
+
+# Serves the progress queues and cancel events shared with the workers
+_manager = None
+
+_cache: Optional[StemCache] = None
+# cache key -> running separation, so concurrent requests for the same track share one job
+_inflight: Dict[str, "_Separation"] = {}
+
+# Sources produced by the htdemucs family, in model order
+SOURCES = ["drums", "bass", "other", "vocals"]
+
+# Called with (segments_done, segments_total) as the worker finishes chunks
+ProgressCallback = Callable[[int, int], None]
+PROGRESS_POLL_INTERVAL = 0.5
+
+
+def get_pool() -> ProcessPoolExecutor:
+    """Returns the shared separation pool, creating it on first use."""
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(
+            max_workers=DEMUCS_WORKERS,
+            # spawn: torch does not like being forked after it has been initialized
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=demucs_worker.init_worker,
+            initargs=(DEMUCS_PRELOAD_MODELS, DEMUCS_TORCH_THREADS),
+        )
+    return _pool
+
+
+async def start_pool() -> None:
+    """Spawns the workers and waits for them to preload their models."""
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(get_pool(), demucs_worker.ping)
+    except Exception as e:
+        # Don't take the whole API down; the pool is recreated on the next request.
+        logger.error(f"Demucs worker pool failed to start: {e}")
+        shutdown_pool()
+
+
+def get_manager():
+    global _manager
+    if _manager is None:
+        _manager = multiprocessing.get_context("spawn").Manager()
+    return _manager
+
+
+def shutdown_pool() -> None:
+    global _pool, _manager
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+    if _manager is not None and not _inflight:
+        _manager.shutdown()
+        _manager = None
+
+
+def get_cache() -> StemCache:
+    global _cache
+    if _cache is None:
+        _cache = StemCache(STEM_CACHE_DIR, STEM_CACHE_MAX_BYTES)
+    return _cache
+
+
+def resolve_model_name(model_name: str) -> str:
+    """Maps API model names to Demucs internal names."""
+    if model_name == "demucs":
+        return "htdemucs"
+    elif model_name == "ht_demucs":
+        return "htdemucs"
+    elif model_name == "ht_demucs_ft":
+        return "htdemucs_ft"
+    elif model_name == "ht_demucs_int8":
+        return "htdemucs" + demucs_worker.INT8_SUFFIX
+    elif model_name == "ht_demucs_ft_int8":
+        return "htdemucs_ft" + demucs_worker.INT8_SUFFIX
+    return model_name
+
+
+def _selection_variant(stems: Optional[List[str]], two_stems: Optional[str]) -> List[str]:
+    """Cache key parts for a stem selection (none for the full set, so those keys are unchanged)."""
+    if two_stems:
+        return [f"two_stems={two_stems}"]
+    if stems and sorted(set(stems)) != sorted(SOURCES):
+        # Order-independent: vocals,drums and drums,vocals are the same entry
+        return ["stems=" + ",".join(sorted(set(stems)))]
+    return []
+
+
+def archive_url(stems: Dict[str, str]) -> Optional[str]:
+    """URL of the zip download for a set of stems returned by run_model()."""
+    if not stems:
+        return None
+    entry = PurePosixPath(next(iter(stems.values()))).parent
+    return f"/stems/archive/{entry.parent.name}/{entry.name}"
+
+
+def archive_files(model: str, key: str) -> Optional[List[Path]]:
+    """Stem files of a cache entry, or None if it doesn't exist (anymore)."""
+    entry_dir = get_cache().get(key)
+    if entry_dir is None or entry_dir.parent.name != model:
+        return None
+    return sorted(p for p in entry_dir.iterdir() if not p.name.startswith("."))
+
+
+def _stem_urls(entry_dir: Path) -> Dict[str, str]:
+    stems = {}
+    for stem_path in sorted(p for p in entry_dir.iterdir() if not p.name.startswith(".")):
+        # Mount point is /outputs -> OUTPUT_DIR
+        rel_path = stem_path.relative_to(OUTPUT_DIR)
+        stems[stem_path.stem] = f"/outputs/{rel_path}"
+    return stems
+
+
+class _Separation:
+    """One in-flight separation, shared by every caller waiting on the same cache key."""
+
+    def __init__(self, cancel):
+        # Manager event polled by the worker between chunks
+        self.cancel = cancel
+        self.listeners: List[ProgressCallback] = []
+        self.waiters = 0
+        self.future: Optional["asyncio.Future[Path]"] = None
+
+    def report(self, done: int, total: int) -> None:
+        for listener in list(self.listeners):
+            listener(done, total)
+
+
+def _drain(progress) -> List[dict]:
+    events = []
+    while True:
+        try:
+            events.append(progress.get_nowait())
+        except queue.Empty:
+            return events
+
+
+async def _separate_sequential(
+    sep: _Separation, audio_path: str, demucs_model: str, staging: Path, selection: dict, output_format: str
+) -> None:
+    """Whole track in one worker, chunk by chunk."""
+    loop = asyncio.get_running_loop()
+    progress = get_manager().Queue()
+    job = loop.run_in_executor(
+        get_pool(),
+        functools.partial(
+            demucs_worker.separate, audio_path, demucs_model, str(staging),
+            chunk_seconds=DEMUCS_CHUNK_SECONDS, progress=progress, cancel=sep.cancel,
+            output_format=output_format, **selection,
+        ),
+    )
+    # Relay the worker's per-chunk progress until it finishes
+    while True:
+        done, _ = await asyncio.wait({job}, timeout=PROGRESS_POLL_INTERVAL)
+        for event in await loop.run_in_executor(None, _drain, progress):
+            sep.report(event["segment"], event["segments"])
+        if done:
+            break
+    job.result()
+
+
+async def _separate_parallel(
+    sep: _Separation, audio_path: str, demucs_model: str, staging: Path, selection: dict, output_format: str
+) -> None:
+    """Overlapping segments fanned out across the pool, then stitched (see demucs_worker)."""
+    loop = asyncio.get_running_loop()
+    pool = get_pool()
+    scratch = staging / ".segments"
+
+    prep = await loop.run_in_executor(
+        pool, demucs_worker.prepare_segments, audio_path, demucs_model, str(scratch)
+    )
+    bounds = demucs_worker.chunk_bounds(
+        prep["frames"],
+        demucs_worker.chunk_size(DEMUCS_CHUNK_SECONDS, prep["samplerate"]),
+        demucs_worker.chunk_overlap(prep["samplerate"]),
+    )
+    segment_paths = [str(scratch / f"{i}.npy") for i in range(len(bounds))]
+    tasks = [
+        loop.run_in_executor(
+            pool,
+            functools.partial(
+                demucs_worker.separate_segment, prep["path"], demucs_model, start, end,
+                prep["mean"], prep["std"], path, cancel=sep.cancel, **selection,
+            ),
+        )
+        for (start, end), path in zip(bounds, segment_paths)
+    ]
+    try:
+        for done, task in enumerate(asyncio.as_completed(tasks), start=1):
+            await task
+            sep.report(done, len(tasks))
+    except BaseException:
+        # Drop the segments that haven't started; running ones see the cancel event
+        for task in tasks:
+            task.cancel()
+        raise
+
+    names = demucs_worker.output_names(prep["sources"], **selection)
+    segment_peaks = [task.result() for task in tasks]
+    peaks = [max(p[i] for p in segment_peaks) for i in range(len(names))]
+    await loop.run_in_executor(
+        pool, demucs_worker.stitch_segments, segment_paths, bounds, names, peaks,
+        prep["samplerate"], prep["channels"], str(staging), output_format,
+    )
+    shutil.rmtree(scratch, ignore_errors=True)
+
+
+def _use_parallel(audio_path: str) -> bool:
+    """Long tracks are split across the pool; short ones aren't worth the overhead."""
+    if DEMUCS_WORKERS < 2 or DEMUCS_PARALLEL_MIN_SECONDS <= 0:
+        return False
+    try:
+        return sf.info(audio_path).duration >= DEMUCS_PARALLEL_MIN_SECONDS
+    except RuntimeError:
+        # Not readable by libsndfile; the sequential path decodes it with demucs' loader
+        return False
+
+
+async def _separate(
+    sep: _Separation, audio_path: str, demucs_model: str, key: str, selection: dict, output_format: str
+) -> Path:
+    """Runs one separation on the pool and commits the result to the cache."""
+    cache = get_cache()
+    staging = cache.staging_dir(key, demucs_model)
+
+    loop = asyncio.get_running_loop()
+    try:
+        if _use_parallel(audio_path):
+            await _separate_parallel(sep, audio_path, demucs_model, staging, selection, output_format)
+        else:
+            await _separate_sequential(sep, audio_path, demucs_model, staging, selection, output_format)
+    except BrokenProcessPool:
+        # A worker died (e.g. OOM-killed). Drop the pool so the next request gets a fresh one.
+        shutdown_pool()
+        shutil.rmtree(staging, ignore_errors=True)
+        raise RuntimeError("Demucs worker crashed during separation")
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+    return await loop.run_in_executor(None, cache.commit, key, demucs_model, staging)
+
+
+def _finished(key: str, future: "asyncio.Future[Path]") -> None:
+    # The entry may already belong to a newer separation (see run_model)
+    sep = _inflight.get(key)
+    if sep is not None and sep.future is future:
+        _inflight.pop(key)
+    # Nobody may be left waiting (e.g. everyone cancelled); retrieve the
+    # exception so asyncio doesn't log "exception was never retrieved".
+    if not future.cancelled():
+        future.exception()
+
+
+async def run_model(
+    audio_path: str,
+    model_name: str = "htdemucs",
+    on_progress: Optional[ProgressCallback] = None,
+    stems: Optional[List[str]] = None,
+    two_stems: Optional[str] = None,
+    output_format: str = "wav",
+) -> Dict[str, str]:
     """
-    Runs Demucs separation.
-    
+    Runs Demucs separation on the worker pool, or returns cached stems.
+
+    Results are cached by audio content + model, so separating a track that
+    was already separated (under any filename) returns the existing stems.
+    Long tracks are split into overlapping segments separated in parallel
+    across the pool (see DEMUCS_PARALLEL_MIN_SECONDS).
+    Cancelling the calling task stops the separation at the next chunk
+    boundary, unless other callers are still waiting on the same result.
+
     Args:
         audio_path: Path to the input audio file.
         model_name: Demucs model name (e.g., "htdemucs", "hdemucs_mmi", "mdx", "mdx_extra").
                     "demucs" in our API maps to "htdemucs" (default) or specific v3 models.
-    
+        on_progress: Optional callback, called with (segments_done, segments_total).
+        stems: Only compute and write these stems (default: all of SOURCES).
+        two_stems: Write <stem> and no_<stem> (mix minus stem) instead, like demucs --two-stems.
+        output_format: Stem file format, one of audio_encoding.available_formats().
+
     Returns:
         Dictionary mapping stem names to their file paths.
     """
-    # Map API model names to Demucs internal names if needed
-    if model_name == "demucs":
-        demucs_model = "htdemucs"
-    elif model_name == "ht_demucs":
-        demucs_model = "htdemucs"
-    elif model_name == "ht_demucs_ft":
-        demucs_model = "htdemucs_ft"
-    else:
-        demucs_model = model_name
-
-    output_path = OUTPUT_DIR / "demucs"
-    output_path.mkdir(exist_ok=True, parents=True)
-
-    # Construct command
-    # python -m demucs.separate -n <model> -o <output_dir> <audio_file>
-    # We use -m demucs.separate to ensure we use the same python environment
-    cmd = f"{sys.executable} -m demucs.separate -n {demucs_model} -o {shlex.quote(str(output_path))} {shlex.quote(audio_path)}"
-    
-    # Run in a subprocess to avoid blocking the event loop
-    # Note: Demucs is heavy, running it in a threadpool or process pool is better, 
-    # but subprocess is easiest for CLI wrapping which Demucs supports well.
-    process = await asyncio.create_subprocess_shell(
-        cmd,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE
-    )
+    demucs_model = resolve_model_name(model_name)
+    cache = get_cache()
 
-    stdout, stderr = await process.communicate()
+    loop = asyncio.get_running_loop()
+    content_hash = await loop.run_in_executor(None, hash_file, audio_path)
+    variant = _selection_variant(stems, two_stems)
+    if output_format != "wav":
+        variant.append(f"format={output_format}")
+    key = make_key(content_hash, demucs_model, *variant)
+    selection = {"stems": stems, "two_stems": two_stems}
 
-    if process.returncode != 0:
-        raise RuntimeError(f"Demucs failed: {stderr.decode()}")
+    entry_dir = cache.get(key)
+    if entry_dir is None:
+        sep = _inflight.get(key)
+        if sep is None:
+            sep = _Separation(get_manager().Event())
+            sep.future = asyncio.ensure_future(
+                _separate(sep, audio_path, demucs_model, key, selection, output_format)
+            )
+            sep.future.add_done_callback(functools.partial(_finished, key))
+            _inflight[key] = sep
 
-    # Demucs output structure: <output_dir>/<model_name>/<track_name>/<stem>.wav
-    track_name = Path(audio_path).stem
-    model_output_dir = output_path / demucs_model / track_name
-    
-    stems = {}
-    for stem in ["vocals", "drums", "bass", "other"]:
-        stem_path = model_output_dir / f"{stem}.wav"
-        if stem_path.exists():
-            # Return relative path or full path as needed. 
-            # For API response, we'll return the full path for now, 
-            # but in a real app we'd return a URL.
-            # We'll convert to a relative path from the static mount point.
-            # Mount point is /outputs -> OUTPUT_DIR
-            
-            # Relative to OUTPUT_DIR
-            rel_path = stem_path.relative_to(OUTPUT_DIR)
-            stems[stem] = f"/outputs/{rel_path}"
-    
-    return stems
+        sep.waiters += 1
+        if on_progress is not None:
+            sep.listeners.append(on_progress)
+        try:
+            # shield: one caller going away must not cancel a job others are waiting on
+            entry_dir = await asyncio.shield(sep.future)
+        except asyncio.CancelledError:
+            if sep.waiters == 1 and not sep.future.done():
+                sep.cancel.set()
+                # The worker only stops at its next chunk boundary: callers
+                # arriving until then start a fresh separation instead of
+                # joining this one and getting its cancellation
+                if _inflight.get(key) is sep:
+                    _inflight.pop(key)
+            raise
+        finally:
+            sep.waiters -= 1
+            if on_progress is not None:
+                sep.listeners.remove(on_progress)
+
+    return _stem_urls(entry_dir)
@@ -0,0 +1,426 @@
+"""
+Demucs worker-side code.
+Everything in this module runs inside the separation pool's worker processes
+(see app/services/demucs.py). Models are loaded once per process and reused
+for every job the worker picks up.
+"""
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import soundfile as sf
+
+from app.services import audio_encoding, pcm_cache
+
+# model name -> loaded demucs model (per worker process)
+_MODELS: Dict[str, object] = {}
+_DEVICE = "cpu"
+
+# Models named <pretrained name> + this suffix are loaded with their Linear/LSTM
+# layers dynamically quantized to int8 (CPU only)
+INT8_SUFFIX = "_int8"
+
+# Consecutive chunks overlap by this much and are joined with a linear crossfade
+CHUNK_OVERLAP_SECONDS = 1.0
+
+
+def init_worker(preload: List[str], torch_threads: int = 0) -> None:
+    """Pool initializer: pick the device, set threading and preload models."""
+    global _DEVICE
+    import torch
+
+    _DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+    if torch_threads > 0:
+        torch.set_num_threads(torch_threads)
+
+    for name in preload:
+        get_model(name)
+
+
+def is_quantized(name: str) -> bool:
+    return name.endswith(INT8_SUFFIX)
+
+
+def model_device(name: str) -> str:
+    # Quantized kernels only exist for the CPU
+    return "cpu" if is_quantized(name) else _DEVICE
+
+
+def _quantize(model):
+    """
+    Dynamic int8 quantization of the model's Linear and LSTM layers (the
+    transformer / BLSTM blocks, where most of the CPU time goes). Weights are
+    stored as int8 and activations quantized on the fly, so no calibration
+    data is needed. Works on bags of models too, as they are plain modules.
+    """
+    import torch
+
+    return torch.ao.quantization.quantize_dynamic(
+        model, {torch.nn.Linear, torch.nn.LSTM}, dtype=torch.qint8, inplace=True
+    )
+
+
+def get_model(name: str):
+    """Returns the cached model for this worker, loading it on first use."""
+    model = _MODELS.get(name)
+    if model is None:
+        from demucs.pretrained import get_model as load_pretrained
+
+        if is_quantized(name):
+            model = load_pretrained(name[:-len(INT8_SUFFIX)])
+            model.eval()
+            model = _quantize(model)
+        else:
+            model = load_pretrained(name)
+            model.eval()
+        model.to(model_device(name))
+        _MODELS[name] = model
+    return model
+
+
+def ping() -> bool:
+    """No-op job used to force the pool to spawn (and warm up) its workers."""
+    return True
+
+
+class SeparationCancelled(Exception):
+    """Raised inside a worker when the job's cancel event is set."""
+
+
+def chunk_bounds(length: int, chunk: int, overlap: int) -> List[Tuple[int, int]]:
+    """Splits [0, length) into chunks of `chunk` samples overlapping by `overlap`."""
+    if length <= chunk:
+        return [(0, length)]
+    bounds = []
+    start = 0
+    while True:
+        end = min(start + chunk, length)
+        bounds.append((start, end))
+        if end == length:
+            return bounds
+        start = end - overlap
+
+
+def chunk_size(chunk_seconds: float, samplerate: int) -> int:
+    return max(int(chunk_seconds * samplerate), 2 * chunk_overlap(samplerate))
+
+
+def chunk_overlap(samplerate: int) -> int:
+    return int(CHUNK_OVERLAP_SECONDS * samplerate)
+
+
+def _fade_in(n: int) -> np.ndarray:
+    return np.linspace(0, 1, n, dtype=np.float32)
+
+
+def output_names(sources: List[str], stems: Optional[List[str]] = None, two_stems: Optional[str] = None) -> List[str]:
+    """Stem files produced for a selection: all sources, a subset, or <stem> + no_<stem>."""
+    if two_stems:
+        return [two_stems, f"no_{two_stems}"]
+    if stems:
+        return list(stems)
+    return list(sources)
+
+
+def _select_model(model, needed: List[str]):
+    """
+    Drops the sub-models of a bag that don't contribute to any needed source.
+    htdemucs_ft is a bag of four single-source models, so asking for vocals
+    only runs one of them. Sources no remaining model covers come out as NaN
+    and must not be used.
+    """
+    from demucs.apply import BagOfModels
+
+    if not isinstance(model, BagOfModels):
+        return model
+    idx = [model.sources.index(name) for name in needed]
+    keep = [i for i, weights in enumerate(model.weights) if any(weights[k] for k in idx)]
+    if len(keep) == len(model.models):
+        return model
+    return BagOfModels([model.models[i] for i in keep], [model.weights[i] for i in keep])
+
+
+def _run_chunk(model, wav, mean: float, std: float, sources: List[str],
+               stems: Optional[List[str]], two_stems: Optional[str], device: str = "cpu"):
+    """
+    Separates one normalized chunk and returns only the requested outputs,
+    denormalized, as a (outputs, channels, samples) tensor.
+    The two-stem complement is the residual (mix - stem), so it needs no
+    inference of its own.
+    """
+    import torch
+    from demucs.apply import apply_model
+
+    with torch.no_grad():
+        out = apply_model(
+            model, wav[None], device=device, shifts=1, split=True, overlap=0.25, progress=False
+        )[0].cpu()
+    out = out * std + mean
+
+    if two_stems:
+        stem = out[sources.index(two_stems)]
+        return torch.stack([stem, wav * std + mean - stem])
+    if stems:
+        return out[[sources.index(name) for name in stems]]
+    return out
+
+
+def _cached_pcm(audio_path: str, model) -> Optional[np.ndarray]:
+    """The upload's memory-mapped PCM if it is cached at the model's rate and channel count."""
+    pcm = pcm_cache.cached(audio_path)
+    if pcm is None or pcm.sample_rate != model.samplerate or pcm.audio.shape[1] != model.audio_channels:
+        return None
+    return pcm.audio
+
+
+def separate(
+    audio_path: str,
+    model_name: str,
+    output_dir: str,
+    chunk_seconds: float = 30.0,
+    progress=None,
+    cancel=None,
+    stems: Optional[List[str]] = None,
+    two_stems: Optional[str] = None,
+    output_format: str = "wav",
+) -> List[str]:
+    """
+    Separates one track with an already-loaded model.
+    Mirrors what `python -m demucs.separate` does with default options, but runs
+    the model over fixed-size chunks so progress can be reported and the job
+    can be cancelled between chunks. Chunks overlap by one second and are
+    joined with a linear crossfade.
+
+    Args:
+        progress: Optional queue; receives {"segment": i, "segments": n} after each chunk.
+        cancel: Optional event; when set, the job stops at the next chunk boundary.
+        stems: Only compute and write these sources (default: all).
+        two_stems: Write <stem> and no_<stem> instead, like demucs --two-stems.
+        output_format: One of audio_encoding.FORMATS.
+
+    Returns:
+        Names of the stems written to output_dir as <stem>.<ext>.
+    """
+    import torch
+    from demucs.separate import load_track
+
+    if cancel is not None and cancel.is_set():
+        raise SeparationCancelled()
+
+    model = get_model(model_name)
+    sources = list(model.sources)
+    names = output_names(sources, stems, two_stems)
+    selected = _select_model(model, [two_stems] if two_stems else (stems or sources))
+
+    pcm = _cached_pcm(audio_path, model)
+    if pcm is not None:
+        wav = torch.from_numpy(np.ascontiguousarray(pcm.T))
+    else:
+        # load_track() calls sys.exit() when no backend can decode the file,
+        # which would otherwise surface as a bare SystemExit in the caller.
+        try:
+            wav = load_track(Path(audio_path), model.audio_channels, model.samplerate)
+        except SystemExit:
+            raise RuntimeError(f"Could not decode audio file: {audio_path}")
+
+    # Same normalization as demucs.separate
+    ref = wav.mean(0)
+    mean, std = ref.mean().item(), ref.std().item()
+    wav = (wav - mean) / std
+
+    length = wav.shape[-1]
+    overlap = chunk_overlap(model.samplerate)
+    bounds = chunk_bounds(length, chunk_size(chunk_seconds, model.samplerate), overlap)
+
+    outputs = torch.zeros(len(names), wav.shape[0], length)
+    for i, (start, end) in enumerate(bounds):
+        if cancel is not None and cancel.is_set():
+            raise SeparationCancelled()
+
+        out = _run_chunk(
+            selected, wav[:, start:end], mean, std, sources, stems, two_stems, model_device(model_name)
+        )
+
+        # Crossfade weights: ramp in over the overlap with the previous chunk,
+        # ramp out over the overlap with the next one. Ramps sum to 1.
+        weight = torch.ones(end - start)
+        if i > 0:
+            weight[:overlap] = torch.from_numpy(_fade_in(overlap))
+        if i < len(bounds) - 1:
+            weight[-overlap:] = torch.from_numpy(_fade_in(overlap)[::-1].copy())
+        outputs[..., start:end] += out * weight
+
+        if progress is not None:
+            progress.put({"segment": i + 1, "segments": len(bounds)})
+
+    out_dir = Path(output_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    for output, name in zip(outputs, names):
+        data = output.numpy().T
+        # Same as demucs' clip="rescale"
+        data = data / max(1.01 * float(np.abs(data).max()), 1.0)
+        audio_encoding.write_audio(
+            str(out_dir / audio_encoding.filename(name, output_format)), data, model.samplerate, output_format
+        )
+    return names
+
+
+# --- Segment-parallel mode ---
+# The track is decoded once to a float32 WAV (uploads already are, in the PCM
+# cache), then every segment is separated as an independent pool job that reads
+# only its own slice from disk. Segment results are stitched with the same
+# crossfade as separate(), so the stems match the sequential output while no
+# process holds more than a segment.
+
+def _pcm_blocks(pcm_path: str, blocksize: int):
+    if pcm_path.endswith(".npy"):
+        audio = np.load(pcm_path, mmap_mode="r")
+        for start in range(0, len(audio), blocksize):
+            yield audio[start:start + blocksize]
+    else:
+        yield from sf.blocks(pcm_path, blocksize=blocksize, dtype="float32", always_2d=True)
+
+
+def prepare_segments(audio_path: str, model_name: str, scratch_dir: str) -> Dict[str, Any]:
+    """
+    Makes the input readable by sample offset at the model's rate/channels and
+    computes the normalization statistics demucs.separate uses for the whole track.
+    """
+    model = get_model(model_name)
+    scratch = Path(scratch_dir)
+    scratch.mkdir(parents=True, exist_ok=True)
+
+    try:
+        info = sf.info(audio_path)
+        readable = info.samplerate == model.samplerate and info.channels == model.audio_channels
+    except RuntimeError:
+        readable = False
+
+    pcm = _cached_pcm(audio_path, model)
+    if pcm is not None:
+        # Segments slice the upload's decoded copy instead of each decoding their part
+        pcm_path = pcm.filename
+    elif readable:
+        pcm_path = audio_path
+    else:
+        # Needs resampling / channel conversion / a non-libsndfile decoder:
+        # decode once with demucs' own loader and keep it as float32 on disk.
+        from demucs.separate import load_track
+
+        try:
+            wav = load_track(Path(audio_path), model.audio_channels, model.samplerate)
+        except SystemExit:
+            raise RuntimeError(f"Could not decode audio file: {audio_path}")
+        pcm_path = str(scratch / "input.wav")
+        sf.write(pcm_path, wav.numpy().T, model.samplerate, subtype="FLOAT")
+        del wav
+
+    # Mean/std of the mono mix, accumulated block by block (std is unbiased, like torch)
+    count, total, total_sq = 0, 0.0, 0.0
+    for block in _pcm_blocks(pcm_path, model.samplerate * 10):
+        mono = block.mean(axis=1, dtype=np.float64)
+        count += len(mono)
+        total += mono.sum()
+        total_sq += np.square(mono).sum()
+    mean = total / max(count, 1)
+    var = (total_sq - count * mean * mean) / max(count - 1, 1)
+
+    return {
+        "path": pcm_path,
+        "frames": count,
+        "samplerate": model.samplerate,
+        "channels": model.audio_channels,
+        "sources": list(model.sources),
+        "mean": float(mean),
+        "std": float(np.sqrt(max(var, 0.0))) or 1.0,
+    }
+
+
+def separate_segment(
+    pcm_path: str,
+    model_name: str,
+    start: int,
+    end: int,
+    mean: float,
+    std: float,
+    out_path: str,
+    cancel=None,
+    stems: Optional[List[str]] = None,
+    two_stems: Optional[str] = None,
+) -> List[float]:
+    """
+    Separates samples [start, end) of a prepared track and saves the requested
+    outputs as a (outputs, channels, samples) .npy at out_path.
+
+    Returns:
+        Peak absolute value per output, used to pick the clipping rescale factor.
+    """
+    import torch
+
+    if cancel is not None and cancel.is_set():
+        raise SeparationCancelled()
+
+    model = get_model(model_name)
+    sources = list(model.sources)
+    selected = _select_model(model, [two_stems] if two_stems else (stems or sources))
+
+    if pcm_path.endswith(".npy"):
+        data = np.load(pcm_path, mmap_mode="r")[start:end]
+    else:
+        data, _ = sf.read(pcm_path, start=start, stop=end, dtype="float32", always_2d=True)
+    wav = (torch.from_numpy(data.T.copy()) - mean) / std
+    out = _run_chunk(selected, wav, mean, std, sources, stems, two_stems, model_device(model_name)).numpy()
+
+    np.save(out_path, out)
+    return np.abs(out).max(axis=(1, 2)).tolist()
+
+
+def stitch_segments(
+    segment_paths: List[str],
+    bounds: List[Tuple[int, int]],
+    names: List[str],
+    peaks: List[float],
+    samplerate: int,
+    channels: int,
+    output_dir: str,
+    output_format: str = "wav",
+) -> List[str]:
+    """
+    Overlap-adds segment results into one encoded file per stem, streaming
+    segment by segment. Each output is rescaled the way demucs' clip="rescale"
+    does it, using the peaks reported by separate_segment().
+    """
+    out_dir = Path(output_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    overlap = chunk_overlap(samplerate)
+    fade_in = _fade_in(overlap)
+    fade_out = fade_in[::-1].copy()
+    scales = np.array([1.0 / max(1.01 * p, 1.0) for p in peaks], dtype=np.float32)[:, None, None]
+
+    writers = [
+        audio_encoding.open_writer(
+            str(out_dir / audio_encoding.filename(name, output_format)), output_format, samplerate, channels
+        )
+        for name in names
+    ]
+    try:
+        carry: Optional[np.ndarray] = None
+        last = len(bounds) - 1
+        for i, path in enumerate(segment_paths):
+            seg = np.load(path)
+            if i > 0:
+                seg[..., :overlap] = seg[..., :overlap] * fade_in + carry
+            if i < last:
+                carry = seg[..., -overlap:] * fade_out
+                seg = seg[..., :-overlap]
+            seg = seg * scales
+            for writer, stem in zip(writers, seg):
+                writer.write(stem.T)
+            os.remove(path)
+    finally:
+        for writer in writers:
+            writer.close()
+
+    return list(names)
@@ -0,0 +1,164 @@
+"""
+Dedicated pools for CPU-bound services.
+
+Blocking work (Essentia, Matchering, Pedalboard, Rubberband, ...) must not run
+on the event loop, or one request stalls every other route of the server.
+Each service gets its own pool from SERVICE_POOLS (app/config.py):
+
+- kind: "process" for code that holds the GIL, "thread" for code that
+  releases it or mostly waits on a subprocess (no pickling of inputs);
+- workers: how many of the service's jobs run at once; the rest wait in
+  the service's queue, so one busy service can't starve the others;
+- timeout: seconds a caller waits for a job before getting JobTimeoutError.
+  A timed-out job can't be killed mid-way, so it keeps its slot until it
+  actually finishes and the concurrency limit still holds.
+
+Queue depth and job counters per pool are reported by stats().
+"""
+import asyncio
+import functools
+import logging
+import multiprocessing
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Optional
+
+from app.config import SERVICE_POOLS
+
+logger = logging.getLogger(__name__)
+
+
+class JobTimeoutError(Exception):
+    pass
+
+
+class ServicePool:
+    def __init__(self, name: str, kind: str, workers: int, timeout: float = 0):
+        if kind not in ("process", "thread"):
+            raise ValueError(f"Unknown pool kind: {kind}")
+        self.name = name
+        self.kind = kind
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self._executor: Optional[Executor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.timed_out = 0
+        self._busy_seconds = 0.0
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.kind == "process":
+                # spawn: forked copies of a server that already has threads (and maybe torch) are fragile
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=self.name)
+        return self._executor
+
+    def _release(self, started: float, future: "asyncio.Future") -> None:
+        self.running -= 1
+        self._busy_seconds += time.monotonic() - started
+        self._slots.release()
+
+    async def run(self, fn: Callable, *args, timeout: Optional[float] = None, **kwargs) -> Any:
+        """
+        Runs fn(*args, **kwargs) on the pool once a slot is free.
+        Raises JobTimeoutError after `timeout` seconds (default: the pool's; 0 = none).
+        """
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+        timeout = self.timeout if timeout is None else timeout
+
+        self.queued += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.queued -= 1
+
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        self.running += 1
+        executor = self._get_executor()
+        try:
+            future = loop.run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+        except BaseException:
+            self.running -= 1
+            self._slots.release()
+            raise
+        # The slot is held until the job really ends, not when the caller stops waiting
+        future.add_done_callback(functools.partial(self._release, started))
+
+        try:
+            result = await asyncio.wait_for(asyncio.shield(future), timeout or None)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            raise JobTimeoutError(f"{self.name} job timed out after {timeout:g}s")
+        except BrokenProcessPool:
+            # A worker died (crash, OOM kill); the next job gets a fresh pool.
+            # Every job that was on the broken pool ends up here, only drop it once.
+            self.failed += 1
+            if self._executor is executor:
+                logger.error(f"{self.name} pool broke; restarting it")
+                self.shutdown()
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+        self.completed += 1
+        return result
+
+    async def start(self, fn: Callable) -> None:
+        """Spawns all workers up front, each running fn (e.g. to import its libraries)."""
+        try:
+            await asyncio.gather(*(self.run(fn, timeout=0) for _ in range(self.workers)))
+        except Exception as e:
+            # Not fatal: the workers are started by the first job instead
+            logger.error(f"{self.name} pool failed to start: {e}")
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> Dict[str, Any]:
+        finished = self.completed + self.failed
+        return {
+            "kind": self.kind,
+            "workers": self.workers,
+            "timeout": self.timeout,
+            "queued": self.queued,
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "timed_out": self.timed_out,
+            "avg_seconds": round(self._busy_seconds / finished, 3) if finished else None,
+        }
+
+
+pools: Dict[str, ServicePool] = {
+    name: ServicePool(name, **settings) for name, settings in SERVICE_POOLS.items()
+}
+
+
+def get_pool(name: str) -> ServicePool:
+    return pools[name]
+
+
+async def run(service: str, fn: Callable, *args, **kwargs) -> Any:
+    """Runs fn on the named service's pool (see ServicePool.run)."""
+    return await pools[service].run(fn, *args, **kwargs)
+
+
+def stats() -> Dict[str, Dict[str, Any]]:
+    return {name: pool.stats() for name, pool in pools.items()}
+
+
+def shutdown() -> None:
+    for pool in pools.values():
+        pool.shutdown()
@@ -1,10 +1,21 @@
 import aiofiles
-from fastapi import UploadFile
+from fastapi import HTTPException, UploadFile
 from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+import io
 import shutil
+import time
+import zipfile
+import uuid
+from app.config import UPLOAD_DIR
+from app.services import ingest, storage, upload_store
 
 async def save_upload_file(upload_file: UploadFile, destination: Path) -> Path:
     """Saves an uploaded file to the destination path."""
+    if isinstance(upload_file, ingest.IngestFile):
+        # Already streamed to disk while the request arrived: moved, not copied
+        ingest.claim(upload_file, destination)
+        return destination
     try:
         async with aiofiles.open(destination, 'wb') as out_file:
             while content := await upload_file.read(1024 * 1024):  # Read in 1MB chunks
@@ -16,3 +27,88 @@ async def save_upload_file(upload_file: UploadFile, destination: Path) -> Path:
             shutil.copyfileobj(upload_file.file, buffer)
             
     return destination
+
+
+async def find_upload(file_id: str) -> Optional[Path]:
+    """Path of a file stored by /upload/audio, or None."""
+    upload = upload_store.get_store().get(file_id)
+    if upload is None:
+        return None
+    await storage.get_manager().atouch(upload.path)
+    return upload.path
+
+
+FILE_ID_DESCRIPTION = "file_id from /upload/audio, instead of sending the file again"
+
+
+async def input_upload(file: Optional[UploadFile], file_id: Optional[str]) -> Optional[upload_store.Upload]:
+    """
+    For endpoints that take either an uploaded `file` or the `file_id` of a stored
+    upload: the stored upload, or None when the audio was sent in `file`.
+    """
+    if isinstance(file, str) or (file is not None and not file.filename):
+        # Form clients send an empty string or an unnamed part for an empty file field
+        file = None
+    if (file is None) == (not file_id):
+        raise HTTPException(status_code=400, detail="Send either a file or a file_id.")
+    if file is not None:
+        return None
+    upload = upload_store.get_store().get(file_id)
+    if upload is None or not upload.path.exists():
+        raise HTTPException(status_code=404, detail=f"File not found: {file_id}")
+    await storage.get_manager().atouch(upload.path)
+    return upload
+
+
+async def input_file(file: Optional[UploadFile], file_id: Optional[str], prefix: str = "") -> Tuple[Path, str]:
+    """
+    (path, original name) of an endpoint's input audio: the stored upload for
+    `file_id`, or the sent `file` saved under UPLOAD_DIR as a scratch file, which
+    is deleted once released (see storage.StorageManager.ausing()).
+    """
+    upload = await input_upload(file, file_id)
+    if upload is not None:
+        return upload.path, upload.original_name
+    # Unique name, so concurrent uploads of e.g. "mix.wav" don't clobber each other
+    path = UPLOAD_DIR / f"{uuid.uuid4().hex}_{prefix}{file.filename}"
+    await save_upload_file(file, path)
+    await storage.get_manager().atrack(path, storage.SCRATCH)
+    return path, file.filename
+
+
+class _ZipSink(io.RawIOBase):
+    """Unseekable write target that hands back whatever zipfile wrote since the last pop()."""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def pop(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def iter_zip(files: List[Tuple[str, Path]], chunk_size: int = 1024 * 1024) -> Iterator[bytes]:
+    """
+    Streams a zip archive of `files` ((name in archive, path) pairs) chunk by chunk,
+    without building the archive in memory or on disk. Entries are stored
+    uncompressed: audio doesn't deflate well and compressed formats not at all.
+    """
+    sink = _ZipSink()
+    # zipfile detects that the sink can't seek and writes data descriptors instead
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_STORED) as archive:
+        for arcname, path in files:
+            info = zipfile.ZipInfo(arcname, date_time=time.localtime(path.stat().st_mtime)[:6])
+            with open(path, "rb") as src, archive.open(info, "w", force_zip64=True) as dst:
+                while chunk := src.read(chunk_size):
+                    dst.write(chunk)
+                    yield sink.pop()
+            yield sink.pop()
+    yield sink.pop()
@@ -0,0 +1,193 @@
+"""
+Single-copy ingest of uploaded files.
+
+Starlette spools every multipart file part to a temporary file, which the
+endpoints then copied to where they keep it. Routes built with IngestRoute
+parse the body with IngestParser instead: each file part is streamed straight
+to a file in INGEST_DIR (on the same filesystem as UPLOAD_DIR), and its
+SHA-256 and audio header are computed from the same chunks on the way.
+
+Endpoints receive an IngestFile, a regular UploadFile with .path, .sha256 and
+.info, and either claim() it (a rename into its final place) or read it in
+place. Unclaimed files are deleted when FastAPI closes the form, after the
+response has been sent.
+
+The parser hooks into Starlette internals (Request._get_form and the parser's
+current part); Starlette is pinned in requirements.txt for that. On a version
+without them, routes fall back to Starlette's own parsing and endpoints get a
+plain UploadFile, which they handle as before.
+"""
+import hashlib
+import inspect
+import io
+import os
+import shutil
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import soundfile as sf
+from fastapi import Request, Response
+from fastapi.routing import APIRoute
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import FormData, Headers, UploadFile
+from starlette.exceptions import HTTPException
+from starlette.formparsers import MultiPartException, MultiPartParser
+
+from app.config import INGEST_DIR
+
+# Bytes kept from the start of each file to probe its audio header
+PROBE_BYTES = 64 * 1024
+# Formats whose header states the length in frames
+SIZED_FORMATS = {"FLAC", "CAF"}
+# Bytes per sample of uncompressed subtypes, whose length follows from the file size.
+# For the rest (MP3, Ogg, ...) the duration can't be known without decoding.
+PCM_SAMPLE_BYTES = {"PCM_S8": 1, "PCM_U8": 1, "PCM_16": 2, "PCM_24": 3, "PCM_32": 4, "FLOAT": 4, "DOUBLE": 8}
+
+# Whether this Starlette has the internals IngestRequest overrides (see module docstring)
+SUPPORTED = (
+    hasattr(MultiPartParser, "on_headers_finished")
+    and hasattr(Request, "_get_form")
+    and "max_part_size" in inspect.signature(Request._get_form).parameters
+)
+
+
+class IngestFile(UploadFile):
+    """An uploaded file written straight to disk, hashed and probed while it arrives."""
+
+    def __init__(self, path: Path, filename: Optional[str], headers: Headers):
+        super().__init__(open(path, "w+b"), size=0, filename=filename, headers=headers)
+        self.path = path
+        self.claimed = False
+        self._digest = hashlib.sha256()
+        self._head = bytearray()
+        self._info: Optional[Dict[str, Any]] = None
+        self._probed = False
+
+    def _write(self, data: bytes) -> None:
+        self._digest.update(data)
+        if len(self._head) < PROBE_BYTES:
+            self._head += data[:PROBE_BYTES - len(self._head)]
+        self.file.write(data)
+
+    async def write(self, data: bytes) -> None:
+        self.size += len(data)
+        await run_in_threadpool(self._write, data)
+
+    @property
+    def sha256(self) -> str:
+        """Hex SHA-256 of the content received so far (all of it once the form is parsed)."""
+        return self._digest.hexdigest()
+
+    @property
+    def info(self) -> Optional[Dict[str, Any]]:
+        """
+        Format, sample rate, channels and (where it follows from the header) duration
+        of the complete file; None if it isn't audio libsndfile reads.
+        """
+        if not self._probed:
+            self._probed = True
+            try:
+                info = sf.info(io.BytesIO(bytes(self._head)))
+            except (sf.LibsndfileError, RuntimeError):
+                return None
+            # Probing only the head, libsndfile counts the frames in it, not in the file
+            duration = None
+            if info.format in SIZED_FORMATS:
+                duration = info.duration
+            elif info.subtype in PCM_SAMPLE_BYTES:
+                frame_bytes = PCM_SAMPLE_BYTES[info.subtype] * info.channels
+                duration = (info.frames + (self.size - len(self._head)) // frame_bytes) / info.samplerate
+            self._info = {
+                "format": info.format,
+                "subtype": info.subtype,
+                "sample_rate": info.samplerate,
+                "channels": info.channels,
+                "duration": duration,
+            }
+        return self._info
+
+    async def close(self) -> None:
+        await super().close()
+        if not self.claimed:
+            self.path.unlink(missing_ok=True)
+
+
+def claim(upload: IngestFile, dest: Path) -> Path:
+    """Moves an ingested file to dest (a rename on the same filesystem) and keeps it."""
+    shutil.move(str(upload.path), str(dest))
+    upload.path = Path(dest)
+    upload.claimed = True
+    return upload.path
+
+
+class IngestParser(MultiPartParser):
+    """Starlette's multipart parser with file parts written to INGEST_DIR instead of spooled."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._ingested: List[IngestFile] = []
+
+    def on_headers_finished(self) -> None:
+        super().on_headers_finished()
+        part = getattr(self, "_current_part", None)
+        to_close = getattr(self, "_files_to_close_on_error", None)
+        spooled = getattr(part, "file", None)
+        if spooled is None or to_close is None or spooled.file not in to_close:
+            # A form field, or internals this version doesn't have: left to Starlette
+            return
+        # Replace the spooled temporary file Starlette just created (still empty)
+        spooled.file.close()
+        to_close.remove(spooled.file)
+        ext = os.path.splitext(spooled.filename or "")[1]
+        INGEST_DIR.mkdir(parents=True, exist_ok=True)
+        upload = IngestFile(INGEST_DIR / f"{uuid.uuid4().hex}{ext}", spooled.filename, spooled.headers)
+        self._ingested.append(upload)
+        self._current_part.file = upload
+
+    def _discard(self, uploads: List[IngestFile]) -> None:
+        for upload in uploads:
+            upload.file.close()
+            upload.path.unlink(missing_ok=True)
+
+    async def parse(self) -> FormData:
+        try:
+            form = await super().parse()
+        except BaseException:
+            # Malformed body or client gone: drop what was written
+            self._discard(self._ingested)
+            raise
+        # A part cut off by the end of the body never made it into the form
+        kept = {id(value) for _, value in form.multi_items()}
+        self._discard([upload for upload in self._ingested if id(upload) not in kept])
+        return form
+
+
+class IngestRequest(Request):
+    async def _get_form(self, *, max_files=1000, max_fields=1000, max_part_size=1024 * 1024) -> FormData:
+        # Same as Starlette's, with IngestParser for multipart bodies
+        content_type = self.headers.get("Content-Type", "")
+        if self._form is None and content_type.startswith("multipart/form-data"):
+            parser = IngestParser(
+                self.headers, self.stream(),
+                max_files=max_files, max_fields=max_fields, max_part_size=max_part_size,
+            )
+            try:
+                self._form = await parser.parse()
+            except MultiPartException as exc:
+                raise HTTPException(status_code=400, detail=exc.message)
+        return await super()._get_form(max_files=max_files, max_fields=max_fields, max_part_size=max_part_size)
+
+
+class IngestRoute(APIRoute):
+    """Route class whose file uploads arrive as IngestFile (see module docstring)."""
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        if not SUPPORTED:
+            return handler
+
+        async def ingest_handler(request: Request) -> Response:
+            return await handler(IngestRequest(request.scope, request.receive))
+
+        return ingest_handler
@@ -0,0 +1,352 @@
+"""
+Asynchronous stem separation jobs.
+
+Jobs are queued by priority (then FIFO) and picked up by a fixed number of
+runner tasks, which bounds how many separations run at once. Clients poll a
+job's status or subscribe to its progress events; cancelling a running job
+stops the separation at the next chunk boundary.
+
+A batch job separates many tracks as one queue entry, keeping the pool busy
+with several of its tracks at a time and publishing each track's result as
+soon as it is done.
+"""
+import asyncio
+import itertools
+import time
+import uuid
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import soundfile as sf
+
+from app.config import (
+    STEM_JOB_CONCURRENCY, STEM_JOB_MAX_QUEUE, STEM_JOB_TTL_SECONDS, STEM_BATCH_CONCURRENCY,
+)
+from app.models import StemJobResponse, StemBatchResponse, StemBatchTrack
+from app.services import demucs, storage
+from app.services.demucs_worker import SeparationCancelled
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+FINAL_STATES = {DONE, FAILED, CANCELLED}
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, audio_path: Optional[str], model_name: str, priority: int = 0, **options):
+        self.id = uuid.uuid4().hex
+        self.audio_path = audio_path
+        self.model_name = model_name
+        # Extra keyword arguments for demucs.run_model (stem selection, ...)
+        self.options = options
+        self.priority = priority
+        self.status = QUEUED
+        self.segments_done = 0
+        self.segments_total = 0
+        self.stems: Optional[Dict[str, str]] = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+        self._subscribers: List[asyncio.Queue] = []
+
+    @property
+    def paths(self) -> List[str]:
+        """Files the job reads; pinned while it is queued or running."""
+        return [self.audio_path]
+
+    @property
+    def progress(self) -> float:
+        if self.status == DONE:
+            return 1.0
+        if not self.segments_total:
+            return 0.0
+        return self.segments_done / self.segments_total
+
+    def to_response(self) -> StemJobResponse:
+        processing_time = None
+        if self.started_at is not None:
+            processing_time = (self.finished_at or time.time()) - self.started_at
+        return StemJobResponse(
+            job_id=self.id,
+            status=self.status,
+            model=self.model_name,
+            priority=self.priority,
+            progress=self.progress,
+            segments_done=self.segments_done,
+            segments_total=self.segments_total,
+            stems=self.stems,
+            archive_url=demucs.archive_url(self.stems),
+            processing_time=processing_time,
+            error=self.error,
+        )
+
+    def publish(self) -> None:
+        """Pushes the current state to every subscriber."""
+        state = self.to_response()
+        for q in self._subscribers:
+            q.put_nowait(state)
+
+    def on_progress(self, done: int, total: int) -> None:
+        self.segments_done = done
+        self.segments_total = total
+        self.publish()
+
+    async def run(self) -> None:
+        self.stems = await demucs.run_model(
+            self.audio_path, self.model_name, on_progress=self.on_progress, **self.options
+        )
+
+
+class BatchTrack:
+    def __init__(self, name: str, audio_path: str):
+        self.name = name
+        self.audio_path = audio_path
+        self.status = QUEUED
+        self.segments_done = 0
+        self.segments_total = 0
+        self.duration: Optional[float] = None
+        self.stems: Optional[Dict[str, str]] = None
+        self.error: Optional[str] = None
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    @property
+    def progress(self) -> float:
+        if self.status == DONE:
+            return 1.0
+        if not self.segments_total:
+            return 0.0
+        return self.segments_done / self.segments_total
+
+    def to_response(self) -> StemBatchTrack:
+        processing_time = None
+        if self.started_at is not None:
+            processing_time = (self.finished_at or time.time()) - self.started_at
+        return StemBatchTrack(
+            name=self.name,
+            status=self.status,
+            progress=self.progress,
+            duration=self.duration,
+            stems=self.stems,
+            archive_url=demucs.archive_url(self.stems),
+            processing_time=processing_time,
+            error=self.error,
+        )
+
+
+def _duration(audio_path: str) -> Optional[float]:
+    try:
+        return sf.info(audio_path).duration
+    except RuntimeError:
+        return None
+
+
+class BatchJob(Job):
+    """
+    Many tracks separated as one job. Up to `concurrency` tracks are in flight
+    at once so the pool's workers (and their loaded models) stay busy; a track
+    failing doesn't stop the others.
+    """
+
+    def __init__(self, tracks: List[Tuple[str, str]], model_name: str, priority: int = 0,
+                 concurrency: int = 1, **options):
+        super().__init__(None, model_name, priority, **options)
+        self.tracks = [BatchTrack(name, path) for name, path in tracks]
+        self.concurrency = max(1, concurrency)
+
+    @property
+    def paths(self) -> List[str]:
+        return [track.audio_path for track in self.tracks]
+
+    @property
+    def progress(self) -> float:
+        if self.status == DONE:
+            return 1.0
+        return sum(track.progress for track in self.tracks) / len(self.tracks)
+
+    def to_response(self) -> StemBatchResponse:
+        processing_time = None
+        if self.started_at is not None:
+            processing_time = (self.finished_at or time.time()) - self.started_at
+        done = [t for t in self.tracks if t.status == DONE]
+        audio_seconds = sum(t.duration or 0.0 for t in done)
+        return StemBatchResponse(
+            job_id=self.id,
+            status=self.status,
+            model=self.model_name,
+            priority=self.priority,
+            progress=self.progress,
+            tracks_total=len(self.tracks),
+            tracks_done=len(done),
+            tracks_failed=sum(t.status == FAILED for t in self.tracks),
+            tracks=[t.to_response() for t in self.tracks],
+            audio_seconds=audio_seconds,
+            processing_time=processing_time,
+            # Seconds of audio separated per second of wall time
+            realtime_factor=audio_seconds / processing_time if processing_time else None,
+            error=self.error,
+        )
+
+    async def _run_track(self, track: BatchTrack, slots: asyncio.Semaphore) -> None:
+        async with slots:
+            track.status = RUNNING
+            track.started_at = time.time()
+            loop = asyncio.get_running_loop()
+            track.duration = await loop.run_in_executor(None, _duration, track.audio_path)
+            self.publish()
+
+            def on_progress(done: int, total: int) -> None:
+                track.segments_done = done
+                track.segments_total = total
+                self.publish()
+
+            try:
+                track.stems = await demucs.run_model(
+                    track.audio_path, self.model_name, on_progress=on_progress, **self.options
+                )
+                track.status = DONE
+            except (asyncio.CancelledError, SeparationCancelled):
+                track.status = CANCELLED
+                raise
+            except Exception as e:
+                track.status = FAILED
+                track.error = str(e)
+            finally:
+                track.finished_at = time.time()
+                self.publish()
+
+    async def run(self) -> None:
+        slots = asyncio.Semaphore(self.concurrency)
+        tasks = [asyncio.create_task(self._run_track(track, slots)) for track in self.tracks]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for track in self.tracks:
+                if track.status == QUEUED:
+                    track.status = CANCELLED
+            raise
+        if all(track.status == FAILED for track in self.tracks):
+            raise RuntimeError("All tracks failed")
+
+
+class JobManager:
+    def __init__(self, concurrency: int, max_queue: int, ttl_seconds: int):
+        self.concurrency = max(1, concurrency)
+        self.max_queue = max_queue
+        self.ttl_seconds = ttl_seconds
+        self._jobs: Dict[str, Job] = {}
+        # (-priority, sequence, job): higher priority first, FIFO within a priority
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._seq = itertools.count()
+        self._runners: List[asyncio.Task] = []
+
+    def start(self) -> None:
+        # The queue is created here so it binds to the server's event loop
+        self._queue = asyncio.PriorityQueue()
+        self._runners = [asyncio.create_task(self._run()) for _ in range(self.concurrency)]
+
+    async def stop(self) -> None:
+        for runner in self._runners:
+            runner.cancel()
+        await asyncio.gather(*self._runners, return_exceptions=True)
+        self._runners = []
+
+    async def submit(self, audio_path: str, model_name: str, priority: int = 0, **options) -> Job:
+        return await self._enqueue(Job(audio_path, model_name, priority, **options))
+
+    async def submit_batch(self, tracks: List[Tuple[str, str]], model_name: str, priority: int = 0, **options) -> BatchJob:
+        """Queues (name, audio path) pairs as a single job."""
+        return await self._enqueue(
+            BatchJob(tracks, model_name, priority, concurrency=STEM_BATCH_CONCURRENCY, **options)
+        )
+
+    async def _enqueue(self, job: Job) -> Job:
+        self._prune()
+        if self._queue.qsize() >= self.max_queue:
+            raise QueueFullError(f"Job queue is full ({self.max_queue} jobs waiting)")
+        self._jobs[job.id] = job
+        # Pinned before a runner can pick it up
+        await storage.get_manager().apin(*job.paths)
+        self._queue.put_nowait((-job.priority, next(self._seq), job))
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    async def cancel(self, job: Job) -> None:
+        if job.status == QUEUED:
+            # Runners skip cancelled jobs when they reach the front of the queue
+            await self._finish(job, CANCELLED)
+        elif job.status == RUNNING and job.task is not None:
+            job.task.cancel()
+
+    async def subscribe(self, job: Job) -> AsyncIterator[StemJobResponse]:
+        """Yields the job's state now and after every change, until it finishes."""
+        q: asyncio.Queue = asyncio.Queue()
+        job._subscribers.append(q)
+        try:
+            state = job.to_response()
+            yield state
+            while state.status not in FINAL_STATES:
+                state = await q.get()
+                yield state
+        finally:
+            job._subscribers.remove(q)
+
+    async def _finish(self, job: Job, status: str, error: Optional[str] = None) -> None:
+        if job.status in FINAL_STATES:
+            # Shutdown cancelled the runner while it was releasing the job's files
+            return
+        job.status = status
+        job.error = error
+        job.finished_at = time.time()
+        # Request uploads the job was given are deleted here
+        await storage.get_manager().arelease(*job.paths)
+        job.publish()
+
+    def _prune(self) -> None:
+        cutoff = time.time() - self.ttl_seconds
+        for job_id, job in list(self._jobs.items()):
+            if job.finished_at is not None and job.finished_at < cutoff:
+                del self._jobs[job_id]
+
+    async def _run(self) -> None:
+        while True:
+            _, _, job = await self._queue.get()
+            if job.status != QUEUED:
+                continue
+
+            job.status = RUNNING
+            job.started_at = time.time()
+            job.publish()
+            job.task = asyncio.create_task(job.run())
+            try:
+                await job.task
+                await self._finish(job, DONE)
+            except asyncio.CancelledError:
+                if not job.task.cancelled():
+                    # The runner itself is being cancelled (shutdown)
+                    job.task.cancel()
+                    await self._finish(job, CANCELLED)
+                    raise
+                await self._finish(job, CANCELLED)
+            except SeparationCancelled:
+                await self._finish(job, CANCELLED)
+            except Exception as e:
+                await self._finish(job, FAILED, str(e))
+            finally:
+                job.task = None
+
+
+stem_jobs = JobManager(STEM_JOB_CONCURRENCY, STEM_JOB_MAX_QUEUE, STEM_JOB_TTL_SECONDS)
@@ -0,0 +1,254 @@
+"""
+Streaming loudness and true-peak metering (EBU R128 / ITU-R BS.1770-4).
+
+LoudnessMeter takes audio in blocks of any size and keeps only per-100ms
+energies and filter state, so hour-long files are measured in constant
+memory. measure_file() feeds it fixed-size chunks read from disk (or from a
+file-like object, e.g. a rendered buffer).
+
+Measures:
+- integrated: gated programme loudness, LUFS
+- momentary_max / short_term_max: loudest 400ms / 3s window, LUFS
+- loudness_range: LRA, LU
+- true_peak: peak of the 4x oversampled signal (2x at 96 kHz and up), dBTP
+- sample_peak: dBFS
+
+Loudness values are None when nothing is above the absolute gate (silence,
+or audio shorter than one 400ms block).
+"""
+import math
+from typing import Any, BinaryIO, Dict, List, Optional, Union
+
+import essentia
+import essentia.standard as es
+import numpy as np
+import soundfile as sf
+from numpy.lib.stride_tricks import sliding_window_view
+
+from app.services import pcm_cache
+
+# Loudness is computed from 100ms sub-blocks: momentary windows are 4 of
+# them, short-term windows 30, both with a 100ms hop.
+SUB_BLOCK_SECONDS = 0.1
+MOMENTARY_BLOCKS = 4
+SHORT_TERM_BLOCKS = 30
+ABSOLUTE_GATE = -70.0  # LUFS
+RELATIVE_GATE = -10.0  # LU below the absolute-gated loudness (integrated)
+LRA_RELATIVE_GATE = -20.0
+LRA_PERCENTILES = (10, 95)
+# Channel weights for 5 and 5.1 layouts (L, R, C, [LFE,] Ls, Rs); everything else is weighted 1
+SURROUND_WEIGHTS = {5: [1.0, 1.0, 1.0, 1.41, 1.41], 6: [1.0, 1.0, 1.0, 0.0, 1.41, 1.41]}
+
+# True peak: polyphase interpolation, TRUE_PEAK_TAPS taps per phase
+TRUE_PEAK_TAPS = 12
+TRUE_PEAK_SEGMENT = 4096
+
+# measure_file() chunk size, in frames
+CHUNK_FRAMES = 65536
+
+
+def _k_weighting(sample_rate: float):
+    """The two BS.1770 K-weighting biquads (high shelf, then high-pass) for any sample rate."""
+    # Analog prototypes from libebur128, bilinear-transformed at this rate
+    f0, gain_db, q = 1681.974450955533, 3.999843853973347, 0.7071752369554196
+    k = math.tan(math.pi * f0 / sample_rate)
+    vh = 10 ** (gain_db / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf = (
+        [(vh + vb * k / q + k * k) / a0, 2 * (k * k - vh) / a0, (vh - vb * k / q + k * k) / a0],
+        [1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0],
+    )
+    f0, q = 38.13547087602444, 0.5003270373238773
+    k = math.tan(math.pi * f0 / sample_rate)
+    a0 = 1 + k / q + k * k
+    highpass = (
+        [1.0, -2.0, 1.0],
+        [1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0],
+    )
+    return shelf, highpass
+
+
+def _oversampling_filter(factor: int) -> np.ndarray:
+    """
+    Interpolation filter as a (TRUE_PEAK_TAPS, factor) matrix: column p gives
+    output phase p from the last TRUE_PEAK_TAPS input samples, oldest first.
+    """
+    n = np.arange(TRUE_PEAK_TAPS * factor)
+    center = (len(n) - 1) / 2
+    h = np.sinc((n - center) / factor) * np.kaiser(len(n), 5.0)
+    phases = h.reshape(TRUE_PEAK_TAPS, factor)[::-1]
+    phases = phases / phases.sum(axis=0)  # unity DC gain per phase
+    return np.ascontiguousarray(phases, dtype=np.float32)
+
+
+def _lufs(energy: np.ndarray) -> np.ndarray:
+    with np.errstate(divide="ignore"):
+        return -0.691 + 10 * np.log10(energy)
+
+
+def _db(value: float) -> Optional[float]:
+    return 20 * math.log10(value) if value > 0 else None
+
+
+class LoudnessMeter:
+    """BS.1770 meter for audio fed in blocks of shape (frames, channels)."""
+
+    def __init__(self, sample_rate: float, channels: int):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        shelf, highpass = _k_weighting(sample_rate)
+        # Essentia's IIR keeps its state between calls, so blocks join seamlessly
+        self._filters = [
+            (
+                es.IIR(numerator=essentia.array(shelf[0]), denominator=essentia.array(shelf[1])),
+                es.IIR(numerator=essentia.array(highpass[0]), denominator=essentia.array(highpass[1])),
+            )
+            for _ in range(channels)
+        ]
+        self._weights = np.asarray(SURROUND_WEIGHTS.get(channels, [1.0] * channels), dtype=np.float64)
+        self._sub_block = max(1, int(round(SUB_BLOCK_SECONDS * sample_rate)))
+        self._carry = np.zeros(0)  # weighted power of samples not yet in a complete sub-block
+        self._energies: List[float] = []
+
+        self._oversampling = 4 if sample_rate < 96000 else 2 if sample_rate < 192000 else 1
+        self._interpolation = _oversampling_filter(self._oversampling)
+        # Worst-case gain of the interpolator: segments that can't beat the
+        # current peak are skipped
+        self._interpolation_gain = float(np.abs(self._interpolation).sum(axis=0).max())
+        self._history = np.zeros((TRUE_PEAK_TAPS - 1, channels), dtype=np.float32)
+        self._true_peak = 0.0
+        self._sample_peak = 0.0
+
+    def process(self, block: np.ndarray) -> None:
+        block = np.asarray(block, dtype=np.float32)
+        if block.ndim == 1:
+            block = block[:, np.newaxis]
+        if len(block) == 0:
+            return
+
+        # Loudness: K-weighted, channel-weighted power per 100ms sub-block
+        power = np.zeros(len(block))
+        for channel, (shelf, highpass) in enumerate(self._filters):
+            weighted = highpass(shelf(essentia.array(block[:, channel])))
+            power += self._weights[channel] * np.square(weighted, dtype=np.float64)
+        power = np.concatenate([self._carry, power])
+        complete = len(power) // self._sub_block * self._sub_block
+        if complete:
+            self._energies.extend(power[:complete].reshape(-1, self._sub_block).mean(axis=1))
+        self._carry = power[complete:]
+
+        self._sample_peak = max(self._sample_peak, float(np.abs(block).max()))
+        self._update_true_peak(block)
+
+    def _update_true_peak(self, block: np.ndarray) -> None:
+        samples = np.concatenate([self._history, block])
+        self._history = samples[-(TRUE_PEAK_TAPS - 1):]
+        self._true_peak = max(self._true_peak, self._sample_peak)
+        if self._oversampling == 1:
+            return
+        for start in range(0, len(block), TRUE_PEAK_SEGMENT):
+            segment = samples[start:start + TRUE_PEAK_SEGMENT + TRUE_PEAK_TAPS - 1]
+            if float(np.abs(segment).max()) * self._interpolation_gain <= self._true_peak:
+                continue
+            # (frames, channels, taps) -> (frames, channels, phases)
+            windows = sliding_window_view(segment, TRUE_PEAK_TAPS, axis=0)
+            self._true_peak = max(self._true_peak, float(np.abs(windows @ self._interpolation).max()))
+
+    def momentary(self) -> np.ndarray:
+        """Momentary loudness every 100ms, LUFS (-inf for digital silence)."""
+        return _lufs(self._window_energies(MOMENTARY_BLOCKS))
+
+    def short_term(self) -> np.ndarray:
+        """Short-term loudness every 100ms, LUFS (-inf for digital silence)."""
+        return _lufs(self._window_energies(SHORT_TERM_BLOCKS))
+
+    def _window_energies(self, blocks: int) -> np.ndarray:
+        energies = np.asarray(self._energies)
+        if len(energies) < blocks:
+            return np.zeros(0)
+        return sliding_window_view(energies, blocks).mean(axis=1)
+
+    def result(self) -> Dict[str, Any]:
+        momentary = self._window_energies(MOMENTARY_BLOCKS)
+        short_term = self._window_energies(SHORT_TERM_BLOCKS)
+        return {
+            "integrated": _gated_loudness(momentary),
+            "momentary_max": _max_loudness(momentary),
+            "short_term_max": _max_loudness(short_term),
+            "loudness_range": _loudness_range(short_term),
+            "true_peak": _db(self._true_peak),
+            "sample_peak": _db(self._sample_peak),
+        }
+
+
+def _gated_loudness(energies: np.ndarray) -> Optional[float]:
+    loudness = _lufs(energies)
+    gated = energies[loudness > ABSOLUTE_GATE]
+    if len(gated) == 0:
+        return None
+    threshold = float(_lufs(gated.mean())) + RELATIVE_GATE
+    gated = gated[_lufs(gated) > threshold]
+    return float(_lufs(gated.mean()))
+
+
+def _max_loudness(energies: np.ndarray) -> Optional[float]:
+    if len(energies) == 0 or energies.max() <= 0:
+        return None
+    loudness = float(_lufs(energies.max()))
+    return loudness if loudness > ABSOLUTE_GATE else None
+
+
+def _loudness_range(energies: np.ndarray) -> Optional[float]:
+    loudness = _lufs(energies)
+    gated = energies[loudness > ABSOLUTE_GATE]
+    if len(gated) == 0:
+        return None
+    threshold = float(_lufs(gated.mean())) + LRA_RELATIVE_GATE
+    gated_loudness = _lufs(gated[_lufs(gated) > threshold])
+    low, high = np.percentile(gated_loudness, LRA_PERCENTILES)
+    return float(high - low)
+
+
+def measure(audio: np.ndarray, sample_rate: float, chunk_frames: int = CHUNK_FRAMES) -> Dict[str, Any]:
+    """Measures (frames, channels) audio already in memory or memory-mapped."""
+    meter = LoudnessMeter(sample_rate, audio.shape[1])
+    for start in range(0, len(audio), chunk_frames):
+        meter.process(audio[start:start + chunk_frames])
+    return meter.result()
+
+
+def measure_file(source: Union[str, BinaryIO], chunk_frames: int = CHUNK_FRAMES) -> Dict[str, Any]:
+    """
+    Measures an audio file (path or file-like object) in chunks of chunk_frames.
+    Uploads are read from the PCM cache. MP3 files are decoded to a scratch
+    file first (see pcm_cache.decoded). MP3 file-like objects, and formats
+    soundfile can't read (e.g. AAC, decoded by Essentia), are held in memory whole.
+    """
+    pcm = pcm_cache.cached(source) if isinstance(source, str) else None
+    if pcm is not None:
+        return measure(pcm.audio, pcm.sample_rate, chunk_frames)
+
+    try:
+        info = sf.info(source)
+    except (sf.LibsndfileError, RuntimeError):
+        if not isinstance(source, str):
+            raise
+        audio, sample_rate, channels, *_ = es.AudioLoader(filename=source)()
+        # AudioLoader always returns two channels; a mono file is duplicated
+        return measure(audio[:, :channels], sample_rate, chunk_frames)
+
+    if not isinstance(source, str):
+        source.seek(0)
+    if info.subtype.startswith("MPEG_LAYER"):
+        # libsndfile's MP3 decoder glitches at the boundaries of chunked reads:
+        # decode in one read, to disk for files
+        if isinstance(source, str):
+            with pcm_cache.decoded(source) as pcm:
+                return measure(pcm.audio, pcm.sample_rate, chunk_frames)
+        audio, sample_rate = sf.read(source, dtype="float32", always_2d=True)
+        return measure(audio, sample_rate, chunk_frames)
+    meter = LoudnessMeter(info.samplerate, info.channels)
+    for block in sf.blocks(source, blocksize=chunk_frames, dtype="float32", always_2d=True):
+        meter.process(block)
+    return meter.result()
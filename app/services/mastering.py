@@ -1,7 +1,7 @@
 import matchering as mg
 import os
 from pathlib import Path
-from app.config import OUTPUT_DIR
+from app.config import MASTERING_OUTPUT_DIR
 import numpy as np
 import scipy.io.wavfile as wav
 
@@ -63,7 +63,7 @@ def process_audio(target_path: str, reference_path: str = None, preset: str = No
             
     # Prepare output path
     target_filename = Path(target_path).stem
-    output_dir = OUTPUT_DIR / "mastering"
+    output_dir = MASTERING_OUTPUT_DIR
     output_dir.mkdir(parents=True, exist_ok=True)
     output_path = output_dir / f"{target_filename}_mastered.wav"
     
@@ -0,0 +1,263 @@
+"""
+Decoded-PCM cache for files uploaded through /upload/audio.
+
+Each upload is decoded once, at upload time, to a float32 .npy of shape
+(frames, channels) at the file's own sample rate. Services open it with
+np.load(mmap_mode="r"), so reading a window or a segment is a zero-copy view
+served from the page cache instead of another MP3/FLAC decode per request.
+
+Layout: <root>/<file_id>.<sample_rate>.npy. The file's mtime doubles as its
+last-access time; least recently used entries are evicted past the quota.
+"""
+import os
+import threading
+from contextlib import contextmanager
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterator, NamedTuple, Optional, Tuple, Union
+
+import numpy as np
+import soundfile as sf
+
+from app.config import PCM_CACHE_DIR, PCM_CACHE_MAX_BYTES
+from app.services import upload_store
+
+# Staging files older than this are left over from a crash. Younger ones may be
+# a decode in progress in another process (the server, or a pool worker).
+STALE_STAGING_SECONDS = 3600
+
+class Pcm(NamedTuple):
+    audio: np.ndarray  # (frames, channels) float32; read-only memmap when cached
+    sample_rate: int
+
+
+def upload_id(path: Union[str, Path]) -> Optional[str]:
+    """The file_id of a file stored by /upload/audio, else None."""
+    return upload_store.get_store().owns(Path(path))
+
+
+def decode(path: Union[str, Path]) -> Pcm:
+    """Decodes a whole file into memory (no caching)."""
+    try:
+        audio, sample_rate = sf.read(str(path), dtype="float32", always_2d=True)
+    except (sf.LibsndfileError, RuntimeError):
+        # Formats libsndfile can't read (e.g. AAC)
+        import essentia.standard as es
+
+        audio, sample_rate, channels, *_ = es.AudioLoader(filename=str(path))()
+        audio = audio[:, :channels]  # mono files come back duplicated to stereo
+    return Pcm(np.asarray(audio, dtype=np.float32), int(sample_rate))
+
+
+def writable(audio: np.ndarray) -> np.ndarray:
+    """audio itself, or an in-memory copy if it is read-only (a memory-mapped cache entry)."""
+    return audio if audio.flags.writeable else np.array(audio)
+
+
+def _save(dest: Path, audio: np.ndarray) -> None:
+    # Through a file object: np.save would append .npy to the staging name
+    with open(dest, "wb") as f:
+        np.save(f, audio)
+
+
+def _decode_to(path: Path, dest: Path) -> int:
+    """Decodes path into the .npy dest; returns the sample rate."""
+    try:
+        f = sf.SoundFile(str(path))
+    except (sf.LibsndfileError, RuntimeError):
+        pcm = decode(path)
+        _save(dest, pcm.audio)
+        return pcm.sample_rate
+
+    with f:
+        out = np.lib.format.open_memmap(dest, mode="w+", dtype=np.float32, shape=(f.frames, f.channels))
+        # One read straight into the mapped file: no copy in memory, and
+        # libsndfile's MP3 decoder glitches at the boundaries of chunked reads
+        written = len(f.read(out=out))
+        out.flush()
+        if written < len(out):
+            # The header over-reported the length (some MP3s): keep what was decoded
+            decoded = np.array(out[:written])
+            del out
+            _save(dest, decoded)
+        return f.samplerate
+
+
+class PcmCache:
+    """Size-bounded LRU cache of decoded uploads, keyed by file_id."""
+
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # file_id -> (path, size in bytes), least recently used first
+        self._entries: "OrderedDict[str, Tuple[Path, int]]" = OrderedDict()
+        self._total_bytes = 0
+        self._load()
+
+    def _load(self) -> None:
+        """Rebuilds the index from disk, dropping half-written entries."""
+        self.root.mkdir(parents=True, exist_ok=True)
+        found = []
+        stale_before = time.time() - STALE_STAGING_SECONDS
+        for path in self.root.iterdir():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                # Renamed or removed by another process meanwhile
+                continue
+            if path.name.endswith(".tmp"):
+                if stat.st_mtime < stale_before:
+                    path.unlink(missing_ok=True)
+            elif path.suffix == ".npy":
+                found.append((stat.st_mtime, path.name.split(".")[0], path, stat.st_size))
+        for _, file_id, path, size in sorted(found):
+            self._entries[file_id] = (path, size)
+            self._total_bytes += size
+        self._evict()
+
+    def get(self, file_id: str) -> Optional[Pcm]:
+        """Memory-mapped PCM of an upload, or None if it isn't cached."""
+        with self._lock:
+            entry = self._entries.get(file_id)
+            if entry is not None:
+                self._entries.move_to_end(file_id)
+        if entry is None:
+            # Possibly decoded by another process (e.g. the server, for a pool worker)
+            path = self._entry_path(file_id)
+            if path is None:
+                return None
+        else:
+            path = entry[0]
+        try:
+            # Also the existence check for an entry this process didn't index
+            os.utime(path)
+            if entry is None:
+                self._index(file_id, path)
+            audio = np.load(path, mmap_mode="r")
+        except FileNotFoundError:
+            # Evicted by another process
+            self._forget(file_id)
+            return None
+        return Pcm(audio, int(path.name.split(".")[1]))
+
+    def put(self, file_id: str, source: Union[str, Path]) -> Pcm:
+        """Decodes source and stores it as file_id's entry."""
+        staging = self.root / f".{file_id}.{uuid.uuid4().hex}.tmp"
+        try:
+            sample_rate = _decode_to(Path(source), staging)
+            final = self.root / f"{file_id}.{sample_rate}.npy"
+            os.replace(staging, final)
+        except BaseException:
+            staging.unlink(missing_ok=True)
+            raise
+
+        self._index(file_id, final)
+        return Pcm(np.load(final, mmap_mode="r"), sample_rate)
+
+    def _entry_path(self, file_id: str, sample_rate: Optional[int] = None) -> Optional[Path]:
+        """
+        Where file_id's entry is, whether or not it exists. The sample rate is the
+        only unknown in the name; upload_store records it.
+        """
+        if sample_rate is None:
+            upload = upload_store.get_store().get(file_id)
+            if upload is None or upload.sample_rate is None:
+                return None
+            sample_rate = upload.sample_rate
+        return self.root / f"{file_id}.{sample_rate}.npy"
+
+    def _index(self, file_id: str, path: Path) -> None:
+        size = path.stat().st_size
+        with self._lock:
+            old = self._entries.pop(file_id, None)
+            if old is not None:
+                self._total_bytes -= old[1]
+            self._entries[file_id] = (path, size)
+            self._total_bytes += size
+            self._evict()
+
+    def remove(self, file_id: str, sample_rate: Optional[int] = None) -> None:
+        """
+        Deletes file_id's entry. Pass the upload's sample_rate if it has already
+        been dropped from upload_store, so entries another process decoded (and
+        this one never indexed) are found too.
+        """
+        entry = self._forget(file_id)
+        paths = {entry[0]} if entry is not None else set()
+        path = self._entry_path(file_id, sample_rate)
+        if path is not None:
+            paths.add(path)
+        for path in paths:
+            path.unlink(missing_ok=True)
+
+    def _forget(self, file_id: str) -> Optional[Tuple[Path, int]]:
+        with self._lock:
+            entry = self._entries.pop(file_id, None)
+            if entry is not None:
+                self._total_bytes -= entry[1]
+            return entry
+
+    def _evict(self) -> None:
+        # Always keep the most recent entry, even if it alone exceeds the quota.
+        # Readers that still have an evicted file mapped keep their view.
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            _, (path, size) = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            path.unlink(missing_ok=True)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "total_bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+_cache: Optional[PcmCache] = None
+
+
+def get_cache() -> PcmCache:
+    global _cache
+    if _cache is None:
+        _cache = PcmCache(PCM_CACHE_DIR, PCM_CACHE_MAX_BYTES)
+    return _cache
+
+
+def cached(path: Union[str, Path]) -> Optional[Pcm]:
+    """The cached PCM of an uploaded file, without decoding; None if there is none."""
+    file_id = upload_id(path)
+    return get_cache().get(file_id) if file_id else None
+
+
+@contextmanager
+def decoded(path: Union[str, Path]) -> Iterator[Pcm]:
+    """
+    Memory-mapped PCM of any audio file for the duration of the block: an
+    upload's cache entry, or a decode to a scratch file in the cache directory
+    (deleted afterwards), so long files aren't held in memory.
+    """
+    if upload_id(path) is not None:
+        yield load(path)
+        return
+    cache = get_cache()
+    scratch = cache.root / f".scratch.{uuid.uuid4().hex}.tmp"
+    try:
+        sample_rate = _decode_to(Path(path), scratch)
+        yield Pcm(np.load(scratch, mmap_mode="r"), sample_rate)
+    finally:
+        scratch.unlink(missing_ok=True)
+
+
+def load(path: Union[str, Path]) -> Pcm:
+    """
+    PCM of any audio file: a memory-mapped view for uploads (decoded into the
+    cache on a miss), a fresh in-memory decode for anything else.
+    """
+    file_id = upload_id(path)
+    if file_id is None:
+        return decode(path)
+    return get_cache().get(file_id) or get_cache().put(file_id, path)
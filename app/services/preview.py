@@ -0,0 +1,104 @@
+"""
+Low-bitrate previews of uploaded audio, for browsers.
+
+A preview is rendered from the upload's cached PCM (see pcm_cache) the
+first time it is requested, as a constant-bitrate MP3 (Opus when there is
+no MP3 encoder), and kept at PREVIEW_DIR/<file_id>.<variant>.<ext>. Either
+the first PREVIEW_SECONDS of the track or all of it.
+"""
+import asyncio
+import os
+import uuid
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from app.config import PREVIEW_BITRATE_KBPS, PREVIEW_DIR, PREVIEW_SECONDS
+from app.services import audio_encoding, executor, pcm_cache
+
+# Sample rates MPEG-1 layer III can encode; anything else is resampled
+MP3_SAMPLE_RATES = (32000, 44100, 48000)
+RESAMPLE_RATE = 44100
+# Frames encoded per write
+ENCODE_BLOCK_FRAMES = 65536
+
+# preview path -> render in progress, so concurrent first requests share one render
+_inflight: Dict[Path, "asyncio.Future[Path]"] = {}
+
+
+def preview_format() -> str:
+    available = audio_encoding.available_formats()
+    for fmt in ("mp3", "opus"):
+        if fmt in available:
+            return fmt
+    raise RuntimeError("No lossy encoder available for previews (needs MP3 in libsndfile, or ffmpeg)")
+
+
+def preview_path(file_id: str, full: bool) -> Path:
+    variant = "full" if full else f"{PREVIEW_SECONDS:g}s"
+    fmt = preview_format()
+    return PREVIEW_DIR / audio_encoding.filename(f"{file_id}.{variant}.{PREVIEW_BITRATE_KBPS}k", fmt)
+
+
+def render(source: str, dest: Path, seconds: Optional[float], bitrate: int) -> Path:
+    """Encodes the first `seconds` of source (all of it if None) to dest."""
+    audio, sample_rate = pcm_cache.load(source)
+    if seconds is not None:
+        audio = audio[:int(seconds * sample_rate)]
+    if audio.shape[1] > 2:
+        # Lossy browser formats here are mono/stereo
+        audio = audio.mean(axis=1, keepdims=True)
+    fmt = preview_format()
+    if fmt == "mp3" and sample_rate not in MP3_SAMPLE_RATES:
+        import essentia
+        import essentia.standard as es
+
+        resample = es.Resample(inputSampleRate=sample_rate, outputSampleRate=RESAMPLE_RATE, quality=1)
+        audio = np.stack([resample(essentia.array(audio[:, c])) for c in range(audio.shape[1])], axis=1)
+        sample_rate = RESAMPLE_RATE
+
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    staging = dest.with_name(f".{dest.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        writer = audio_encoding.open_writer(str(staging), fmt, sample_rate, audio.shape[1], bitrate)
+        try:
+            for start in range(0, len(audio), ENCODE_BLOCK_FRAMES):
+                writer.write(audio[start:start + ENCODE_BLOCK_FRAMES])
+        finally:
+            writer.close()
+        os.replace(staging, dest)
+    except BaseException:
+        staging.unlink(missing_ok=True)
+        raise
+    return dest
+
+
+def _finished(dest: Path, future: "asyncio.Future[Path]") -> None:
+    _inflight.pop(dest, None)
+    if not future.cancelled():
+        future.exception()
+
+
+async def get_preview(file_id: str, source: str, full: bool = False) -> Path:
+    """Path of the upload's preview, rendering it on the preview pool if it doesn't exist yet."""
+    dest = preview_path(file_id, full)
+    if dest.exists():
+        return dest
+    future = _inflight.get(dest)
+    if future is None:
+        future = asyncio.ensure_future(
+            executor.run("preview", render, source, dest, None if full else PREVIEW_SECONDS, PREVIEW_BITRATE_KBPS)
+        )
+        future.add_done_callback(lambda f: _finished(dest, f))
+        _inflight[dest] = future
+    # One caller going away doesn't cancel the render for the others
+    return await asyncio.shield(future)
+
+
+def remove(file_id: str) -> List[Path]:
+    """Deletes every preview of an upload; returns their paths."""
+    removed = list(PREVIEW_DIR.glob(f"{file_id}.*")) if PREVIEW_DIR.exists() else []
+    for path in removed:
+        path.unlink(missing_ok=True)
+    return removed
@@ -0,0 +1,151 @@
+"""
+Content-addressed cache for stem separation results.
+
+Entries are keyed by a hash of the audio content plus the separation variant
+(model name, ...), so re-uploads of the same track are served from disk and
+different tracks that happen to share a filename never collide.
+
+Layout: <root>/<model>/<key>/<stem>.wav plus a `.complete` marker whose mtime
+doubles as the entry's last-access time for LRU eviction.
+"""
+import hashlib
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+COMPLETE_MARKER = ".complete"
+HASH_CHUNK_SIZE = 1024 * 1024
+# Staging dirs older than this are left over from a crash. Younger ones may be
+# a separation in progress in another server process, and are left alone.
+STALE_STAGING_SECONDS = 6 * 3600
+
+
+def hash_file(path: str) -> str:
+    """SHA-256 of the file contents, read in 1MB chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def make_key(content_hash: str, *variant: str) -> str:
+    """Cache key for a given audio content hash and separation variant."""
+    return hashlib.sha256("|".join((content_hash,) + variant).encode()).hexdigest()[:32]
+
+
+def _mtime(path: Path) -> float:
+    """mtime of path, or now if it is already gone (removed by another process)."""
+    try:
+        return path.stat().st_mtime
+    except FileNotFoundError:
+        return time.time()
+
+
+def _dir_size(path: Path) -> int:
+    return sum(f.stat().st_size for f in path.iterdir() if f.is_file())
+
+
+class StemCache:
+    """Size-bounded LRU cache of separated stem directories."""
+
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # key -> (entry dir, size in bytes), least recently used first
+        self._entries: "OrderedDict[str, Tuple[Path, int]]" = OrderedDict()
+        self._total_bytes = 0
+        self._load()
+
+    def _load(self) -> None:
+        """Rebuilds the index from disk, dropping unfinished entries."""
+        self.root.mkdir(parents=True, exist_ok=True)
+        found = []
+        stale_before = time.time() - STALE_STAGING_SECONDS
+        for model_dir in self.root.iterdir():
+            if not model_dir.is_dir():
+                continue
+            for entry_dir in model_dir.iterdir():
+                if not entry_dir.is_dir():
+                    continue
+                if entry_dir.name.endswith(".tmp"):
+                    if _mtime(entry_dir) < stale_before:
+                        # Staging dir left over from a crash mid-separation
+                        shutil.rmtree(entry_dir, ignore_errors=True)
+                    continue
+                marker = entry_dir / COMPLETE_MARKER
+                if not marker.exists():
+                    continue
+                found.append((marker.stat().st_mtime, entry_dir.name, entry_dir))
+
+        for _, key, entry_dir in sorted(found):
+            size = _dir_size(entry_dir)
+            self._entries[key] = (entry_dir, size)
+            self._total_bytes += size
+        self._evict()
+
+    def entry_dir(self, key: str, model: str) -> Path:
+        return self.root / model / key
+
+    def staging_dir(self, key: str, model: str) -> Path:
+        """Private directory a new entry is written to before it is committed."""
+        return self.root / model / f".{key}.{uuid.uuid4().hex}.tmp"
+
+    def get(self, key: str) -> Optional[Path]:
+        """Returns the entry directory on a hit and marks it as recently used."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+        entry_dir = entry[0]
+        try:
+            os.utime(entry_dir / COMPLETE_MARKER)
+        except FileNotFoundError:
+            # Removed behind our back (another process evicted it)
+            with self._lock:
+                if self._entries.pop(key, None) is not None:
+                    self._total_bytes -= entry[1]
+            return None
+        return entry_dir
+
+    def commit(self, key: str, model: str, staging: Path) -> Path:
+        """Moves a fully written staging directory into place and indexes it."""
+        (staging / COMPLETE_MARKER).touch()
+        final = self.entry_dir(key, model)
+        if final.exists():
+            # Someone else produced the same entry first; keep theirs.
+            shutil.rmtree(staging, ignore_errors=True)
+        else:
+            os.replace(staging, final)
+
+        size = _dir_size(final)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._total_bytes -= old[1]
+            self._entries[key] = (final, size)
+            self._total_bytes += size
+            self._evict()
+        return final
+
+    def _evict(self) -> None:
+        # Always keep the most recent entry, even if it alone exceeds the quota
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            _, (entry_dir, size) = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            shutil.rmtree(entry_dir, ignore_errors=True)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "total_bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+            }
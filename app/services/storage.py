@@ -0,0 +1,396 @@
+"""
+Disk quota and eviction for uploads and generated files.
+
+Files the API writes are registered in an SQLite index shared by all server
+processes: path, area, size and last access. A background task (start())
+deletes the entries not accessed within their area's TTL, then the least
+recently used ones while the total is over the quota. A pass only queries the
+index; the directories are walked once, at startup (reconcile()), to pick up
+files written before the index existed or left behind by a crash.
+
+Areas:
+- scratch: files uploaded with a single request, deleted when the request or
+  job using them ends (release()); the TTL only catches leftovers.
+- upload: files stored by /upload/audio. Evicting one also drops its index
+  entry, decoded PCM, previews and waveform (remove_upload()).
+- output: mastered tracks and previews served from /outputs.
+
+Files a job is using are pinned (pin()/release()). A pin is a row tagged with
+the process id, so the pins of a process that died don't keep files forever.
+Index writes can wait on other processes' writes, so async code uses the
+a-prefixed methods (apin(), ausing(), ...), which run them in a thread.
+Stems and decoded PCM are bounded by their own caches (stem_cache, pcm_cache).
+"""
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from pathlib import Path
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Set, Tuple, Union
+
+from app.config import (
+    INGEST_DIR, MASTERING_OUTPUT_DIR, PREVIEW_DIR, STORAGE_INDEX_PATH, STORAGE_MAX_BYTES,
+    STORAGE_OUTPUT_TTL_SECONDS, STORAGE_SCRATCH_TTL_SECONDS, STORAGE_SWEEP_SECONDS,
+    STORAGE_UPLOAD_TTL_SECONDS, UPLOAD_DIR, UPLOAD_INDEX_PATH,
+)
+from app.services import pcm_cache, preview, upload_store, waveform
+
+logger = logging.getLogger(__name__)
+
+SCRATCH = "scratch"
+UPLOAD = "upload"
+OUTPUT = "output"
+
+# Accesses to the same file within this many seconds are recorded once
+TOUCH_INTERVAL_SECONDS = 60
+# Rows read per query when picking least recently used files
+EVICT_BATCH = 500
+# Staging files older than this are left over from a crash
+STALE_STAGING_SECONDS = 3600
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS artifacts (
+    path TEXT PRIMARY KEY,
+    area TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS artifacts_area_accessed ON artifacts (area, accessed_at);
+CREATE INDEX IF NOT EXISTS artifacts_accessed ON artifacts (accessed_at);
+CREATE TABLE IF NOT EXISTS pins (
+    path TEXT NOT NULL,
+    pid INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pins_path ON pins (path);
+"""
+
+PathLike = Union[str, Path]
+
+
+def _key(path: PathLike) -> str:
+    return os.path.abspath(str(path))
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def remove_upload(file_id: str) -> bool:
+    """Deletes an /upload/audio file with everything derived from it; False if it was unknown."""
+    upload = upload_store.get_store().delete(file_id)
+    pcm_cache.get_cache().remove(file_id, upload.sample_rate if upload is not None else None)
+    removed = preview.remove(file_id)
+    waveform.peaks_path(file_id).unlink(missing_ok=True)
+    get_manager().forget(*removed, *([upload.path] if upload is not None else []))
+    return upload is not None
+
+
+def _delete(path: str, area: str) -> None:
+    file_id = upload_store.get_store().owns(Path(path)) if area == UPLOAD else None
+    if file_id is not None:
+        remove_upload(file_id)
+    else:
+        Path(path).unlink(missing_ok=True)
+
+
+class StorageManager:
+    """Index of managed files with TTL and LRU eviction under a byte quota."""
+
+    def __init__(self, db_path: Path, max_bytes: int, ttls: Dict[str, float]):
+        self.max_bytes = max_bytes
+        self.ttls = ttls
+        self._lock = threading.Lock()
+        # path -> when its last access was recorded, to skip redundant writes.
+        # Own lock, so the check never waits on a database write
+        self._touch_lock = threading.Lock()
+        self._touched: Dict[str, float] = {}
+        self._task: Optional[asyncio.Task] = None
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        # One connection shared by the request threads, serialized by _lock
+        self._db = sqlite3.connect(str(db_path), check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_SCHEMA)
+
+    def track(self, path: PathLike, area: str, accessed_at: Optional[float] = None) -> None:
+        """Registers (or refreshes) a file of `area`; ignored if it doesn't exist."""
+        key = _key(path)
+        try:
+            size = os.stat(key).st_size
+        except FileNotFoundError:
+            return
+        accessed_at = time.time() if accessed_at is None else accessed_at
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO artifacts VALUES (?, ?, ?, ?) ON CONFLICT(path) DO UPDATE SET "
+                "area = excluded.area, size = excluded.size, accessed_at = excluded.accessed_at",
+                (key, area, size, accessed_at),
+            )
+
+    def touch(self, path: PathLike, area: Optional[str] = None) -> None:
+        """
+        Records an access. Files not in the index are added to `area` if given,
+        otherwise ignored (e.g. stems, which their cache manages).
+        """
+        key = _key(path)
+        now = time.time()
+        if self._due(key, now):
+            self._record_access(key, area, now)
+
+    def _due(self, key: str, now: float) -> bool:
+        """Whether an access to `key` at `now` needs recording; marks it recorded if so."""
+        with self._touch_lock:
+            if now - self._touched.get(key, 0) < TOUCH_INTERVAL_SECONDS:
+                return False
+            if len(self._touched) > 100000:
+                self._touched.clear()
+            self._touched[key] = now
+            return True
+
+    def _record_access(self, key: str, area: Optional[str], now: float) -> None:
+        if area is not None:
+            self.track(key, area, now)
+            return
+        with self._lock, self._db:
+            self._db.execute("UPDATE artifacts SET accessed_at = ? WHERE path = ?", (now, key))
+
+    def forget(self, *paths: PathLike) -> None:
+        """Drops index entries of files deleted by someone else."""
+        with self._lock, self._db:
+            self._db.executemany("DELETE FROM artifacts WHERE path = ?", [(_key(p),) for p in paths])
+
+    def pin(self, *paths: PathLike) -> None:
+        """Keeps files from being evicted until release()."""
+        with self._lock, self._db:
+            self._db.executemany("INSERT INTO pins VALUES (?, ?)", [(_key(p), os.getpid()) for p in paths])
+
+    def release(self, *paths: PathLike) -> None:
+        """Undoes one pin() of each path; scratch files nobody has pinned anymore are deleted."""
+        pid = os.getpid()
+        done: List[Tuple[str, str]] = []
+        with self._lock, self._db:
+            for path in map(_key, paths):
+                self._db.execute(
+                    "DELETE FROM pins WHERE rowid = (SELECT rowid FROM pins WHERE path = ? AND pid = ? LIMIT 1)",
+                    (path, pid),
+                )
+                row = self._db.execute(
+                    "SELECT area FROM artifacts WHERE path = ? AND NOT EXISTS (SELECT 1 FROM pins WHERE path = ?)",
+                    (path, path),
+                ).fetchone()
+                if row is not None and row[0] == SCRATCH:
+                    done.append((path, row[0]))
+        for path, area in done:
+            self._remove(path, area)
+
+    @contextmanager
+    def using(self, *paths: PathLike) -> Iterator[None]:
+        """Pins paths for the duration of the block."""
+        self.pin(*paths)
+        try:
+            yield
+        finally:
+            self.release(*paths)
+
+    async def atrack(self, path: PathLike, area: str, accessed_at: Optional[float] = None) -> None:
+        await asyncio.to_thread(self.track, path, area, accessed_at)
+
+    async def atouch(self, path: PathLike, area: Optional[str] = None) -> None:
+        # Throttled accesses return without leaving the loop
+        key = _key(path)
+        now = time.time()
+        if self._due(key, now):
+            await asyncio.to_thread(self._record_access, key, area, now)
+
+    async def apin(self, *paths: PathLike) -> None:
+        await asyncio.to_thread(self.pin, *paths)
+
+    async def arelease(self, *paths: PathLike) -> None:
+        # Shielded: a caller cancelled meanwhile still has its pins dropped
+        await asyncio.shield(asyncio.to_thread(self.release, *paths))
+
+    @asynccontextmanager
+    async def ausing(self, *paths: PathLike) -> AsyncIterator[None]:
+        """using() for async code."""
+        await self.apin(*paths)
+        try:
+            yield
+        finally:
+            await self.arelease(*paths)
+
+    def _pinned(self) -> Set[str]:
+        with self._lock:
+            pids = [pid for (pid,) in self._db.execute("SELECT DISTINCT pid FROM pins")]
+        dead = [pid for pid in pids if not _alive(pid)]
+        with self._lock, self._db:
+            self._db.executemany("DELETE FROM pins WHERE pid = ?", [(pid,) for pid in dead])
+            return {path for (path,) in self._db.execute("SELECT DISTINCT path FROM pins")}
+
+    def _remove(self, path: str, area: str) -> bool:
+        """Deletes a file unless it is pinned; False if it was kept."""
+        # Pin check and unindexing in one statement: a file pinned since it was
+        # selected stays, and one unindexed here can't be picked by another pass
+        with self._lock, self._db:
+            claimed = self._db.execute(
+                "DELETE FROM artifacts WHERE path = ? AND NOT EXISTS (SELECT 1 FROM pins WHERE pins.path = artifacts.path)",
+                (path,),
+            ).rowcount
+        if not claimed:
+            return False
+        try:
+            _delete(path, area)
+        except OSError as e:
+            logger.warning(f"Could not delete {path}: {e}")
+            self.track(path, area)
+            return False
+        return True
+
+    def evict(self) -> Dict[str, int]:
+        """One pass: expired entries first, then least recently used ones past the quota."""
+        now = time.time()
+        pinned = self._pinned()
+        expired: List[Tuple[str, str, int]] = []
+        with self._lock:
+            for area, ttl in self.ttls.items():
+                if ttl > 0:
+                    expired += self._db.execute(
+                        "SELECT path, area, size FROM artifacts WHERE area = ? AND accessed_at < ?",
+                        (area, now - ttl),
+                    ).fetchall()
+            total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM artifacts").fetchone()[0]
+        expired = [row for row in expired if row[0] not in pinned]
+        excess = total - sum(size for _, _, size in expired) - self.max_bytes
+        lru: List[Tuple[str, str, int]] = []
+        skip = pinned | {path for path, _, _ in expired}
+        # Oldest first, a batch per query, so requests can use the index in between
+        after: Tuple[float, str] = (float("-inf"), "")
+        while excess > 0:
+            with self._lock:
+                rows = self._db.execute(
+                    "SELECT path, area, size, accessed_at FROM artifacts "
+                    "WHERE accessed_at >= ? AND (accessed_at > ? OR path > ?) "
+                    "ORDER BY accessed_at, path LIMIT ?",
+                    (after[0], after[0], after[1], EVICT_BATCH),
+                ).fetchall()
+            if not rows:
+                break
+            for path, area, size, _ in rows:
+                if excess <= 0:
+                    break
+                if path not in skip:
+                    lru.append((path, area, size))
+                    excess -= size
+            after = (rows[-1][3], rows[-1][0])
+
+        # Selected from a snapshot of the pins; _remove re-checks each file
+        expired = [row for row in expired if self._remove(row[0], row[1])]
+        lru = [row for row in lru if self._remove(row[0], row[1])]
+        return {
+            "expired": len(expired),
+            "evicted": len(lru),
+            "freed_bytes": sum(size for _, _, size in expired + lru),
+        }
+
+    def reconcile(self) -> None:
+        """
+        Indexes files that aren't yet (with their mtime as last access) and
+        forgets entries whose file is gone. Walks the managed directories.
+        """
+        store = upload_store.get_store()
+        found: List[Tuple[str, str, int, float]] = []
+
+        def add(path: Path, area: str) -> None:
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                return
+            found.append((_key(path), area, stat.st_size, stat.st_mtime))
+
+        index_files = {_key(UPLOAD_INDEX_PATH) + suffix for suffix in ("", "-wal", "-shm")}
+        for path in UPLOAD_DIR.iterdir():
+            if path.is_file() and not path.name.startswith(".") and _key(path) not in index_files:
+                add(path, SCRATCH)
+        for upload in store.uploads():
+            add(upload.path, UPLOAD)
+        for directory in (MASTERING_OUTPUT_DIR, PREVIEW_DIR, INGEST_DIR):
+            if not directory.exists():
+                continue
+            for path in directory.iterdir():
+                if not path.is_file():
+                    continue
+                if path.name.startswith(".") or directory == INGEST_DIR:
+                    # Staging file of a render or upload that never finished
+                    if path.stat().st_mtime < time.time() - STALE_STAGING_SECONDS:
+                        path.unlink(missing_ok=True)
+                    continue
+                add(path, OUTPUT)
+
+        with self._lock, self._db:
+            self._db.executemany("INSERT OR IGNORE INTO artifacts VALUES (?, ?, ?, ?)", found)
+            paths = [path for (path,) in self._db.execute("SELECT path FROM artifacts")]
+        self.forget(*[path for path in paths if not os.path.exists(path)])
+
+    async def _sweep(self, interval: float) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, self.reconcile)
+        except Exception:
+            logger.exception("Storage reconcile failed")
+        while True:
+            try:
+                result = await loop.run_in_executor(None, self.evict)
+                if result["expired"] or result["evicted"]:
+                    logger.info(f"Storage eviction: {result}")
+            except Exception:
+                logger.exception("Storage eviction failed")
+            await asyncio.sleep(interval)
+
+    def start(self, interval: float = STORAGE_SWEEP_SECONDS) -> None:
+        """Runs reconcile() once, then evict() every `interval` seconds, on the running loop."""
+        self._task = asyncio.create_task(self._sweep(interval))
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT area, COUNT(*), COALESCE(SUM(size), 0) FROM artifacts GROUP BY area"
+            ).fetchall()
+            pins = self._db.execute("SELECT COUNT(DISTINCT path) FROM pins").fetchone()[0]
+        areas = {area: {"files": count, "total_bytes": size} for area, count, size in rows}
+        return {
+            "areas": areas,
+            "total_bytes": sum(a["total_bytes"] for a in areas.values()),
+            "max_bytes": self.max_bytes,
+            "pinned": pins,
+        }
+
+
+_manager: Optional[StorageManager] = None
+
+
+def get_manager() -> StorageManager:
+    global _manager
+    if _manager is None:
+        _manager = StorageManager(
+            STORAGE_INDEX_PATH,
+            STORAGE_MAX_BYTES,
+            {
+                SCRATCH: STORAGE_SCRATCH_TTL_SECONDS,
+                UPLOAD: STORAGE_UPLOAD_TTL_SECONDS,
+                OUTPUT: STORAGE_OUTPUT_TTL_SECONDS,
+            },
+        )
+    return _manager
@@ -3,10 +3,10 @@ import os
 import tempfile
 import subprocess
 import shutil
-import soundfile as sf
 import librosa
 import logging
 from typing import Optional
+from app.services import pcm_cache
 
 logger = logging.getLogger(__name__)
 
@@ -15,7 +15,7 @@ RUBBERBAND_BIN = shutil.which("rubberband") or "rubberband"
 
 def _detect_bpm(input_file_path: str) -> float:
     """Auto-detect BPM using librosa."""
-    data, sample_rate = sf.read(input_file_path, dtype='float32', always_2d=True)
+    data, sample_rate = pcm_cache.load(input_file_path)
     y_mono = librosa.to_mono(data.T)
     tempo, _ = librosa.beat.beat_track(y=y_mono, sr=sample_rate)
     return float(tempo)
@@ -0,0 +1,307 @@
+"""
+Storage and index of files uploaded through /upload/audio.
+
+Files live in directories sharded by id prefix,
+<root>/<id[0:2]>/<id[2:4]>/<file_id><ext>, so no directory grows past a few
+thousand entries. Their metadata (path, duration, format, size, content
+hash) is kept in an SQLite table keyed by file_id: looking up or deleting
+an upload is one primary-key query, whatever the number of uploads, and the
+index is shared by all server processes (WAL mode).
+
+Uploads stored flat in <root> by older versions are moved into their shard
+and indexed when the store is opened.
+"""
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import soundfile as sf
+
+from app.config import UPLOAD_DIR, UPLOAD_INDEX_PATH
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS uploads (
+    file_id TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    original_name TEXT NOT NULL,
+    duration REAL,
+    sample_rate INTEGER,
+    channels INTEGER,
+    size INTEGER NOT NULL,
+    content_hash TEXT,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS upload_sessions (
+    file_id TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    original_name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    chunk_size INTEGER NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS upload_chunks (
+    file_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    PRIMARY KEY (file_id, idx)
+);
+"""
+
+
+class Upload(NamedTuple):
+    file_id: str
+    path: Path
+    original_name: str
+    duration: Optional[float]
+    sample_rate: Optional[int]
+    channels: Optional[int]
+    size: int
+    content_hash: Optional[str]
+    created_at: float
+
+
+class UploadSession(NamedTuple):
+    """A resumable upload in progress: chunks are written in place into a preallocated .part file."""
+
+    file_id: str
+    path: Path
+    original_name: str
+    size: int
+    chunk_size: int
+    created_at: float
+
+    @property
+    def chunks(self) -> int:
+        return max(1, -(-self.size // self.chunk_size))
+
+    def chunk_span(self, index: int) -> Tuple[int, int]:
+        """(offset, length) of chunk `index` in the file."""
+        offset = index * self.chunk_size
+        return offset, max(0, min(self.chunk_size, self.size - offset))
+
+
+def is_file_id(name: str) -> bool:
+    try:
+        return str(uuid.UUID(name)) == name
+    except ValueError:
+        return False
+
+
+class UploadStore:
+    """Sharded upload directory with an SQLite index keyed by file_id."""
+
+    def __init__(self, root: Path, db_path: Path):
+        self.root = root
+        self._lock = threading.Lock()
+        root.mkdir(parents=True, exist_ok=True)
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        # One connection shared by the request threads, serialized by _lock
+        self._db = sqlite3.connect(str(db_path), check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_SCHEMA)
+        self._migrate_flat()
+
+    def shard_dir(self, file_id: str) -> Path:
+        return self.root / file_id[:2] / file_id[2:4]
+
+    def path_for(self, file_id: str, ext: str) -> Path:
+        """Where a new upload is stored; creates its shard directory."""
+        shard = self.shard_dir(file_id)
+        shard.mkdir(parents=True, exist_ok=True)
+        return shard / f"{file_id}{ext}"
+
+    def owns(self, path: Path) -> Optional[str]:
+        """The file_id if path is an upload stored here, else None."""
+        path = Path(path)
+        if not is_file_id(path.stem):
+            return None
+        return path.stem if path.parent.resolve() == self.shard_dir(path.stem).resolve() else None
+
+    def add(
+        self,
+        file_id: str,
+        path: Path,
+        original_name: str,
+        duration: Optional[float] = None,
+        sample_rate: Optional[int] = None,
+        channels: Optional[int] = None,
+        content_hash: Optional[str] = None,
+    ) -> Upload:
+        upload = Upload(
+            file_id, Path(path), original_name, duration, sample_rate, channels,
+            Path(path).stat().st_size, content_hash, time.time(),
+        )
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (upload.file_id, str(upload.path), *upload[2:]),
+            )
+        return upload
+
+    def get(self, file_id: str) -> Optional[Upload]:
+        with self._lock:
+            row = self._db.execute("SELECT * FROM uploads WHERE file_id = ?", (file_id,)).fetchone()
+        if row is None:
+            return None
+        return Upload(row[0], Path(row[1]), *row[2:])
+
+    def uploads(self) -> List[Upload]:
+        with self._lock:
+            rows = self._db.execute("SELECT * FROM uploads").fetchall()
+        return [Upload(row[0], Path(row[1]), *row[2:]) for row in rows]
+
+    def delete(self, file_id: str) -> Optional[Upload]:
+        """Removes an upload's file and index entry; returns it, or None if unknown."""
+        upload = self.get(file_id)
+        if upload is None:
+            return None
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM uploads WHERE file_id = ?", (file_id,))
+        upload.path.unlink(missing_ok=True)
+        return upload
+
+    def create_session(self, original_name: str, size: int, chunk_size: int) -> UploadSession:
+        """Starts a resumable upload, preallocating its file (sparse where the filesystem allows)."""
+        file_id = str(uuid.uuid4())
+        ext = os.path.splitext(original_name)[1] or ".wav"
+        session = UploadSession(
+            file_id, self.path_for(file_id, f"{ext}.part"), original_name, size, chunk_size, time.time()
+        )
+        with open(session.path, "wb") as f:
+            f.truncate(size)
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO upload_sessions VALUES (?, ?, ?, ?, ?, ?)",
+                (session.file_id, str(session.path), *session[2:]),
+            )
+        return session
+
+    def get_session(self, file_id: str) -> Optional[UploadSession]:
+        with self._lock:
+            row = self._db.execute("SELECT * FROM upload_sessions WHERE file_id = ?", (file_id,)).fetchone()
+        if row is None:
+            return None
+        return UploadSession(row[0], Path(row[1]), *row[2:])
+
+    def start_chunk(self, file_id: str, index: int) -> bool:
+        """
+        Marks chunk `index` as not received before it is (re)written, so a write
+        that fails or is cut off leaves it missing. False if the session is gone.
+        """
+        with self._lock, self._db:
+            if self._db.execute("SELECT 1 FROM upload_sessions WHERE file_id = ?", (file_id,)).fetchone() is None:
+                return False
+            self._db.execute("DELETE FROM upload_chunks WHERE file_id = ? AND idx = ?", (file_id, index))
+        return True
+
+    def add_chunk(self, file_id: str, index: int, sha256: str) -> None:
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO upload_chunks SELECT ?, ?, ? "
+                "WHERE EXISTS (SELECT 1 FROM upload_sessions WHERE file_id = ?)",
+                (file_id, index, sha256, file_id),
+            )
+
+    def received_chunks(self, file_id: str) -> List[int]:
+        return [index for index, _ in self.chunk_digests(file_id)]
+
+    def chunk_digests(self, file_id: str) -> List[Tuple[int, str]]:
+        """(index, SHA-256) of the chunks received so far, in order."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT idx, sha256 FROM upload_chunks WHERE file_id = ? ORDER BY idx", (file_id,)
+            ).fetchall()
+        return [(index, sha256) for index, sha256 in rows]
+
+    def finish_session(self, session: UploadSession, digests: List[Tuple[int, str]]) -> Optional[Path]:
+        """
+        Moves a fully received upload to its final path and ends the session,
+        provided its chunks are still `digests` (as read before verifying the
+        file). Raises ValueError if a chunk was re-sent or went missing meanwhile.
+        Returns None if another request finished it first.
+        """
+        final = session.path.with_suffix("")
+        # The rename happens under the lock: a chunk write that starts after it
+        # finds the session gone (start_chunk) instead of writing into the upload
+        with self._lock, self._db:
+            current = self._db.execute(
+                "SELECT idx, sha256 FROM upload_chunks WHERE file_id = ? ORDER BY idx", (session.file_id,)
+            ).fetchall()
+            if self._db.execute(
+                "SELECT 1 FROM upload_sessions WHERE file_id = ?", (session.file_id,)
+            ).fetchone() is None:
+                return None
+            if [tuple(row) for row in current] != list(digests) or len(current) != session.chunks:
+                raise ValueError("Chunks changed while the upload was being completed")
+            self._db.execute("DELETE FROM upload_sessions WHERE file_id = ?", (session.file_id,))
+            self._db.execute("DELETE FROM upload_chunks WHERE file_id = ?", (session.file_id,))
+            os.replace(session.path, final)
+        return final
+
+    def delete_session(self, file_id: str) -> Optional[UploadSession]:
+        session = self.get_session(file_id)
+        if session is None:
+            return None
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM upload_sessions WHERE file_id = ?", (file_id,))
+            self._db.execute("DELETE FROM upload_chunks WHERE file_id = ?", (file_id,))
+        session.path.unlink(missing_ok=True)
+        return session
+
+    def purge_sessions(self, max_age: float) -> int:
+        """Abandons sessions without a chunk written for max_age seconds; returns how many."""
+        cutoff = time.time() - max_age
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT file_id, path FROM upload_sessions WHERE created_at < ?", (cutoff,)
+            ).fetchall()
+        purged = 0
+        for file_id, path in rows:
+            # Every chunk write updates the .part file's mtime
+            try:
+                if os.stat(path).st_mtime >= cutoff:
+                    continue
+            except FileNotFoundError:
+                pass
+            purged += self.delete_session(file_id) is not None
+        return purged
+
+    def _migrate_flat(self) -> None:
+        for path in self.root.iterdir():
+            if not path.is_file() or not is_file_id(path.stem):
+                continue
+            dest = self.path_for(path.stem, path.suffix)
+            try:
+                os.replace(path, dest)
+            except FileNotFoundError:
+                # Another server process moved it first
+                continue
+            try:
+                info = sf.info(str(dest))
+                details = (info.duration, info.samplerate, info.channels)
+            except RuntimeError:
+                details = (None, None, None)
+            with self._lock, self._db:
+                self._db.execute(
+                    "INSERT OR IGNORE INTO uploads VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (path.stem, str(dest), path.name, *details, dest.stat().st_size, None, time.time()),
+                )
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            count, total = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM uploads").fetchone()
+        return {"uploads": count, "total_bytes": total}
+
+
+_store: Optional[UploadStore] = None
+
+
+def get_store() -> UploadStore:
+    global _store
+    if _store is None:
+        _store = UploadStore(UPLOAD_DIR, UPLOAD_INDEX_PATH)
+    return _store
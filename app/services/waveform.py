@@ -0,0 +1,161 @@
+"""
+Waveform peak pyramids for drawing uploads without downloading them.
+
+Level 0 holds one peak per BASE_SAMPLES_PER_PEAK frames, and every level
+above merges LEVEL_FACTOR peaks of the one below, up to a level that fits a
+screen. A peak is (min, max, rms) per channel as int16 (full scale = 32767).
+
+The pyramid is stored next to the upload as <file_id>.peaks: a JSON header
+padded to HEADER_BYTES, then each level as a (peaks, channels, 3) int16
+little-endian array. Tiles are read through a memory map, so serving one
+touches a few KB of the file.
+"""
+import json
+import os
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from app.services import upload_store
+
+MAGIC = "peaks/1"
+HEADER_BYTES = 4096
+BASE_SAMPLES_PER_PEAK = 256
+LEVEL_FACTOR = 4
+# The coarsest level is the first with at most this many peaks
+MIN_LEVEL_PEAKS = 1024
+# Peaks per tile served by read_tile()
+TILE_PEAKS = 1024
+# Frames read per block while building level 0 (a multiple of BASE_SAMPLES_PER_PEAK)
+BUILD_BLOCK_FRAMES = BASE_SAMPLES_PER_PEAK * 1024
+
+
+def peaks_path(file_id: str) -> Path:
+    """Where an upload's pyramid is stored: next to the upload."""
+    return upload_store.get_store().shard_dir(file_id) / f"{file_id}.peaks"
+
+
+def _quantize(values: np.ndarray) -> np.ndarray:
+    return np.round(np.clip(values, -1.0, 1.0) * 32767).astype("<i2")
+
+
+def _merge(values: np.ndarray, fill, reduce) -> np.ndarray:
+    """Reduces every LEVEL_FACTOR consecutive rows, padding the last group with `fill`."""
+    n = -(-len(values) // LEVEL_FACTOR)
+    padded = np.concatenate([values, np.full((n * LEVEL_FACTOR - len(values),) + values.shape[1:], fill, values.dtype)])
+    return reduce(padded.reshape((n, LEVEL_FACTOR) + values.shape[1:]), axis=1)
+
+
+def build(audio: np.ndarray, sample_rate: int, dest: Path) -> Dict[str, Any]:
+    """Computes the pyramid of (frames, channels) audio and writes it to dest; returns its header."""
+    frames, channels = audio.shape
+
+    # Level 0 in one pass over the audio: min, max, sum of squares and frame count per peak
+    peaks = -(-frames // BASE_SAMPLES_PER_PEAK)
+    low = np.zeros((peaks, channels), dtype=np.float32)
+    high = np.zeros((peaks, channels), dtype=np.float32)
+    energy = np.zeros((peaks, channels), dtype=np.float64)
+    counts = np.full(peaks, BASE_SAMPLES_PER_PEAK, dtype=np.int64)
+    if peaks:
+        counts[-1] = frames - (peaks - 1) * BASE_SAMPLES_PER_PEAK
+    for start in range(0, frames, BUILD_BLOCK_FRAMES):
+        block = np.asarray(audio[start:start + BUILD_BLOCK_FRAMES], dtype=np.float32)
+        first = start // BASE_SAMPLES_PER_PEAK
+        n = -(-len(block) // BASE_SAMPLES_PER_PEAK)
+        pad = n * BASE_SAMPLES_PER_PEAK - len(block)
+        if pad:
+            # Repeat the last frame so the partial peak's min/max aren't skewed; its energy is fixed below
+            block = np.concatenate([block, np.repeat(block[-1:], pad, axis=0)])
+        # (peaks, channels, frames): reducing over the contiguous axis is several times faster
+        block = np.ascontiguousarray(block.reshape(n, BASE_SAMPLES_PER_PEAK, channels).transpose(0, 2, 1))
+        low[first:first + n] = block.min(axis=2)
+        high[first:first + n] = block.max(axis=2)
+        energy[first:first + n] = np.einsum("ijk,ijk->ij", block, block)
+        if pad:
+            energy[first + n - 1] -= pad * np.square(block[-1, :, -1], dtype=np.float64)
+
+    levels = []
+    samples_per_peak = BASE_SAMPLES_PER_PEAK
+    while True:
+        rms = np.sqrt(energy / np.maximum(counts, 1)[:, np.newaxis])
+        levels.append((samples_per_peak, np.stack([_quantize(low), _quantize(high), _quantize(rms)], axis=2)))
+        if len(low) <= MIN_LEVEL_PEAKS:
+            break
+        # Merge LEVEL_FACTOR peaks into one
+        low = _merge(low, np.inf, np.min)
+        high = _merge(high, -np.inf, np.max)
+        energy = _merge(energy, 0, np.sum)
+        counts = _merge(counts, 0, np.sum)
+        samples_per_peak *= LEVEL_FACTOR
+
+    header: Dict[str, Any] = {
+        "format": MAGIC,
+        "sample_rate": sample_rate,
+        "channels": channels,
+        "frames": frames,
+        "tile_peaks": TILE_PEAKS,
+        "levels": [],
+    }
+    offset = HEADER_BYTES
+    for samples_per_peak, data in levels:
+        header["levels"].append({"samples_per_peak": samples_per_peak, "peaks": len(data), "offset": offset})
+        offset += data.nbytes
+
+    staging = dest.with_name(f".{dest.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        with open(staging, "wb") as f:
+            f.write(json.dumps(header).encode().ljust(HEADER_BYTES, b" "))
+            for _, data in levels:
+                f.write(data.tobytes())
+        os.replace(staging, dest)
+    except BaseException:
+        staging.unlink(missing_ok=True)
+        raise
+    return header
+
+
+def read_header(path: Path) -> Dict[str, Any]:
+    with open(path, "rb") as f:
+        header = json.loads(f.read(HEADER_BYTES))
+    if header.get("format") != MAGIC:
+        raise ValueError(f"Not a peaks file: {path}")
+    return header
+
+
+def level_array(path: Path, header: Dict[str, Any], level: int) -> np.ndarray:
+    """Memory-mapped (peaks, channels, 3) int16 array of one level."""
+    spec = header["levels"][level]
+    return np.memmap(
+        path, dtype="<i2", mode="r", offset=spec["offset"], shape=(spec["peaks"], header["channels"], 3)
+    )
+
+
+def read_tile(path: Path, header: Dict[str, Any], level: int, tile: int) -> Optional[bytes]:
+    """Raw bytes of tile `tile` of a level (the last one may be short); None past the end."""
+    start = tile * TILE_PEAKS
+    if tile < 0 or start >= header["levels"][level]["peaks"]:
+        return None
+    return level_array(path, header, level)[start:start + TILE_PEAKS].tobytes()
+
+
+def describe(header: Dict[str, Any]) -> Dict[str, Any]:
+    """Header as served to clients: the levels with their peak duration and tile count."""
+    levels: List[Dict[str, Any]] = [
+        {
+            "level": i,
+            "samples_per_peak": spec["samples_per_peak"],
+            "seconds_per_peak": spec["samples_per_peak"] / header["sample_rate"],
+            "peaks": spec["peaks"],
+            "tiles": -(-spec["peaks"] // header["tile_peaks"]),
+        }
+        for i, spec in enumerate(header["levels"])
+    ]
+    return {
+        "sample_rate": header["sample_rate"],
+        "channels": header["channels"],
+        "duration_seconds": header["frames"] / header["sample_rate"],
+        "tile_peaks": header["tile_peaks"],
+        "levels": levels,
+    }
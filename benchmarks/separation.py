@@ -0,0 +1,93 @@
+"""
+Speed vs. quality of the separation engines on this machine.
+
+Separates each track with every engine through the same worker code the API
+uses, and reports the real-time factor (seconds of audio per second of
+processing) and, per stem, the SDR of each engine's output measured against
+the reference engine's output (higher = closer; identical output is inf).
+
+Usage (from the repository root):
+    python -m benchmarks.separation track1.wav [track2.flac ...] \
+        [--engines ht_demucs,ht_demucs_int8] [--threads 4]
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+import soundfile as sf
+
+from app.config import DEMUCS_CHUNK_SECONDS
+from app.services import demucs_worker
+from app.services.demucs import resolve_model_name
+
+DEFAULT_ENGINES = "ht_demucs,ht_demucs_int8"
+
+
+def sdr(reference: np.ndarray, estimate: np.ndarray) -> float:
+    """Signal-to-distortion ratio in dB (plain energy ratio, no scale invariance)."""
+    length = min(len(reference), len(estimate))
+    reference, estimate = reference[:length], estimate[:length]
+    noise = np.sum(np.square(reference - estimate))
+    if noise == 0:
+        return float("inf")
+    return float(10 * np.log10((np.sum(np.square(reference)) + 1e-12) / noise))
+
+
+def run_engine(engine: str, track: str, out_dir: Path) -> float:
+    """Separates one track and returns the processing time in seconds."""
+    model_name = resolve_model_name(engine)
+    demucs_worker.get_model(model_name)  # load outside of the timing
+    start = time.perf_counter()
+    demucs_worker.separate(track, model_name, str(out_dir), chunk_seconds=DEMUCS_CHUNK_SECONDS)
+    return time.perf_counter() - start
+
+
+def read_stems(out_dir: Path) -> Dict[str, np.ndarray]:
+    return {path.stem: sf.read(str(path), dtype="float32")[0] for path in sorted(out_dir.glob("*.wav"))}
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("tracks", nargs="+")
+    parser.add_argument("--engines", default=DEFAULT_ENGINES,
+                        help="Comma-separated API model names; the first one is the SDR reference")
+    parser.add_argument("--threads", type=int, default=0, help="torch threads (0 = torch default)")
+    args = parser.parse_args(argv)
+
+    engines = [e for e in args.engines.split(",") if e]
+    demucs_worker.init_worker([], args.threads)
+
+    audio_seconds = 0.0
+    times = {engine: 0.0 for engine in engines}
+    # engine -> stem -> SDR per track
+    scores: Dict[str, Dict[str, List[float]]] = {engine: {} for engine in engines[1:]}
+
+    with tempfile.TemporaryDirectory() as scratch:
+        for t, track in enumerate(args.tracks):
+            audio_seconds += sf.info(track).duration
+            reference = None
+            for e, engine in enumerate(engines):
+                out_dir = Path(scratch) / str(t) / str(e)
+                times[engine] += run_engine(engine, track, out_dir)
+                stems = read_stems(out_dir)
+                if reference is None:
+                    reference = stems
+                    continue
+                for name, data in stems.items():
+                    scores[engine].setdefault(name, []).append(sdr(reference[name], data))
+
+    print(f"{len(args.tracks)} track(s), {audio_seconds:.1f}s of audio, reference: {engines[0]}")
+    print(f"{'engine':<20} {'time (s)':>10} {'RTF':>8}  SDR vs reference (dB)")
+    for engine in engines:
+        rtf = audio_seconds / times[engine] if times[engine] else float("inf")
+        per_stem = "  ".join(
+            f"{name}={np.mean(values):.1f}" for name, values in sorted(scores.get(engine, {}).items())
+        )
+        print(f"{engine:<20} {times[engine]:>10.1f} {rtf:>8.2f}  {per_stem or '-'}")
+
+
+if __name__ == "__main__":
+    main()
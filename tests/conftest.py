@@ -0,0 +1,65 @@
+"""
+Shared fixtures. Routers are driven with raw ASGI calls; stores, caches and
+the storage index live in tmp_path, and pool jobs run inline.
+"""
+import json
+
+import pytest
+from fastapi import FastAPI
+
+from app.routers import upload
+from app.services import executor, pcm_cache, storage, upload_store
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = upload_store.UploadStore(tmp_path, tmp_path / "uploads.sqlite3")
+    monkeypatch.setattr(upload_store, "_store", store)
+    monkeypatch.setattr(pcm_cache, "_cache", pcm_cache.PcmCache(tmp_path / ".pcm", 1 << 30))
+    monkeypatch.setattr(storage, "_manager", storage.StorageManager(tmp_path / "storage.sqlite3", 1 << 30, {}))
+    
+    async def run(service, fn, *args, **kwargs):
+        return fn(*args, **kwargs)
+    
+    monkeypatch.setattr(executor, "run", run)
+    return store
+
+
+@pytest.fixture
+def upload_app(store):
+    app = FastAPI()
+    app.include_router(upload.router)
+    return app
+
+
+@pytest.fixture
+def send():
+    """Coroutine sending one request to an ASGI app; returns (status, decoded JSON body)."""
+    async def send(app, method, path, body=b"", headers=(), chunks=None):
+        parts = chunks if chunks is not None else [body]
+        messages = [
+            {"type": "http.request", "body": part, "more_body": i < len(parts) - 1}
+            for i, part in enumerate(parts)
+        ]
+        sent = []
+        
+        async def receive():
+            return messages.pop(0) if messages else {"type": "http.disconnect"}
+        
+        async def send_message(message):
+            sent.append(message)
+        
+        path, _, query = path.partition("?")
+        scope = {
+            "type": "http",
+            "method": method,
+            "path": path,
+            "query_string": query.encode(),
+            "headers": [(k.encode(), v.encode()) for k, v in headers],
+            "asgi": {"version": "3.0"},
+        }
+        await app(scope, receive, send_message)
+        payload = b"".join(m.get("body", b"") for m in sent[1:])
+        return sent[0]["status"], json.loads(payload) if payload else None
+    
+    return send
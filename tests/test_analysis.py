@@ -0,0 +1,33 @@
+"""
+Long-track analysis path (app/services/analysis.py): the streamed features
+must match the ones computed on the fully loaded signal.
+"""
+import numpy as np
+import pytest
+import soundfile as sf
+
+from app.services import analysis
+
+
+@pytest.fixture
+def click_chord_track(tmp_path):
+    """20s of clicks every half second over a chord that stops every other 2s, with silence around it."""
+    rate = analysis.SAMPLE_RATE
+    t = np.arange(20 * rate) / rate
+    clicks = np.where(np.arange(len(t)) % (rate // 2) < 200, 0.9, 0.0)
+    chord = 0.2 * sum(np.sin(2 * np.pi * f * t) for f in (261.6, 329.6, 392.0)) * (t % 4 < 2)
+    signal = np.concatenate([np.zeros(2 * rate), clicks + chord, np.zeros(rate)]).astype(np.float32)
+    path = tmp_path / "clicks.wav"
+    sf.write(path, signal, rate, subtype="FLOAT")
+    return str(path)
+
+
+def test_long_track_dynamic_complexity_matches(click_chord_track):
+    short, _ = analysis._run_network(click_chord_track, long_track=False, timeline=False)
+    # In a child process like in production: tearing down a degara network can crash
+    long = analysis._run_network_isolated(click_chord_track, long_track=True, timeline=False)
+    
+    expected = float(short["dynamic_complexity"])
+    streamed = analysis._dynamic_complexity(np.asarray(long["dynamics_power"], dtype=np.float64))
+    assert expected > 1
+    assert streamed == pytest.approx(expected, abs=1e-3)
@@ -0,0 +1,91 @@
+"""
+Sharing of in-flight separations in app/services/demucs.py (run_model).
+The pool is replaced by a fake separation that waits for its cancel event.
+"""
+import asyncio
+import threading
+
+import pytest
+
+from app.services import demucs
+
+
+class _Manager:
+    def Event(self):
+        return threading.Event()
+
+
+class _Cache:
+    def get(self, key):
+        return None
+
+
+@pytest.fixture
+def separations(tmp_path, monkeypatch):
+    started = []
+    
+    async def separate(sep, audio_path, demucs_model, key, selection, output_format):
+        started.append(sep)
+        # Like the worker, only notices a cancel at a chunk boundary
+        while not sep.cancel.is_set():
+            if getattr(sep, "finish", False):
+                entry = tmp_path / "outputs" / f"entry{len(started)}"
+                entry.mkdir(parents=True)
+                (entry / "vocals.wav").write_bytes(b"")
+                return entry
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.1)
+        raise RuntimeError("Separation cancelled")
+    
+    monkeypatch.setattr(demucs, "_separate", separate)
+    monkeypatch.setattr(demucs, "get_manager", lambda: _Manager())
+    monkeypatch.setattr(demucs, "get_cache", lambda: _Cache())
+    monkeypatch.setattr(demucs, "OUTPUT_DIR", tmp_path / "outputs")
+    monkeypatch.setattr(demucs, "_inflight", {})
+    audio = tmp_path / "track.wav"
+    audio.write_bytes(b"not really audio")
+    return str(audio), started
+
+
+def test_cancel_then_resubmit_starts_a_fresh_separation(separations):
+    audio, started = separations
+    
+    async def scenario():
+        first = asyncio.ensure_future(demucs.run_model(audio))
+        while not started:
+            await asyncio.sleep(0.01)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        
+        # Submitted while the cancelled job is still winding down
+        second = asyncio.ensure_future(demucs.run_model(audio))
+        while len(started) < 2:
+            await asyncio.sleep(0.01)
+        assert started[0].cancel.is_set() and not started[1].cancel.is_set()
+        await asyncio.sleep(0.2)  # the cancelled job finishes meanwhile
+        started[1].finish = True
+        return await second
+    
+    stems = asyncio.run(asyncio.wait_for(scenario(), 5))
+    assert list(stems) == ["vocals"]
+    assert demucs._inflight == {}
+
+
+def test_concurrent_callers_share_one_separation(separations):
+    audio, started = separations
+    
+    async def scenario():
+        first = asyncio.ensure_future(demucs.run_model(audio))
+        second = asyncio.ensure_future(demucs.run_model(audio))
+        while not started:
+            await asyncio.sleep(0.01)
+        # One of two waiters leaving doesn't cancel the job
+        first.cancel()
+        await asyncio.sleep(0.05)
+        assert not started[0].cancel.is_set()
+        started[0].finish = True
+        return await second
+    
+    assert list(asyncio.run(asyncio.wait_for(scenario(), 5))) == ["vocals"]
+    assert len(started) == 1
@@ -0,0 +1,60 @@
+"""
+Eviction and pinning in app/services/storage.py (StorageManager).
+"""
+import asyncio
+import threading
+
+import pytest
+
+from app.services import storage
+
+
+@pytest.fixture
+def manager(tmp_path):
+    return storage.StorageManager(tmp_path / "storage.sqlite3", 0, {})
+
+
+def _files(tmp_path, manager, accessed_at):
+    paths = []
+    for i, at in enumerate(accessed_at):
+        path = tmp_path / f"{i}.wav"
+        path.write_bytes(b"x" * 10)
+        manager.track(path, storage.OUTPUT, at)
+        paths.append(path)
+    return paths
+
+
+def test_evict_reads_lru_candidates_in_batches(tmp_path, manager, monkeypatch):
+    monkeypatch.setattr(storage, "EVICT_BATCH", 2)
+    # Ties on accessed_at straddle the batches
+    paths = _files(tmp_path, manager, [5, 1, 1, 1, 3, 4, 2])
+    manager.max_bytes = 20
+    manager.pin(paths[1])
+
+    result = manager.evict()
+
+    assert result == {"expired": 0, "evicted": 5, "freed_bytes": 50}
+    assert [p.exists() for p in paths] == [True, True, False, False, False, False, False]
+
+
+def test_ausing_pins_and_releases_off_the_event_loop(tmp_path, manager, monkeypatch):
+    (path,) = _files(tmp_path, manager, [1])
+    threads = []
+    for name in ("pin", "release"):
+        method = getattr(manager, name)
+
+        def record(*paths, method=method):
+            threads.append(threading.get_ident())
+            method(*paths)
+
+        monkeypatch.setattr(manager, name, record)
+
+    async def use():
+        async with manager.ausing(path):
+            assert manager.evict()["evicted"] == 0
+            return threading.get_ident()
+
+    loop_thread = asyncio.run(use())
+
+    assert len(threads) == 2 and loop_thread not in threads
+    assert manager.evict()["evicted"] == 1
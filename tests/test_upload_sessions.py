@@ -0,0 +1,155 @@
+"""
+Resumable upload protocol (app/routers/upload.py): chunk bookkeeping,
+verification on completion and session expiry.
+"""
+import asyncio
+import hashlib
+import os
+import time
+from urllib.parse import urlencode
+
+import pytest
+
+from app.routers import upload
+
+
+@pytest.fixture(autouse=True)
+def register(monkeypatch):
+    # Completed uploads aren't decoded or indexed here
+    async def register(file_id, path, original_name, content_hash):
+        return {"file_id": file_id, "path": path, "content_hash": content_hash}
+    
+    monkeypatch.setattr(upload, "_register", register)
+
+
+@pytest.fixture
+def client(upload_app, send):
+    def call(*args, **kwargs):
+        return asyncio.run(send(upload_app, *args, **kwargs))
+    
+    return call
+
+
+DATA = os.urandom(10_000)
+CHUNK = 4096
+
+
+def _sha(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _start(client, size=len(DATA), chunk_size=CHUNK):
+    form = urlencode({"filename": "take.wav", "size": size, "chunk_size": chunk_size}).encode()
+    return client(
+        "POST", "/upload/sessions", form,
+        headers=[("content-type", "application/x-www-form-urlencoded")],
+    )
+
+
+def _put(client, file_id, index, data, sha=None, chunks=None):
+    return client(
+        "PUT", f"/upload/sessions/{file_id}/chunks/{index}", data,
+        headers=[("x-chunk-sha256", sha or _sha(data))], chunks=chunks,
+    )
+
+
+def _complete(client, file_id, sha256=None):
+    form = urlencode({"sha256": sha256} if sha256 else {}).encode()
+    return client(
+        "POST", f"/upload/sessions/{file_id}/complete", form,
+        headers=[("content-type", "application/x-www-form-urlencoded")],
+    )
+
+
+def _put_all(client, file_id):
+    for index in range(0, len(DATA), CHUNK):
+        status, _ = _put(client, file_id, index // CHUNK, DATA[index:index + CHUNK])
+        assert status == 200
+
+
+def _missing(client, file_id):
+    status, body = client("GET", f"/upload/sessions/{file_id}")
+    assert status == 200
+    return body["missing"]
+
+
+def test_complete_upload(client):
+    status, session = _start(client)
+    assert status == 200 and session["chunks"] == 3
+    _put_all(client, session["file_id"])
+    
+    status, body = _complete(client, session["file_id"], _sha(DATA))
+    assert status == 200
+    assert body["content_hash"] == _sha(DATA)
+    with open(body["path"], "rb") as f:
+        assert f.read() == DATA
+
+
+def test_rejected_resend_clears_chunk(client):
+    _, session = _start(client)
+    file_id = session["file_id"]
+    _put_all(client, file_id)
+    
+    # A bad re-send has already overwritten the chunk's bytes
+    status, _ = _put(client, file_id, 1, b"x" * CHUNK, sha="0" * 64)
+    assert status == 400
+    assert _missing(client, file_id) == [1]
+    status, body = _complete(client, file_id)
+    assert status == 409 and body["detail"]["missing"] == [1]
+
+
+@pytest.mark.parametrize("data", [DATA[:CHUNK + 1], DATA[:CHUNK - 1]])
+def test_wrong_length_leaves_chunk_missing(client, data):
+    _, session = _start(client)
+    file_id = session["file_id"]
+    _put_all(client, file_id)
+    
+    status, _ = _put(client, file_id, 0, data, chunks=[data[:1000], data[1000:]])
+    assert status in (400, 413)
+    assert _missing(client, file_id) == [0]
+
+
+def test_checksum_mismatch_keeps_session(client):
+    _, session = _start(client)
+    file_id = session["file_id"]
+    _put_all(client, file_id)
+    
+    status, _ = _complete(client, file_id, "0" * 64)
+    assert status == 400
+    assert _missing(client, file_id) == []
+    status, body = _complete(client, file_id, _sha(DATA))
+    assert status == 200 and body["content_hash"] == _sha(DATA)
+
+
+def test_chunks_changed_during_completion(client, store):
+    _, session = _start(client)
+    file_id = session["file_id"]
+    _put_all(client, file_id)
+    session = store.get_session(file_id)
+    digests = store.chunk_digests(file_id)
+    
+    store.start_chunk(file_id, 2)
+    with pytest.raises(ValueError):
+        store.finish_session(session, digests)
+    assert store.get_session(file_id) is not None
+
+
+def test_size_is_capped(client, monkeypatch):
+    monkeypatch.setattr(upload, "UPLOAD_MAX_BYTES", len(DATA) - 1)
+    status, _ = _start(client)
+    assert status == 413
+
+
+def test_purge_keeps_active_sessions(client, store):
+    _, idle = _start(client)
+    _, active = _start(client)
+    old = time.time() - 3600
+    for session in (idle, active):
+        store._db.execute("UPDATE upload_sessions SET created_at = ? WHERE file_id = ?", (old, session["file_id"]))
+        store._db.commit()
+        os.utime(store.get_session(session["file_id"]).path, (old, old))
+    _put(client, active["file_id"], 0, DATA[:CHUNK])
+    
+    assert store.purge_sessions(60) == 1
+    assert store.get_session(idle["file_id"]) is None
+    assert store.get_session(active["file_id"]) is not None
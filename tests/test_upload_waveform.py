@@ -0,0 +1,64 @@
+"""
+Waveform of a just-uploaded file (app/routers/upload.py): uploads indexed
+from their header are decoded in the background, and /upload/waveform waits
+for that decode instead of starting another one.
+"""
+import asyncio
+import io
+
+import numpy as np
+import pytest
+import soundfile as sf
+
+from app.routers import upload
+from app.services import executor, waveform
+
+
+@pytest.fixture
+def decodes(store, monkeypatch):
+    """Decodes of uploads, each taking a moment like a real one."""
+    started = []
+    run = executor.run
+    
+    async def slow_run(service, fn, *args, **kwargs):
+        if fn is upload._ingest or fn is upload.pcm_cache.load:
+            started.append(fn.__name__)
+            await asyncio.sleep(0.2)
+        return await run(service, fn, *args, **kwargs)
+    
+    monkeypatch.setattr(executor, "run", slow_run)
+    return started
+
+
+def _wav_form():
+    buffer = io.BytesIO()
+    sf.write(buffer, np.zeros((44100, 2), dtype=np.float32), 44100, format="WAV", subtype="PCM_16")
+    body = (
+        b'--BOUNDARY\r\nContent-Disposition: form-data; name="file"; filename="take.wav"\r\n\r\n'
+        + buffer.getvalue() + b"\r\n--BOUNDARY--\r\n"
+    )
+    return body, [("content-type", "multipart/form-data; boundary=BOUNDARY")]
+
+
+async def _upload_then_waveform(app, send):
+    status, uploaded = await send(app, "POST", "/upload/audio", *_wav_form())
+    assert status == 200 and uploaded["duration_seconds"] == 1.0
+    return await send(app, "GET", f"/upload/waveform/{uploaded['file_id']}")
+
+
+def test_waveform_waits_for_the_upload_decode(upload_app, send, decodes):
+    status, levels = asyncio.run(_upload_then_waveform(upload_app, send))
+    assert status == 200 and levels
+    assert decodes == ["_ingest"]
+
+
+def test_waveform_errors_are_reported(upload_app, send, decodes, monkeypatch):
+    def broken(*args):
+        raise RuntimeError("no peaks today")
+    
+    monkeypatch.setattr(waveform, "build", broken)
+    status, body = asyncio.run(_upload_then_waveform(upload_app, send))
+    assert status == 500
+    assert "no peaks today" in body["detail"]
+    # The failed background decode is retried once, by the request
+    assert decodes == ["_ingest", "load"]